@@ -0,0 +1,83 @@
+"""Latency of writes made while SQLite database is being backed up.
+
+Seeded database is written by a background thread committing one post at a time, while the main thread
+copies it: not at all (baseline), incrementally within a pinned read transaction in WAL mode (as
+models.backup does), and in a single step in rollback journal mode, blocking writers.
+Run from src folder: `python -m benchmarks.backup_latency [posts count]`.
+"""
+
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from itertools import islice
+
+from models.backup import copy_database
+
+SEED = 42
+TEXT_LENGTH = 500
+
+
+def seed(path: str, count: int, journal_mode: str, rng: random.Random) -> None:
+    """Creates database of count posts with random texts."""
+    connection = sqlite3.connect(path)
+    connection.execute(f"PRAGMA journal_mode = {journal_mode}")
+    connection.execute("CREATE TABLE posts (id INTEGER PRIMARY KEY, text TEXT)")
+    texts = ("".join(rng.choices("abcdefghij ", k=TEXT_LENGTH)) for _ in range(count))
+    connection.executemany("INSERT INTO posts (text) VALUES (?)", ((x,) for x in texts))
+    connection.commit()
+    connection.close()
+
+
+def write(path: str, stop: threading.Event, latencies: list[float]) -> None:
+    """Commits single row inserts until stopped, recording duration of each."""
+    connection = sqlite3.connect(path, timeout=60)
+    while not stop.is_set():
+        started = time.perf_counter()
+        connection.execute("INSERT INTO posts (text) VALUES ('text')")
+        connection.commit()
+        latencies.append(time.perf_counter() - started)
+        time.sleep(0.001)
+    connection.close()
+
+
+def run(name: str, count: int, journal_mode: str, backup: bool) -> None:
+    """Measures write latencies during 1 second, or for the duration of the backup."""
+    scratch = tempfile.mkdtemp()
+    path = os.path.join(scratch, "source.db")
+    seed(path, count, journal_mode, random.Random(SEED))
+    latencies: list[float] = []
+    stop = threading.Event()
+    writer = threading.Thread(target=write, args=(path, stop, latencies))
+    writer.start()
+    time.sleep(0.1)
+    started = time.perf_counter()
+    if backup:
+        copy_database(path, os.path.join(scratch, "copy.db"))
+    else:
+        time.sleep(1)
+    duration = time.perf_counter() - started
+    stop.set()
+    writer.join()
+
+    quantiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    print(
+        f"{name:<12} {os.path.getsize(path) / 2**20:6.1f} MiB  backup {duration if backup else 0:6.2f} s"
+        f"  writes {len(latencies):6}  p50 {quantiles[49] * 1000:7.2f} ms  p99 {quantiles[98] * 1000:7.2f} ms"
+        f"  max {max(latencies) * 1000:7.2f} ms"
+    )
+
+
+def main(count: int = 200000) -> None:
+    """Runs all of the variants over databases of the same size."""
+    run("baseline", count, "wal", backup=False)
+    run("wal", count, "wal", backup=True)
+    run("rollback", count, "delete", backup=True)
+
+
+if __name__ == "__main__":
+    main(*(int(x) for x in islice(sys.argv[1:], 1)))
@@ -0,0 +1,107 @@
+"""Bytes on the wire and CPU time per request of list routes sent plain and in every supported encoding.
+
+Database is seeded as by benchmarks.read_memory, then requests are sent to the app in-process. CPU time
+is reported for the whole plain request and for compressing its body alone, and for public routes also for
+reusing compressed body, which is hashing the body and a lookup, see server.compression.
+Run from src folder: `DB_URI=sqlite:///<scratch file> python -m benchmarks.compression [users count]`.
+"""
+
+import asyncio
+import random
+import statistics
+import sys
+import time
+from collections.abc import Callable
+from itertools import islice
+
+from benchmarks.read_memory import READER, SEED, seed
+from benchmarks.replay import Request
+from config import DB_URI, FEED_PAGE_SIZE
+from server import app
+from server.compression import ENCODINGS, compress_body
+from server.server import compressed_bodies
+
+REPEATS = 5
+ROUTES = [
+    ("/users", "", None),
+    ("/users", "text_length=100", None),
+    ("/users/top", "", None),
+    ("/user/me/subscriptions", f"limit={FEED_PAGE_SIZE}", READER),
+]
+
+
+def recording(app: Callable, bodies: list[bytes]) -> Callable:
+    """ASGI app appending body of every response sent by the given one to bodies."""
+
+    async def wrapper(scope, receive, send) -> None:
+        body = bytearray()
+
+        async def send_recording(message) -> None:
+            if message["type"] == "http.response.body":
+                body.extend(message.get("body", b""))
+            await send(message)
+
+        await app(scope, receive, send_recording)
+        bodies.append(bytes(body))
+
+    return wrapper
+
+
+async def cpu_time(func: Callable, *args) -> float:
+    """Median process time in ms of awaiting func, threads compressing large bodies included."""
+    durations = []
+    for _ in range(REPEATS):
+        started = time.process_time()
+        await func(*args)
+        durations.append(time.process_time() - started)
+    return statistics.median(durations) * 1000
+
+
+async def measure(path: str, query: str, subject: str | None) -> None:
+    """Prints plain size and CPU time of the route, then size and compression cost in every encoding."""
+    record = {"method": "GET", "route": path, "path": path, "query": query, "subject": subject}
+    tokens: dict[str, str] = {}
+    bodies: list[bytes] = []
+
+    async def send(encoding: str) -> None:
+        request = Request(record, tokens)
+        request.scope["headers"].append((b"accept-encoding", encoding.encode()))
+        status, _ = await request.send_to(recording(app, bodies))
+        if status != 200:
+            raise RuntimeError(f"{path} answered {status}")
+
+    name = f"{path}?{query}" if query else path
+    await send("identity")
+    plain = bodies[-1]
+    print(f"{name:<40}{'identity':>9}{len(plain):11d}{'':>8}{await cpu_time(send, 'identity'):11.1f}")
+    for encoding in ENCODINGS:
+        compressed_bodies.clear()
+        await send(encoding)
+        size = len(bodies[-1])
+        compression = await cpu_time(compress_body, encoding, plain)
+        line = f"{name:<40}{encoding:>9}{size:11d}{size / len(plain):8.1%}{compression:11.2f}"
+        if not subject:
+            # Body of the public route was stored by the request above, so it's found by digest.
+            line += f"{await cpu_time(compressed_bodies.compress, encoding, plain):9.2f}"
+        print(line)
+
+
+async def run() -> None:
+    """Measures every route within app lifespan."""
+    async with app.router.lifespan_context(app):
+        print(f"{'route':<40}{'encoding':>9}{'bytes':>11}{'ratio':>8}{'CPU ms':>11}{'reused':>9}")
+        for path, query, subject in ROUTES:
+            await measure(path, query, subject)
+
+
+def main(count: int = 1000) -> None:
+    """Seeds the database and measures the routes."""
+    if "test" not in DB_URI.lower():
+        sys.exit("Run against a scratch database with 'test' in its name, it's filled with fake users.")
+    seed(count, random.Random(SEED))
+    print(f"{count} users, median of {REPEATS} runs, CPU time of the plain request and of compression alone")
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main(*(int(x) for x in islice(sys.argv[1:], 1)))
@@ -0,0 +1,103 @@
+"""Storage size and read throughput of post texts stored plain, compressed, and compressed with dictionary.
+
+Seeded corpus of posts is written into scratch SQLite databases, so results are reproducible.
+Run from src folder: `python -m benchmarks.post_compression [posts count]`.
+"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+from itertools import islice
+
+from peewee import SqliteDatabase
+
+from models import Post, User, db
+from models.compression import reset_dictionaries, train_post_dictionary
+from models.db import shards
+from models.post import post_columns, truncate_text
+from models.utils import create_tables
+
+SEED = 42
+PREVIEW_LENGTH = 100
+COMMON_WORDS = (
+    "the of and to in is you that it he was for on are as with his they at be this have from or one had by "
+    "but not what all were we when your can said there use an each which she do how their if will up other "
+    "about out many then them these so some her would make like him into time has look two more go see no way"
+).split()
+
+
+def corpus(count: int, rng: random.Random) -> list[str]:
+    """Post texts out of common words and a larger Zipf distributed vocabulary, 10 to 1000 characters long."""
+    letters = "etaoinshrdlucmfwypvbgkqjxz"
+    vocabulary = COMMON_WORDS + [
+        "".join(rng.choices(letters, weights=range(26, 0, -1), k=rng.randint(3, 10))) for _ in range(5000)
+    ]
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    texts = []
+    for _ in range(count):
+        length = min(999, max(11, int(rng.lognormvariate(5.5, 0.7))))
+        words = rng.choices(vocabulary, weights=weights, k=length // 4)
+        sentence = " ".join(words)[:length].strip()
+        texts.append(sentence[0].upper() + sentence[1:] + ".")
+    return texts
+
+
+def run(name: str, texts: list[str], compress: bool, dictionary: bool) -> None:
+    """Writes corpus into a fresh database and measures its size and reading speed."""
+    path = os.path.join(tempfile.mkdtemp(), f"{name}.db")
+    shards[:] = [SqliteDatabase(path)]
+    db.initialize(shards[0])
+    reset_dictionaries()
+    create_tables()
+    Post.text.compress = False
+    User.create(name="Writer", password="password")
+
+    def write(items: list[str]) -> None:
+        with db.atomic():
+            for text in items:
+                Post.create(author="Writer", title="title", text=text)
+
+    if dictionary:
+        # Dictionary is trained on the first part of the corpus written plain, as it would be in production.
+        write(texts[: len(texts) // 10])
+        train_post_dictionary()
+        Post.delete().execute()
+    Post.text.compress = compress
+    started = time.perf_counter()
+    write(texts)
+    write_time = time.perf_counter() - started
+    db.execute_sql("VACUUM")
+    stored = db.execute_sql("SELECT SUM(LENGTH(text)) FROM posts").fetchone()[0]
+
+    timings = {}
+    for mode, text_length in (("full", None), ("preview", PREVIEW_LENGTH)):
+        started = time.perf_counter()
+        for _ in range(3):
+            query = Post.select(*post_columns(text_length)).order_by(Post.id.desc())
+            for post in query:
+                truncate_text(post, text_length)
+        timings[mode] = 3 * len(texts) / (time.perf_counter() - started)
+
+    plain = sum(len(x.encode()) for x in texts)
+    print(
+        f"{name:<12} texts {stored / 2**20:6.2f} MiB ({stored / plain:6.1%})"
+        f"  file {os.path.getsize(path) / 2**20:6.2f} MiB"
+        f"  write {len(texts) / write_time:8.0f} posts/s"
+        f"  read {timings['full']:8.0f} posts/s"
+        f"  preview {timings['preview']:8.0f} posts/s"
+    )
+
+
+def main(count: int = 20000) -> None:
+    """Runs all of the variants over the same corpus."""
+    texts = corpus(count, random.Random(SEED))
+    print(f"{count} posts, {sum(len(x.encode()) for x in texts) / 2**20:.2f} MiB of text, preview {PREVIEW_LENGTH} chars")
+    run("plain", texts, compress=False, dictionary=False)
+    run("zstd", texts, compress=True, dictionary=False)
+    run("zstd+dict", texts, compress=True, dictionary=True)
+
+
+if __name__ == "__main__":
+    main(*(int(x) for x in islice(sys.argv[1:], 1)))
@@ -0,0 +1,101 @@
+"""Peak memory allocated while serving a request to the heaviest list routes: /users and subscriptions feed.
+
+Seeded database of users with posts is migrated, then requests are sent to the app in-process one by one
+with tracemalloc tracing allocations. Peak is counted above memory in use before the request.
+Run from src folder: `DB_URI=sqlite:///<scratch file> python -m benchmarks.read_memory [users count]`.
+"""
+
+import asyncio
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from itertools import islice
+
+from benchmarks.replay import Request
+from config import DB_URI, FEED_PAGE_SIZE
+from models import Post, Subscription, User, db
+from models.migrations import migrate
+from models.user import MAX_SUBSCRIPTIONS
+from models.utils import create_tables
+from server import app
+
+SEED = 42
+POSTS_PER_USER = 10
+REPEATS = 5
+READER = "reader"
+ROUTES = [
+    ("/users", "", None),
+    ("/users", "text_length=100", None),
+    ("/user/me/subscriptions", f"limit={FEED_PAGE_SIZE}", READER),
+]
+
+
+def seed(count: int, rng: random.Random) -> None:
+    """Creates users with posts of a few sentences each, reader is subscribed to as many of them as allowed."""
+    create_tables()
+    names = [f"user{i}" for i in range(count)]
+    words = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt".split()
+    started = datetime(2022, 9, 1)
+    with db.atomic():
+        User.insert_many([{"name": x, "password": "password"} for x in [READER, *names]]).execute()
+        posts = [
+            {
+                "author": x,
+                "title": " ".join(rng.choices(words, k=5)),
+                "text": " ".join(rng.choices(words, k=rng.randint(20, 150))),
+                "created": started + timedelta(minutes=rng.randint(0, 60 * 24 * 30)),
+            }
+            for x in names
+            for _ in range(POSTS_PER_USER)
+        ]
+        for i in range(0, len(posts), 1000):
+            Post.insert_many(posts[i : i + 1000]).execute()
+        followees = rng.sample(names, min(count, MAX_SUBSCRIPTIONS))
+        Subscription.insert_many([{"source": READER, "target": x} for x in followees]).execute()
+    migrate()
+
+
+async def measure(path: str, query: str, subject: str | None) -> tuple[float, float]:
+    """Median peak of allocated memory in KiB and median duration in ms of a request."""
+    record = {"method": "GET", "route": path, "path": path, "query": query, "subject": subject}
+    tokens: dict[str, str] = {}
+    await Request(record, tokens).send_to(app)
+    peaks, durations = [], []
+    for _ in range(REPEATS):
+        request = Request(record, tokens)
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        started = time.perf_counter()
+        status, _ = await request.send_to(app)
+        durations.append(time.perf_counter() - started)
+        peaks.append(tracemalloc.get_traced_memory()[1] - current)
+        if status != 200:
+            raise RuntimeError(f"{path} answered {status}")
+    return statistics.median(peaks) / 1024, statistics.median(durations) * 1000
+
+
+async def run() -> None:
+    """Measures every route within app lifespan."""
+    async with app.router.lifespan_context(app):
+        tracemalloc.start()
+        for path, query, subject in ROUTES:
+            peak, duration = await measure(path, query, subject)
+            name = f"{path}?{query}" if query else path
+            print(f"{name:<40} peak {peak:10.1f} KiB  {duration:8.1f} ms (traced)")
+        tracemalloc.stop()
+
+
+def main(count: int = 1000) -> None:
+    """Seeds the database and measures the routes."""
+    if "test" not in DB_URI.lower():
+        sys.exit("Run against a scratch database with 'test' in its name, it's filled with fake users.")
+    seed(count, random.Random(SEED))
+    print(f"{count} users, {POSTS_PER_USER} posts each, {REPEATS} requests per route")
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main(*(int(x) for x in islice(sys.argv[1:], 1)))
@@ -0,0 +1,180 @@
+"""Replays requests recorded by server.capture against the app in-process and reports latencies per route.
+
+Requests are sent at the recorded pace sped up `speed` times, or as fast as possible with speed 0,
+with at most `concurrency` of them in flight. Users the requests were made by get fresh tokens,
+stripped passwords of logins and signups are replaced by REPLAY_PASSWORD. Requests write to the
+database, so run it against a scratch copy, e.g. a shard restored from backup with models.backup.
+Run from src folder: `DB_URI=sqlite:///<test db> python -m benchmarks.replay <traces.jsonl> [--speed 10]`,
+save report with `--output`, compare to the report of another build with `--compare`.
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import sys
+import time
+from collections import defaultdict
+from collections.abc import Callable
+
+from config import DB_URI
+from fastapi import FastAPI
+from schemas.inbound import LoginPayload
+from server import app
+from server.utils import create_access_token
+
+REPLAY_PASSWORD = "Replay_password1"
+PERCENTILES = (50, 90, 99)
+
+
+def load_records(path: str) -> list[dict]:
+    """Records that can be replayed, in order of their timestamps."""
+    with open(path) as f:
+        records = [json.loads(x) for x in f if x.strip()]
+    return sorted((x for x in records if not x.get("truncated")), key=lambda x: x["timestamp"])
+
+
+class Request:
+    """Request of a record, ready to be sent."""
+
+    def __init__(self, record: dict, tokens: dict[str, str]) -> None:
+        self.name = f"{record['method']} {record['route']}"
+        self.scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": record["method"],
+            "scheme": "http",
+            "path": record["path"],
+            "raw_path": record["path"].encode(),
+            "query_string": record["query"].encode("latin-1"),
+            "root_path": "",
+            "headers": [(b"host", b"replay")],
+            "client": ("127.0.0.1", 0),
+            "server": ("replay", 80),
+        }
+        if record["subject"]:
+            if record["subject"] not in tokens:
+                tokens[record["subject"]] = create_access_token(data={"sub": record["subject"]})
+            self.scope["headers"].append((b"authorization", f"Bearer {tokens[record['subject']]}".encode()))
+        self.body = b""
+        if "json" in record:
+            payload = record["json"]
+            if isinstance(payload, dict) and set(LoginPayload.__fields__) - payload.keys() == {"password"}:
+                payload = {**payload, "password": REPLAY_PASSWORD}
+            self.body = json.dumps(payload).encode()
+            self.scope["headers"].append((b"content-type", b"application/json"))
+
+    async def send_to(self, app: Callable) -> tuple[int, float]:
+        """Sends request to ASGI app and reads the whole response. Returns its status and duration in seconds."""
+        status = 0
+        received = asyncio.Event()
+
+        async def receive() -> dict:
+            if received.is_set():
+                # Client never disconnects, streaming responses stop listening when done.
+                await asyncio.Future()
+            received.set()
+            return {"type": "http.request", "body": self.body, "more_body": False}
+
+        async def send(message: dict) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+
+        started = time.perf_counter()
+        try:
+            await app(dict(self.scope, headers=list(self.scope["headers"])), receive, send)
+        except Exception:
+            # Server would have answered 500 and logged the error, as the app itself has done.
+            status = 500
+        return status, time.perf_counter() - started
+
+
+async def replay(app: FastAPI, records: list[dict], speed: float = 1, concurrency: int = 32) -> dict:
+    """Sends requests of the records to the app, running its lifespan around. Returns report per route."""
+    tokens: dict[str, str] = {}
+    results: dict[str, list[tuple[int, float]]] = defaultdict(list)
+    slots = asyncio.Semaphore(concurrency)
+    pending = set()
+    lag = 0.0
+
+    async def run(request: Request) -> None:
+        try:
+            results[request.name].append(await request.send_to(app))
+        finally:
+            slots.release()
+
+    async with app.router.lifespan_context(app):
+        started = time.perf_counter()
+        for record in records:
+            if speed:
+                due = started + (record["timestamp"] - records[0]["timestamp"]) / speed
+                await asyncio.sleep(due - time.perf_counter())
+            await slots.acquire()
+            if speed:
+                lag = max(lag, time.perf_counter() - due)
+            task = asyncio.create_task(run(Request(record, tokens)))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+        await asyncio.gather(*pending)
+        duration = time.perf_counter() - started
+
+    routes = {}
+    for name, items in sorted(results.items(), key=lambda x: -len(x[1])):
+        latencies = [x for _, x in items]
+        if len(latencies) > 1:
+            quantiles = statistics.quantiles(latencies, n=100, method="inclusive")
+        else:
+            quantiles = latencies * 99
+        routes[name] = {
+            "count": len(items),
+            "errors": sum(status >= 400 for status, _ in items),
+            **{f"p{x}": quantiles[x - 1] * 1000 for x in PERCENTILES},
+            "max": max(latencies) * 1000,
+        }
+    return {"requests": len(records), "duration": duration, "max_lag": lag * 1000, "routes": routes}
+
+
+def print_report(report: dict, baseline: dict | None = None) -> None:
+    """Prints latencies in milliseconds per route, with ratios to the baseline report if given."""
+    print(
+        f"{report['requests']} requests in {report['duration']:.2f} s, "
+        f"up to {report['max_lag']:.1f} ms behind schedule"
+    )
+    header = "".join(f"{f'p{x}':>9}" for x in PERCENTILES)
+    print(f"{'route':<40}{'count':>7}{'errors':>7}{header}{'max':>9}")
+    for name, route in report["routes"].items():
+        line = f"{name:<40}{route['count']:>7}{route['errors']:>7}"
+        line += "".join(f"{route[f'p{x}']:9.2f}" for x in PERCENTILES) + f"{route['max']:9.2f}"
+        base = (baseline or {}).get("routes", {}).get(name)
+        if base:
+            line += "   vs baseline " + " ".join(f"{route[f'p{x}'] / base[f'p{x}']:5.2f}x" for x in PERCENTILES)
+        print(line)
+
+
+def main() -> None:
+    """Replays traces file given in command line."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("traces", help="JSON lines file recorded with TRAFFIC_CAPTURE_PATH")
+    parser.add_argument("--speed", type=float, default=1, help="speed up recorded pace, 0 for no pauses")
+    parser.add_argument("--concurrency", type=int, default=32, help="max count of requests in flight")
+    parser.add_argument("--output", help="save report as JSON")
+    parser.add_argument("--compare", help="JSON report of another build to compare latencies with")
+    args = parser.parse_args()
+    if "test" not in DB_URI.lower():
+        sys.exit("Replay writes to the database, run it against a copy with 'test' in its name.")
+
+    report = asyncio.run(replay(app, load_records(args.traces), args.speed, args.concurrency))
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
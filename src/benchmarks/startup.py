@@ -0,0 +1,107 @@
+"""Cold start of the server: import time, time until every worker is ready and memory they take.
+
+Seeded database of users and subscriptions is migrated once, then the server is started by uvicorn
+with workers importing the app each, and by gunicorn with the app preloaded and forked into workers.
+Run from src folder: `DB_URI=sqlite:///<scratch file> python -m benchmarks.startup [workers] [users count]`.
+"""
+
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+from itertools import islice
+from urllib.error import URLError
+
+from config import DB_URI
+from models import Subscription, User, db
+from models.migrations import migrate
+from models.utils import create_tables
+
+SEED = 42
+SUBSCRIPTIONS_PER_USER = 10
+STARTED_LINE = b"Application startup complete"
+
+
+def seed(count: int, rng: random.Random) -> None:
+    """Creates users subscribed to random other ones, then runs the migration step taking graph snapshot."""
+    create_tables()
+    names = [f"user{i}" for i in range(count)]
+    with db.atomic():
+        for i in range(0, count, 1000):
+            User.insert_many([{"name": x, "password": "password"} for x in names[i : i + 1000]]).execute()
+        pairs = {(x, rng.choice(names)) for x in names for _ in range(SUBSCRIPTIONS_PER_USER)}
+        rows = [{"source": s, "target": t} for s, t in pairs if s != t]
+        for i in range(0, len(rows), 1000):
+            Subscription.insert_many(rows[i : i + 1000]).execute()
+    migrate()
+
+
+def import_time() -> float:
+    """Seconds it takes a fresh interpreter to import the app."""
+    code = "import time; started = time.perf_counter(); import server; print(time.perf_counter() - started)"
+    return float(subprocess.run([sys.executable, "-c", code], capture_output=True, check=True).stdout)
+
+
+def process_tree(pid: int) -> list[int]:
+    """Process and all of its descendants."""
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            children = [int(x) for x in f.read().split()]
+    except OSError:
+        return [pid]
+    return [pid, *(x for child in children for x in process_tree(child))]
+
+
+def memory(pid: int) -> float:
+    """Proportional set size of the process tree in MiB, pages shared by workers are split among them."""
+    total = 0
+    for x in process_tree(pid):
+        with open(f"/proc/{x}/smaps_rollup") as f:
+            total += next(int(line.split()[1]) for line in f if line.startswith("Pss:"))
+    return total / 1024
+
+
+def run(name: str, command: list[str], workers: int) -> None:
+    """Starts the server and waits until all of the workers started and it answers readiness probe."""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    env = {**os.environ, "UVICORN_HOST": "127.0.0.1", "UVICORN_PORT": str(port), "WEB_CONCURRENCY": str(workers)}
+    started = time.perf_counter()
+    process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    try:
+        ready_workers = 0
+        while ready_workers < workers:
+            line = process.stderr.readline()
+            if not line:
+                raise RuntimeError(f"{name} exited before startup")
+            ready_workers += STARTED_LINE in line
+        workers_time = time.perf_counter() - started
+        while True:
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/health/ready") as response:
+                    if response.status == 200:
+                        break
+            except URLError:
+                time.sleep(0.01)
+        print(f"{name:<10} {workers} workers ready in {workers_time:5.2f} s, taking {memory(process.pid):6.1f} MiB")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main(workers: int = 4, count: int = 100000) -> None:
+    """Seeds the database and starts the server both ways."""
+    if "test" not in DB_URI.lower():
+        sys.exit("Run against a scratch database with 'test' in its name, it's filled with fake users.")
+    seed(count, random.Random(SEED))
+    print(f"{count} users, app import {import_time():.2f} s")
+    run("uvicorn", ["uvicorn", "server:app", "--workers", str(workers)], workers)
+    run("gunicorn", ["gunicorn", "server:app"], workers)
+
+
+if __name__ == "__main__":
+    main(*(int(x) for x in islice(sys.argv[1:], 2)))
@@ -1,4 +1,12 @@
 import os
+import tempfile
+import zlib
+
+
+def env_flag(name: str, default: str) -> bool:
+    """Boolean env variable, empty, 0, false, no and off turn it off."""
+    return os.getenv(name, default).strip().lower() not in ("", "0", "false", "no", "off")
+
 
 # Default database(sqlite3)
 
@@ -9,11 +17,82 @@ DB_FALLBACK_URI = "sqlite:///../database/embed_api.db"
 # postgres and mysql drivers comes installed in the docker image
 DB_URI = os.getenv("DB_URI") or DB_FALLBACK_URI
 
+# Optional comma separated list of extra databases to spread users across, same format as DB_URI.
+# Run `make rebalance` after changing it to move existing users to their new shards.
+DB_SHARD_URIS = [x for x in os.getenv("DB_SHARD_URIS", "").split(",") if x]
+
+# Path prefix of subscriptions graph index files shared by the workers of a host, see models/graph.py.
+# Index is a cache of the database kept up to date through the events log, so it needs no shared volume.
+SOCIAL_GRAPH_PATH = os.getenv("SOCIAL_GRAPH_PATH") or os.path.join(
+    tempfile.gettempdir(), f"social_graph_{zlib.crc32(DB_URI.encode())}"
+)
+
+# Graph index snapshot is retaken once its journal grows over this size, so workers don't replay it endlessly
+SOCIAL_GRAPH_JOURNAL_MAX_MB = float(os.getenv("SOCIAL_GRAPH_JOURNAL_MAX_MB", "16"))
+
+# Directory of compressed SQLite snapshots, see models/backup.py
+BACKUP_DIR = os.getenv("BACKUP_DIR", "../database/backups")
+
+# Server backs SQLite shards up this often, 0 turns scheduled backups off
+BACKUP_INTERVAL_HOURS = float(os.getenv("BACKUP_INTERVAL_HOURS", "0"))
+
+# Count of the latest snapshots to keep per shard
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "7"))
+
 # Remote url for documentations
 REMOTE_URL = os.getenv("REMOTE_URL", "http://localhost:8000")
 
 # How many posts should contain user profile at /users/
-POST_PREVIEW_COUNT = os.getenv("POST_PREVIEW_COUNT", "5")
+POST_PREVIEW_COUNT = int(os.getenv("POST_PREVIEW_COUNT", "5"))
+
+# Default and maximal count of posts per page of subscriptions feed at /user/me/subscriptions
+FEED_PAGE_SIZE = int(os.getenv("FEED_PAGE_SIZE", "50"))
+
+# Default and maximal count of users per page of /users/search
+USERS_PAGE_SIZE = int(os.getenv("USERS_PAGE_SIZE", "50"))
+
+# Store texts of new posts compressed with zstd, see models/compression.py
+COMPRESS_POST_TEXT = env_flag("COMPRESS_POST_TEXT", "")
+
+# Posts older than this count of full months are moved to compressed archive by `make archive`
+ARCHIVE_AFTER_MONTHS = int(os.getenv("ARCHIVE_AFTER_MONTHS", "12"))
+
+# Count of users to recommend at /user/me/recommendations
+RECOMMENDATIONS_COUNT = int(os.getenv("RECOMMENDATIONS_COUNT", "20"))
+
+# Recommendations older than this are recomputed by `make recommendations` even if nothing changed
+RECOMMENDATIONS_MAX_AGE_HOURS = int(os.getenv("RECOMMENDATIONS_MAX_AGE_HOURS", "24"))
+
+# Max count of change events handed to a consumer or sent by /events at once
+EVENTS_BATCH_SIZE = int(os.getenv("EVENTS_BATCH_SIZE", "100"))
+
+# How often in-process consumers and /events streams look for new change events, in seconds
+EVENTS_POLL_SECONDS = float(os.getenv("EVENTS_POLL_SECONDS", "1"))
+
+# Change events younger than this are not read yet, so events of transactions committed out of order
+# are not skipped by consumers. Writes to a single SQLite database are serialized, so ids are assigned
+# in commit order there, while generated ids of several shards and Postgres sequences are not.
+EVENTS_DELAY_SECONDS = float(
+    os.getenv("EVENTS_DELAY_SECONDS") or (0 if not DB_SHARD_URIS and DB_URI.startswith("sqlite") else 2)
+)
+
+# Run periodic database upkeep and derived data audits in background, see models/maintenance.py
+ENABLE_MAINTENANCE = env_flag("MAINTENANCE_ENABLED", "1")
+
+# File to record served requests to as JSON lines, for benchmarks.replay. Empty turns recording off.
+TRAFFIC_CAPTURE_PATH = os.getenv("TRAFFIC_CAPTURE_PATH", "")
+
+# Share of requests recorded to TRAFFIC_CAPTURE_PATH
+TRAFFIC_CAPTURE_SAMPLE = float(os.getenv("TRAFFIC_CAPTURE_SAMPLE", "1"))
+
+# Compress responses with zstd, brotli or gzip as client accepts, see server/compression.py
+ENABLE_COMPRESSION = env_flag("COMPRESSION_ENABLED", "1")
+
+# Responses smaller than this many bytes are sent as they are, compression barely pays off for them.
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+
+# Megabytes of compressed public responses every worker keeps to send again for equal bodies.
+COMPRESSION_CACHE_MB = float(os.getenv("COMPRESSION_CACHE_MB", "32"))
 
 # Env variable to turn on/off CORS middleware if needed.
 ENABLE_CORS = bool(os.getenv("CORS_ENABLED", "0"))
@@ -25,6 +25,12 @@ user_not_found_exception = HTTPException(
     status_code=status.HTTP_404_NOT_FOUND, detail="User not found"
 )
 
+# Exception to handle filtration by usernames that don't exist
+usernames_not_found_exception = HTTPException(
+    status_code=status.HTTP_404_NOT_FOUND,
+    detail="Some of provided usernames do not exist",
+)
+
 # Exeption to handle duplicate subscription error
 subscription_exists_exception = HTTPException(
     status_code=status.HTTP_409_CONFLICT, detail="Subscription already exists"
@@ -40,3 +46,9 @@ cant_subscribe_to_youserlf = HTTPException(
     status_code=status.HTTP_403_FORBIDDEN,
     detail="Not allowed to subscibe to your own account",
 )
+
+# Exception to handle readiness probe of a worker still starting or missing its database
+service_not_ready_exception = HTTPException(
+    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+    detail="Service is not ready",
+)
@@ -0,0 +1,30 @@
+"""Production server settings, picked up by `gunicorn server:app` run from src folder.
+
+App is imported once by the master process and forked into uvicorn workers, so they start without
+importing anything and share the memory pages of loaded code. Run `python -m models.migrations` first.
+"""
+
+import math
+import os
+
+
+def available_cpus() -> int:
+    """CPUs the container may use: cgroup quota if there is one, otherwise CPUs the process may run on."""
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            return max(1, math.ceil(int(quota) / int(period)))
+    except (OSError, ValueError):
+        pass
+    return len(os.sched_getaffinity(0))
+
+
+bind = f"{os.getenv('UVICORN_HOST', '0.0.0.0')}:{os.getenv('UVICORN_PORT', '8000')}"  # noqa: S104
+# Workers are async, so one per CPU keeps them all busy.
+workers = int(os.getenv("WEB_CONCURRENCY") or available_cpus())
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+# Startup of a worker includes mapping graph index, see server.lifespan.
+timeout = 60
+accesslog = "-"
@@ -8,7 +8,24 @@ from peewee import IntegrityError
 
 from .db import db
 from .post import Post
+from .archive import PostArchive  # noqa: I001 - depends on Post
 from .subscription import Subscription
+from .graph import graph  # noqa: I001 - depends on Subscription
+from .recommendation import Recommendation
+from .event import Event, EventOffset
+from .interest import Interest
 from .user import User
 
-__all__ = ["db", "Post", "Subscription", "User", "IntegrityError"]
+__all__ = [
+    "db",
+    "Event",
+    "EventOffset",
+    "Interest",
+    "Post",
+    "PostArchive",
+    "Recommendation",
+    "Subscription",
+    "User",
+    "graph",
+    "IntegrityError",
+]
@@ -0,0 +1,127 @@
+import json
+import zlib
+from collections import defaultdict
+from collections.abc import Iterator
+from datetime import date, datetime
+
+from peewee import BlobField, CharField, DeferredForeignKey, IntegerField, Model, fn
+
+from config import ARCHIVE_AFTER_MONTHS
+from models import Post, db
+from models.rows import PostRow
+from models.sharding import scatter
+
+
+def period_of(value: date) -> str:
+    """Monthly partition key of a date, like 2022-09."""
+    return f"{value.year:04d}-{value.month:02d}"
+
+
+class PostArchive(Model):
+    """Cold storage partition: all posts of a single author published within a single month.
+
+    Posts are stored as zlib compressed JSON, so partition is read and decompressed as a whole.
+    """
+
+    # id field will be created by ORM
+    author = DeferredForeignKey("User", backref="archived_posts")
+    period = CharField(7)
+    post_count = IntegerField()
+    data = BlobField()
+
+    class Meta:
+        """Peewee Meta class."""
+
+        table_name = "posts_archive"
+        database = db
+        # Only one partition per author per month.
+        indexes = ((("author", "period"), True),)
+
+    @staticmethod
+    def pack(posts: list[Post | PostRow]) -> bytes:
+        """Compresses posts into partition data."""
+        rows = [[x.id, x.title, x.text, x.created.isoformat()] for x in posts]
+        return zlib.compress(json.dumps(rows).encode(), 9)
+
+    def unpack(self) -> list[PostRow]:
+        """Decompresses partition data into post rows, most recent first."""
+        rows = json.loads(zlib.decompress(self.data))
+        return [
+            PostRow(post_id, self.author_id, title, text, datetime.fromisoformat(created))
+            for post_id, title, text, created in rows
+        ]
+
+
+def archived_post_count(author: str) -> int:
+    """Count of archived posts of the author."""
+    query = PostArchive.select(fn.SUM(PostArchive.post_count)).where(PostArchive.author == author)
+    return query.scalar() or 0
+
+
+def iter_archived_posts(
+    author: str,
+    keyword: str | None = None,
+    start: date | None = None,
+    end: date | None = None,
+    before: int | None = None,
+) -> Iterator[PostRow]:
+    """Archived posts of the author, most recent first, filtered same way as models.utils.post_filter_query_builder.
+
+    Partitions out of start/end range are pruned, so they are not even read from disk.
+    Generator is lazy: no query is done until the first post is requested.
+    """
+    query = PostArchive.select().where(PostArchive.author == author)
+    if start:
+        query = query.where(PostArchive.period >= period_of(start))
+    if end:
+        query = query.where(PostArchive.period <= period_of(end))
+
+    for partition in query.order_by(PostArchive.period.desc()):
+        for post in partition.unpack():
+            if before is not None and post.id >= before:
+                continue
+            if keyword and keyword.lower() not in post.title.lower():
+                continue
+            if start and post.created.date() < start:
+                continue
+            if end and post.created.date() > end:
+                continue
+            yield post
+
+
+def archive_posts(before: date) -> int:
+    """Moves posts published before the month of given date to the archive. Returns count of moved posts.
+
+    Every author is moved in a separate transaction, so job can be interrupted at any moment.
+    Running it again for the same months merges posts into existing partitions.
+    """
+    cutoff = datetime(before.year, before.month, 1)
+    moved = 0
+    authors = Post.select(Post.author).where(Post.created < cutoff).distinct().tuples()
+    for (author,) in list(authors):
+        with db.atomic():
+            posts = Post.select().where(Post.author == author, Post.created < cutoff)
+            periods = defaultdict(list)
+            for post in posts:
+                periods[period_of(post.created)].append(post)
+
+            for period, items in periods.items():
+                partition = PostArchive.get_or_none(author=author, period=period)
+                if not partition:
+                    partition = PostArchive(author=author, period=period)
+                else:
+                    items += partition.unpack()
+                items.sort(key=lambda x: x.id, reverse=True)
+                partition.post_count = len(items)
+                partition.data = PostArchive.pack(items)
+                partition.save()
+
+            moved += Post.delete().where(Post.author == author, Post.created < cutoff).execute()
+    return moved
+
+
+def archive_old_posts() -> int:
+    """Archives posts older than ARCHIVE_AFTER_MONTHS full months in every shard."""
+    today = date.today()
+    months = today.year * 12 + today.month - 1 - ARCHIVE_AFTER_MONTHS
+    return sum(scatter(archive_posts, date(months // 12, months % 12 + 1, 1)))
@@ -0,0 +1,208 @@
+"""Online backups of SQLite shards.
+
+Snapshot is copied with SQLite backup API a few pages at a time, sleeping in between. In WAL mode
+(SQLite shards are switched to it, see models.db.get_db) the whole copy is made within a single read
+transaction: writers are not blocked at all, and the copy is never restarted by their commits.
+Databases in rollback journal mode can't be copied incrementally while written to, so they are copied
+in a single step, blocking writers for its duration.
+
+Copy is checked with integrity_check, compressed with zstd and described by a JSON manifest with
+checksum and row counts of every table, which are verified by restore before and after overwriting.
+Data derived from a restored shard, graph index and trending counters, is taken anew from it.
+"""
+
+import asyncio
+import fcntl
+import glob
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import time
+from datetime import datetime
+
+import zstandard
+from peewee import SqliteDatabase
+
+from config import BACKUP_DIR, BACKUP_INTERVAL_HOURS, BACKUP_KEEP
+from models import graph
+from models.db import shards
+from models.event import SHARD_RESTORED, record_event
+from models.sharding import using_shard
+from models.trending import reset_trending_counters
+
+logger = logging.getLogger(__name__)
+
+STEP_PAGES = 256
+STEP_SLEEP_SECONDS = 0.005
+COMPRESSION_LEVEL = 3
+CHUNK_SIZE = 1 << 20
+# How often background task checks whether the next backup is due.
+SCHEDULE_CHECK_SECONDS = 60
+
+
+class BackupError(Exception):
+    """Snapshot is damaged or doesn't match its manifest."""
+
+
+def sqlite_shards() -> list[tuple[int, str]]:
+    """Index and file path of every SQLite shard, other databases have their own backup tools."""
+    return [(i, x.database) for i, x in enumerate(shards) if isinstance(x, SqliteDatabase)]
+
+
+def copy_database(
+    source_path: str, target_path: str, pages: int = STEP_PAGES, sleep: float = STEP_SLEEP_SECONDS
+) -> None:
+    """Copies live database into a new file, see module docstring."""
+    source = sqlite3.connect(source_path, isolation_level=None)
+    target = sqlite3.connect(target_path)
+    try:
+        if source.execute("PRAGMA journal_mode").fetchone()[0] == "wal":
+            # Pinning current WAL snapshot, so commits made in the meantime don't restart the copy.
+            source.execute("BEGIN")
+            source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        else:
+            pages = -1
+        source.backup(target, pages=pages, sleep=sleep)
+    finally:
+        source.close()
+        target.close()
+
+
+def sha256_of(path: str) -> str:
+    """Hex SHA-256 digest of the file."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def check_database(path: str) -> dict[str, int]:
+    """Runs integrity check of the database file. Returns row counts of its tables."""
+    connection = sqlite3.connect(path)
+    try:
+        result = connection.execute("PRAGMA integrity_check").fetchall()
+        if result != [("ok",)]:
+            raise BackupError(f"Integrity check of {path} failed: {result[:5]}")
+        query = "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name"
+        tables = [x for (x,) in connection.execute(query)]
+        return {x: connection.execute(f'SELECT COUNT(*) FROM "{x}"').fetchone()[0] for x in tables}
+    finally:
+        connection.close()
+
+
+def backup_database(index: int, path: str, directory: str = BACKUP_DIR) -> str:
+    """Writes compressed snapshot of the shard and its manifest into directory. Returns snapshot path."""
+    name = f"shard{index}-{datetime.now().strftime('%Y%m%dT%H%M%S%f')}.db.zst"
+    with tempfile.TemporaryDirectory(dir=directory) as scratch:
+        copy = os.path.join(scratch, "copy.db")
+        copy_database(path, copy)
+        tables = check_database(copy)
+        compressed = os.path.join(scratch, name)
+        with open(copy, "rb") as source, open(compressed, "wb") as target:
+            zstandard.ZstdCompressor(level=COMPRESSION_LEVEL, write_checksum=True).copy_stream(source, target)
+        manifest = {
+            "shard": index,
+            "source": os.path.abspath(path),
+            "created": datetime.now().isoformat(),
+            "size": os.path.getsize(copy),
+            "sha256": sha256_of(compressed),
+            "tables": tables,
+        }
+        with open(f"{compressed}.json", "w") as f:
+            json.dump(manifest, f, indent=2)
+        # Manifest goes last, so snapshots without one are known to be incomplete.
+        snapshot = os.path.join(directory, name)
+        os.replace(compressed, snapshot)
+        os.replace(f"{compressed}.json", f"{snapshot}.json")
+    return snapshot
+
+
+def list_backups(directory: str = BACKUP_DIR, index: int | None = None) -> list[str]:
+    """Complete snapshots, oldest first, optionally of given shard only."""
+    pattern = f"shard{'*' if index is None else index}-*.db.zst.json"
+    return sorted(x.removesuffix(".json") for x in glob.glob(os.path.join(glob.escape(directory), pattern)))
+
+
+def prune_backups(index: int, directory: str = BACKUP_DIR, keep: int = BACKUP_KEEP) -> None:
+    """Removes all of the shard snapshots but the latest ones."""
+    for snapshot in list_backups(directory, index)[:-keep]:
+        os.remove(f"{snapshot}.json")
+        os.remove(snapshot)
+
+
+def backup_all(directory: str = BACKUP_DIR) -> list[str]:
+    """Backs up every SQLite shard. Returns snapshot paths, or nothing if another process is doing it right now."""
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, ".lock"), "a") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return []
+        snapshots = []
+        for index, path in sqlite_shards():
+            snapshots.append(backup_database(index, path, directory))
+            prune_backups(index, directory)
+        return snapshots
+
+
+def restore_database(snapshot: str, path: str | None = None) -> dict:
+    """Verifies snapshot and copies it over the database, the shard it was taken from by default.
+
+    Database is overwritten through backup API, so connections open by running workers stay valid
+    and see restored data. If it's one of the shards, graph index and trending counters are refreshed,
+    graph indexes of other hosts are rebuilt by their consumers. Returns manifest of the snapshot.
+    """
+    with open(f"{snapshot}.json") as f:
+        manifest = json.load(f)
+    if sha256_of(snapshot) != manifest["sha256"]:
+        raise BackupError(f"Checksum of {snapshot} doesn't match its manifest")
+    path = path or manifest["source"]
+
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(path))) as scratch:
+        copy = os.path.join(scratch, "restore.db")
+        with open(snapshot, "rb") as source, open(copy, "wb") as target:
+            zstandard.ZstdDecompressor().copy_stream(source, target)
+        if check_database(copy) != manifest["tables"]:
+            raise BackupError(f"Row counts of {snapshot} don't match its manifest")
+
+        source, target = sqlite3.connect(copy), sqlite3.connect(path)
+        try:
+            source.backup(target)
+        finally:
+            source.close()
+            target.close()
+    if check_database(path) != manifest["tables"]:
+        raise BackupError(f"Row counts of restored {path} don't match manifest of {snapshot}")
+
+    restored = [
+        x for x in shards if isinstance(x, SqliteDatabase) and os.path.abspath(x.database) == os.path.abspath(path)
+    ]
+    for shard in restored:
+        with using_shard(shard):
+            record_event(SHARD_RESTORED, "", {"snapshot": os.path.basename(snapshot)})
+            reset_trending_counters()
+        graph.rebuild()
+    return manifest
+
+
+def backup_due(directory: str = BACKUP_DIR, interval_hours: float = BACKUP_INTERVAL_HOURS) -> bool:
+    """Whether the latest snapshot is older than the interval."""
+    snapshots = list_backups(directory)
+    if not snapshots:
+        return True
+    return time.time() - max(os.path.getmtime(x) for x in snapshots) >= interval_hours * 3600
+
+
+async def run_backups(directory: str = BACKUP_DIR, interval_hours: float = BACKUP_INTERVAL_HOURS) -> None:
+    """Backs up shards every interval_hours forever. Every worker runs it, the first one to see it's due does it."""
+    while True:
+        try:
+            if backup_due(directory, interval_hours):
+                await asyncio.to_thread(backup_all, directory)
+        except Exception:
+            logger.exception("Backup failed")
+        await asyncio.sleep(SCHEDULE_CHECK_SECONDS)
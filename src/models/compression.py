@@ -0,0 +1,191 @@
+"""Transparent zstd compression of post texts with a shared dictionary.
+
+Posts are short, so compressing them one by one gains little unless compressor is primed with
+a dictionary trained on the texts themselves. Dictionaries are stored in every shard next to the posts,
+frames refer to the one they were compressed with, so training a new dictionary never breaks old rows.
+"""
+
+import threading
+from datetime import datetime
+from itertools import chain
+
+import zstandard
+from peewee import BigIntegerField, BlobField, DateTimeField, Model
+
+from config import COMPRESS_POST_TEXT
+from models import db
+from models.db import shards
+from models.sharding import scatter
+
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+COMPRESSION_LEVEL = 9
+DICTIONARY_SIZE = 16 * 1024
+DICTIONARY_SAMPLES = 20000
+# Streaming decompression of a part of the frame pays off on large frames only, smaller ones are decompressed whole.
+PARTIAL_DECOMPRESSION_MIN_SIZE = 16 * 1024
+
+
+class CompressionDictionary(Model):
+    """Trained zstd dictionary, identical in every shard."""
+
+    # Id zstd writes into frame headers.
+    id = BigIntegerField(primary_key=True)
+    data = BlobField()
+    created = DateTimeField(default=datetime.now)
+
+    class Meta:
+        """Peewee Meta class."""
+
+        table_name = "compression_dictionaries"
+        database = db
+
+
+# Dictionaries loaded by this process, by id, and the latest one to compress with.
+_dictionaries: dict[int, zstandard.ZstdCompressionDict] = {}
+_latest: list[zstandard.ZstdCompressionDict | None] = []
+# Compression contexts are not thread safe, but costly to create, so every thread keeps its own ones.
+_contexts = threading.local()
+
+
+def get_dictionary(dict_id: int) -> zstandard.ZstdCompressionDict:
+    """Dictionary by id, looked up in every shard, since rows could be moved by rebalancing."""
+    if dict_id not in _dictionaries:
+        query = CompressionDictionary.select().where(CompressionDictionary.id == dict_id)
+        row = next(chain(*scatter(lambda: list(query.clone()))))
+        dictionary = zstandard.ZstdCompressionDict(bytes(row.data))
+        dictionary.precompute_compress(level=COMPRESSION_LEVEL)
+        _dictionaries[dict_id] = dictionary
+    return _dictionaries[dict_id]
+
+
+def latest_dictionary() -> zstandard.ZstdCompressionDict | None:
+    """The most recently trained dictionary, if any. Loaded once per process."""
+    if not _latest:
+        query = CompressionDictionary.select(CompressionDictionary.id, CompressionDictionary.created)
+        rows = chain(*scatter(lambda: list(query.clone())))
+        latest = max(rows, key=lambda x: x.created, default=None)
+        _latest.append(get_dictionary(latest.id) if latest else None)
+    return _latest[0]
+
+
+def reset_dictionaries() -> None:
+    """Forgets loaded dictionaries, so the latest one is looked up again."""
+    _dictionaries.clear()
+    _latest.clear()
+    _contexts.__dict__.clear()
+
+
+def compressor() -> zstandard.ZstdCompressor:
+    """Compressor of the current thread primed with the latest dictionary."""
+    dictionary = latest_dictionary()
+    dict_id = dictionary.dict_id() if dictionary else 0
+    if getattr(_contexts, "compressor", (None, None))[0] != dict_id:
+        context = zstandard.ZstdCompressor(level=COMPRESSION_LEVEL, dict_data=dictionary, write_checksum=False)
+        _contexts.compressor = (dict_id, context)
+    return _contexts.compressor[1]
+
+
+def compress(text: str) -> bytes:
+    """Compresses text with the latest dictionary. Falls back to plain UTF-8 if it doesn't get any smaller."""
+    data = text.encode()
+    compressed = compressor().compress(data)
+    return compressed if len(compressed) < len(data) else data
+
+
+def decompressor(frame: bytes) -> zstandard.ZstdDecompressor:
+    """Decompressor of the current thread primed with the dictionary frame was compressed with."""
+    dict_id = zstandard.get_frame_parameters(frame).dict_id
+    if not hasattr(_contexts, "decompressors"):
+        _contexts.decompressors = {}
+    if dict_id not in _contexts.decompressors:
+        dictionary = get_dictionary(dict_id) if dict_id else None
+        _contexts.decompressors[dict_id] = zstandard.ZstdDecompressor(dict_data=dictionary)
+    return _contexts.decompressors[dict_id]
+
+
+def decompress(value: str | bytes | memoryview) -> str:
+    """Text out of database value: zstd frame, plain UTF-8 bytes or text stored before compression was introduced."""
+    if isinstance(value, str):
+        return value
+    value = bytes(value)
+    if value.startswith(ZSTD_MAGIC):
+        return decompressor(value).decompress(value).decode()
+    return value.decode()
+
+
+def decompress_preview(value: str | bytes | memoryview, length: int) -> str:
+    """First length characters of database value, decompressing only as much of the frame as needed."""
+    if isinstance(value, str):
+        return value[:length]
+    value = bytes(value)
+    if value.startswith(ZSTD_MAGIC):
+        if zstandard.get_frame_parameters(value).content_size < PARTIAL_DECOMPRESSION_MIN_SIZE:
+            return decompress(value)[:length]
+        # Up to 4 bytes per character in UTF-8, character cut in half at the end is dropped.
+        value = decompressor(value).stream_reader(value).read(length * 4)
+    return value[: length * 4].decode(errors="ignore")[:length]
+
+
+class CompressedTextField(BlobField):
+    """Text field stored compressed with zstd if COMPRESS_POST_TEXT is on, see module docstring.
+
+    Values are always read transparently, no matter whether they were compressed or not.
+    Plain values are written as UTF-8 bytes through the blob adapter too: bound as text, Postgres would parse
+    them with bytea input rules, mangling backslashes. Text columns of older databases are altered to blobs
+    by the migration step, see models.migrations.
+    """
+
+    def __init__(self, *args, compress: bool = COMPRESS_POST_TEXT, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.compress = compress
+
+    def db_value(self, value: str | None):  # noqa: ANN201
+        """Compressed or plain UTF-8 bytes."""
+        if value is None:
+            return None
+        return super().db_value(compress(value) if self.compress else value.encode())
+
+    def python_value(self, value: str | bytes | None) -> str | None:
+        """Decompressed text."""
+        return value if value is None else decompress(value)
+
+
+def train_post_dictionary(samples: int = DICTIONARY_SAMPLES, size: int = DICTIONARY_SIZE) -> int:
+    """Trains dictionary on the latest posts of every shard and stores it in all of them. Returns its id.
+
+    Posts written after that are compressed with it, already stored ones are rewritten by recompress_posts().
+    """
+    # Imported here since Post model depends on compression itself.
+    from models import Post
+
+    query = Post.select(Post.text).order_by(Post.id.desc()).limit(samples // len(shards) + 1).tuples()
+    texts = [x.encode() for (x,) in chain(*scatter(lambda: list(query.clone())))]
+    dictionary = zstandard.train_dictionary(size, texts, level=COMPRESSION_LEVEL)
+    row = {"id": dictionary.dict_id(), "data": dictionary.as_bytes()}
+    scatter(lambda: CompressionDictionary.insert(row).on_conflict_ignore().execute())
+    reset_dictionaries()
+    return dictionary.dict_id()
+
+
+def recompress_posts(batch_size: int = 1000) -> int:
+    """Rewrites texts of all posts in every shard with current settings and dictionary. Returns count of posts.
+
+    Every batch is rewritten in a separate transaction, so job can be interrupted at any moment.
+    """
+    # Imported here since Post model depends on compression itself.
+    from models import Post
+
+    def recompress_shard() -> int:
+        count, last = 0, 0
+        while True:
+            with db.atomic():
+                query = Post.select(Post.id, Post.text).where(Post.id > last).order_by(Post.id).limit(batch_size)
+                posts = list(query)
+                for post in posts:
+                    Post.update(text=post.text).where(Post.id == post.id).execute()
+            if not posts:
+                return count
+            count += len(posts)
+            last = posts[-1].id
+
+    return sum(scatter(recompress_shard))
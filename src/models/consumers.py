@@ -0,0 +1,104 @@
+"""In-process consumers of change events log, see models.event.
+
+Consumer keeps its own offset in every shard next to the events, and handles batches of events
+of a single shard in order. Batch is handled within a transaction on that shard which also moves
+the offset, so database writes made by a consumer into the same shard are applied exactly once.
+Anything else should be idempotent: if several workers run the same consumer, batch handled
+concurrently is rolled back for all of them but one, yet handle() has been called for each.
+"""
+
+import asyncio
+import logging
+
+from peewee import Database
+
+from config import EVENTS_BATCH_SIZE, EVENTS_POLL_SECONDS
+from models import db
+from models.db import shards
+from models.event import Event, EventOffset, read_events
+from models.sharding import using_shard
+
+logger = logging.getLogger(__name__)
+
+
+class OffsetMoved(Exception):
+    """Batch was handled by another worker in the meantime."""
+
+
+class Consumer:
+    """Base class of change events consumer. Subclasses set unique name and implement handle()."""
+
+    name: str
+    batch_size = EVENTS_BATCH_SIZE
+
+    def handle(self, events: list[Event]) -> None:
+        """Handles a batch of events of the current shard, oldest first."""
+        raise NotImplementedError
+
+    def poll_shard(self, shard: Database) -> int:
+        """Handles the next batch of events of the shard. Returns count of handled events.
+
+        Offset and events are read before the transaction, so polls finding nothing new write nothing.
+        """
+        with using_shard(shard):
+            row = EventOffset.get_or_none(EventOffset.consumer == self.name)
+            if row is None:
+                # Offsets are seeded by the migration step, see seed_offsets(), consumers added since start here.
+                EventOffset.insert(consumer=self.name).on_conflict_ignore().execute()
+            offset = row.event_id if row else 0
+            events = read_events(after=offset, limit=self.batch_size)
+            if not events:
+                return 0
+            try:
+                with db.atomic():
+                    self.handle(events)
+                    moved = (
+                        EventOffset.update(event_id=events[-1].id)
+                        .where(EventOffset.consumer == self.name, EventOffset.event_id == offset)
+                        .execute()
+                    )
+                    if not moved:
+                        raise OffsetMoved
+            except OffsetMoved:
+                return 0
+            return len(events)
+
+    def seek(self, event_id: int) -> None:
+        """Moves offset in the current shard, so handling goes on after given event."""
+        EventOffset.insert(consumer=self.name).on_conflict_ignore().execute()
+        EventOffset.update(event_id=event_id).where(EventOffset.consumer == self.name).execute()
+
+    def poll(self) -> int:
+        """Handles all of the pending events of every shard. Returns count of handled events."""
+        handled = 0
+        for shard in shards:
+            while count := self.poll_shard(shard):
+                handled += count
+        return handled
+
+
+# Consumers run by the server in background, see run_consumers()
+consumers: list[Consumer] = []
+
+
+def seed_offsets() -> None:
+    """Creates offsets of registered consumers missing in the current shard."""
+    if consumers:
+        EventOffset.insert_many([{"consumer": x.name} for x in consumers]).on_conflict_ignore().execute()
+
+
+def register_consumer(consumer: Consumer) -> Consumer:
+    """Adds consumer to the ones run in background by the server."""
+    consumers.append(consumer)
+    return consumer
+
+
+async def run_consumers(interval: float = EVENTS_POLL_SECONDS) -> None:
+    """Polls registered consumers forever, in a thread. Failed batch is logged and retried on the next round."""
+    while True:
+        for consumer in consumers:
+            try:
+                await asyncio.to_thread(consumer.poll)
+            except Exception:
+                logger.exception("Consumer %s failed", consumer.name)
+        await asyncio.sleep(interval)
@@ -1,11 +1,54 @@
+from contextvars import ContextVar
+
+from peewee import Database, DatabaseProxy, SqliteDatabase
 from playhouse.db_url import connect
 
-from config import DB_URI
+from config import DB_SHARD_URIS, DB_URI
+
+# Shard chosen for current request/task, see models.sharding.using_shard
+current_shard: ContextVar[Database | None] = ContextVar("current_shard", default=None)
+
+
+class ShardedDatabase(DatabaseProxy):
+    """Database proxy forwarding every query to currently chosen shard.
+
+    Shard is kept in a context variable, so concurrent requests don't interfere with each other.
+    If none is chosen, proxy falls back to the one it was initialized with.
+
+    SQLite transactions take the write lock as they begin. Deferred ones read first and upgrade at the first
+    write, which fails right away with "database is locked" if another connection committed in the meantime.
+    """
+
+    @property
+    def obj(self) -> Database | None:
+        """Database queries are forwarded to."""
+        return current_shard.get() or self.default
+
+    @obj.setter
+    def obj(self, value: Database | None) -> None:
+        # Proxy.__setattr__ allows slot names only, so going around it.
+        object.__setattr__(self, "default", value)
+
+    def transaction(self, *args, **kwargs):  # noqa: ANN201
+        """Transaction of the current shard, the outermost one of atomic() blocks as well."""
+        if isinstance(self.obj, SqliteDatabase) and not args:
+            kwargs.setdefault("lock_type", "IMMEDIATE")
+        return super().transaction(*args, **kwargs)
+
+
+def get_db(uri: str = DB_URI):  # noqa: ANN201
+    """Returns a database connection.
 
+    SQLite databases are switched to WAL mode, so readers and online backups don't block writers.
+    New ones are created in incremental auto_vacuum mode, free pages are returned by models.maintenance.
+    """
+    if uri.startswith("sqlite"):
+        return connect(uri, pragmas={"auto_vacuum": "incremental", "journal_mode": "wal"})
+    return connect(uri)
 
-def get_db():  # noqa: ANN201
-    """Returns a database connection."""
-    return connect(DB_URI)
 
+# All of the databases users data is spread across, the first one is DB_URI
+shards = [get_db(x) for x in [DB_URI, *DB_SHARD_URIS]]
 
-db = get_db()
+db = ShardedDatabase()
+db.initialize(shards[0])
@@ -0,0 +1,86 @@
+import json
+from datetime import datetime, timedelta
+
+from peewee import BigAutoField, BigIntegerField, CharField, DateTimeField, Model, TextField, fn
+
+from config import EVENTS_DELAY_SECONDS
+from models import db
+from models.sharding import create_with_id
+
+USER_CREATED = "user_created"
+USER_UPDATED = "user_updated"
+POST_ADDED = "post_added"
+SUBSCRIPTION_ADDED = "subscription_added"
+SUBSCRIPTION_DELETED = "subscription_deleted"
+# Shard was restored from a backup, data derived from it should be taken anew, see models.backup
+SHARD_RESTORED = "shard_restored"
+
+
+class Event(Model):
+    """Append-only log of changes, every event is written in the same transaction as the change itself.
+
+    Events are stored in the shard of the user who made the change, ids are time ordered across shards.
+    """
+
+    # 64-bit, since ids generated for sharded setup don't fit into 32 bits, see models.sharding
+    id = BigAutoField()
+    kind = CharField(32)
+    # Not a foreign key: users are moved between shards by rebalancing, their events are not.
+    username = CharField(15)
+    # JSON object describing the change.
+    payload = TextField(default="{}")
+    created = DateTimeField(default=datetime.now)
+
+    class Meta:
+        """Peewee Meta class."""
+
+        table_name = "events"
+        database = db
+
+    def as_dict(self) -> dict:
+        """Returns a dictionary representation of the event."""
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "username": self.username,
+            "payload": json.loads(self.payload),
+            "created": self.created,
+        }
+
+
+class EventOffset(Model):
+    """Id of the last event of the shard handled by a consumer, see models.consumers."""
+
+    consumer = CharField(64, primary_key=True)
+    event_id = BigIntegerField(default=0)
+
+    class Meta:
+        """Peewee Meta class."""
+
+        table_name = "event_offsets"
+        database = db
+
+
+def record_event(kind: str, username: str, payload: dict) -> Event:
+    """Appends event to the log, should be called within the transaction making the change."""
+    return create_with_id(Event, kind=kind, username=username, payload=json.dumps(payload, default=str))
+
+
+def last_event_id() -> int:
+    """Id of the latest event of the current shard read_events() would return, 0 if there is none."""
+    query = Event.select(fn.MAX(Event.id))
+    if EVENTS_DELAY_SECONDS:
+        query = query.where(Event.created <= datetime.now() - timedelta(seconds=EVENTS_DELAY_SECONDS))
+    return query.scalar() or 0
+
+
+def read_events(after: int = 0, limit: int | None = None) -> list[Event]:
+    """Events of the current shard following given id, oldest first.
+
+    Events younger than EVENTS_DELAY_SECONDS are held back, transactions writing them may still be
+    committed after ones with greater ids.
+    """
+    query = Event.select().where(Event.id > after)
+    if EVENTS_DELAY_SECONDS:
+        query = query.where(Event.created <= datetime.now() - timedelta(seconds=EVENTS_DELAY_SECONDS))
+    return list(query.order_by(Event.id).limit(limit))
@@ -0,0 +1,432 @@
+"""Compact in-memory index of subscriptions graph.
+
+Users are numbered in order of sorted usernames and both directions of subscriptions are stored
+CSR-style: array of row offsets plus array of sorted neighbour ids. Arrays live in a snapshot file
+which is memory mapped, so all of the workers share the same pages and read them without copying.
+
+Changes made after the snapshot was taken are appended to a journal file next to it. Every worker
+replays journal tail before answering, so all of them see the same graph without touching the
+database. Counts are O(1), membership is a binary search over a single row, which is never longer
+than MAX_SUBSCRIPTIONS for subscriptions.
+
+Usernames are also completed by prefix here, with a binary search over ids ordered by case folded name.
+
+Database stays the source of truth, index files are a cache local to the host. Changes made by workers
+of other hosts reach it through the events log, see GraphConsumer, so hosts don't need shared storage.
+"""
+
+import fcntl
+import glob
+import heapq
+import mmap
+import os
+import socket
+import struct
+import threading
+import time
+from array import array
+from bisect import bisect_left, insort
+from collections import Counter, defaultdict
+from collections.abc import Iterator
+from contextlib import contextmanager
+from itertools import chain
+
+from peewee import Database
+
+from config import SOCIAL_GRAPH_JOURNAL_MAX_MB, SOCIAL_GRAPH_PATH
+from models import Subscription
+from models.consumers import Consumer, register_consumer
+from models.db import shards
+from models.event import (
+    SHARD_RESTORED,
+    SUBSCRIPTION_ADDED,
+    SUBSCRIPTION_DELETED,
+    USER_CREATED,
+    Event,
+    last_event_id,
+)
+from models.sharding import scatter, using_shard
+
+# Snapshot header: magic, generation, users count, subscriptions count, usernames blob length.
+HEADER = struct.Struct("<4sQIII")
+MAGIC = b"SGI1"
+# Max count of matching usernames ranked by subscribers count when completing a prefix.
+MAX_RANKED_COMPLETIONS = 1000
+
+
+def build_csr(pairs: list[tuple[int, int]], rows: int) -> tuple[array, array]:
+    """Builds offsets and sorted targets arrays out of (row, target) pairs."""
+    pairs = sorted(pairs)
+    offsets = array("I", [0] * (rows + 1))
+    for row, _ in pairs:
+        offsets[row + 1] += 1
+    for row in range(rows):
+        offsets[row + 1] += offsets[row]
+    return offsets, array("I", [target for _, target in pairs])
+
+
+class SocialGraph:
+    """Subscriptions graph index backed by snapshot and journal files at given path.
+
+    Snapshot is taken from the database by the migration step, see models.migrations, and mapped by
+    every process on the first use. Journals persist across restarts, so changes made since are kept,
+    and snapshot is retaken once journal grows over SOCIAL_GRAPH_JOURNAL_MAX_MB.
+    Changes are recorded after the database writes they follow are committed, changes made on other hosts
+    are caught up with by the consumer of events log given the graph, see GraphConsumer.
+
+    File lock shared by processes is only taken to write journal and snapshot, which blocks, so writes
+    should be made off the event loop. Reads take a thread lock guarding in-memory state only.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.generation = None
+        self.consumer: GraphConsumer | None = None
+        self._state_lock = threading.RLock()
+        self._file_thread_lock = threading.RLock()
+        self._lock_depth = 0
+        self._lock_file = None
+
+    @property
+    def journal_path(self) -> str:
+        """Journal of changes made after current snapshot."""
+        return f"{self.path}.{self.generation}.log"
+
+    @contextmanager
+    def locked(self) -> Iterator[None]:
+        """Exclusive lock over journal and snapshot files shared by all processes, reentrant."""
+        with self._file_thread_lock:
+            if not self._lock_depth:
+                if not self._lock_file:
+                    self._lock_file = open(f"{self.path}.lock", "a")  # noqa: SIM115
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+                if not self._lock_depth:
+                    fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def rebuild(self) -> None:
+        """Takes a fresh snapshot of all the shards and drops journals of previous ones."""
+        # Imported here since User model depends on the graph itself.
+        from models import User
+
+        with self.locked():
+            # Snapshot reflects at least these events, the consumer goes on with the ones following them.
+            offsets = scatter(last_event_id)
+            names = sorted(chain(*scatter(lambda: [x for (x,) in User.select(User.name).tuples()])))
+            edges_query = Subscription.select(Subscription.source, Subscription.target).tuples()
+            edges = chain(*scatter(lambda: list(edges_query.clone())))
+            ids = {x: i for i, x in enumerate(names)}
+            pairs = [(ids[s], ids[t]) for s, t in edges if s in ids and t in ids]
+
+            blob = "\n".join(names).encode()
+            generation = time.time_ns()
+            with open(f"{self.path}.tmp", "wb") as f:
+                f.write(HEADER.pack(MAGIC, generation, len(names), len(pairs), len(blob)))
+                f.write(blob + b"\0" * (-len(blob) % 4))
+                for arrays in (build_csr(pairs, len(names)), build_csr([(t, s) for s, t in pairs], len(names))):
+                    for x in arrays:
+                        x.tofile(f)
+            os.replace(f"{self.path}.tmp", self.path)
+            if self.consumer:
+                for shard, offset in zip(shards, offsets):
+                    with using_shard(shard):
+                        self.consumer.seek(offset)
+
+            # Other workers notice missing journal and switch to the new snapshot.
+            for journal in glob.glob(f"{glob.escape(self.path)}.*.log"):
+                os.remove(journal)
+            self._load()
+
+    def compact(self, max_size: int = int(SOCIAL_GRAPH_JOURNAL_MAX_MB * 1024 * 1024)) -> bool:
+        """Takes a fresh snapshot if the journal grew over max_size bytes. Returns whether it was taken."""
+        with self._current():
+            if self.journal_offset <= max_size:
+                return False
+        with self.locked():
+            self.refresh()
+            # Snapshot may have been retaken by another worker while waiting for the lock.
+            if self.journal_offset <= max_size:
+                return False
+            self.rebuild()
+            return True
+
+    @contextmanager
+    def _current(self) -> Iterator[None]:
+        """Holds in-memory state still, brought up to date with the journal first."""
+        with self._state_lock:
+            self.refresh()
+            yield
+
+    def _load(self) -> None:
+        """Maps current snapshot and resets changes made after previous one."""
+        with self._state_lock:
+            with open(self.path, "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            _, self.generation, users, edges, blob_length = HEADER.unpack_from(data)
+            view = memoryview(data)
+            position = HEADER.size
+            blob = bytes(view[position : position + blob_length]).decode()
+            self.names = blob.split("\n") if blob else []
+            self.ids = {x: i for i, x in enumerate(self.names)}
+            self.completion_order = array("I", sorted(range(len(self.names)), key=self._completion_key))
+            self.snapshot_users = users
+
+            position += blob_length + -blob_length % 4
+            arrays = []
+            for size in (users + 1, edges, users + 1, edges):
+                arrays.append(view[position : position + size * 4].cast("I"))
+                position += size * 4
+            self.followees_offsets, self.followees_ids, self.followers_offsets, self.followers_ids = arrays
+
+            self.added = defaultdict(set)
+            self.removed = defaultdict(set)
+            self.followees_delta = Counter()
+            self.followers_delta = Counter()
+            self.journal_offset = 0
+            open(self.journal_path, "a").close()
+
+    def load(self) -> None:
+        """Maps the latest snapshot, taking one if there is none yet."""
+        with self.locked():
+            if os.path.exists(self.path):
+                self._load()
+            else:
+                self.rebuild()
+
+    def refresh(self) -> None:
+        """Replays changes other workers appended to the journal since the last call."""
+        if self.generation is None:
+            self.load()
+        with self._state_lock:
+            try:
+                size = os.stat(self.journal_path).st_size
+            except FileNotFoundError:
+                # Snapshot was rebuilt by another worker. It's replaced before old journals are removed,
+                # so the new one is in place already.
+                self._load()
+                size = 0
+            if size <= self.journal_offset:
+                return
+            with open(self.journal_path, "rb") as f:
+                f.seek(self.journal_offset)
+                tail = f.read(size - self.journal_offset)
+            # Line being written right now is picked up by the next call.
+            tail = tail[: tail.rfind(b"\n") + 1]
+            self.journal_offset += len(tail)
+            for line in tail.decode().splitlines():
+                self._apply(*line.split(" "))
+
+    def _append(self, *args: str) -> None:
+        """Writes change to the journal and applies it."""
+        with self.locked():
+            self.refresh()
+            self._write(args)
+            self.refresh()
+
+    def sync(self, records: list[tuple[str, ...]]) -> None:
+        """Writes to the journal those of the changes which aren't applied yet, in order."""
+        with self.locked():
+            for record in records:
+                with self._current():
+                    if not self._changes(*record):
+                        continue
+                self._write(record)
+
+    def _write(self, record: tuple[str, ...]) -> None:
+        """Appends record to the journal, should be called with the file lock held."""
+        fd = os.open(self.journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        try:
+            os.write(fd, (" ".join(record) + "\n").encode())
+        finally:
+            os.close(fd)
+
+    def _changes(self, operation: str, *names: str) -> bool:
+        """Checks whether journal record would change the graph."""
+        if operation == "u":
+            return names[0] not in self.ids
+        following = all(x in self.ids for x in names) and self._is_following(*(self.ids[x] for x in names))
+        return following if operation == "-" else not following
+
+    def _apply(self, operation: str, *names: str) -> None:
+        """Applies journal record. Records are idempotent, so replaying already applied change is harmless."""
+        ids = [self._id(x) for x in names]
+        if operation == "u":
+            return
+        source, target = ids
+        if operation == "+" and not self._is_following(source, target):
+            if target in self.removed[source]:
+                self.removed[source].discard(target)
+            else:
+                self.added[source].add(target)
+            self.followees_delta[source] += 1
+            self.followers_delta[target] += 1
+        elif operation == "-" and self._is_following(source, target):
+            if target in self.added[source]:
+                self.added[source].discard(target)
+            else:
+                self.removed[source].add(target)
+            self.followees_delta[source] -= 1
+            self.followers_delta[target] -= 1
+
+    def _id(self, name: str) -> int:
+        """Id of the user, users who joined after the snapshot get next free ones."""
+        if name not in self.ids:
+            self.ids[name] = len(self.names)
+            self.names.append(name)
+            insort(self.completion_order, self.ids[name], key=self._completion_key)
+        return self.ids[name]
+
+    def _completion_key(self, user_id: int) -> str:
+        """Order of users for prefix completion."""
+        return self.names[user_id].casefold()
+
+    def _row(self, offsets: memoryview, ids: memoryview, user_id: int) -> memoryview:
+        """Snapshot row of the user, zero-copy."""
+        if user_id >= self.snapshot_users:
+            return ids[0:0]
+        return ids[offsets[user_id] : offsets[user_id + 1]]
+
+    def _is_following(self, source: int, target: int) -> bool:
+        """Membership check by user ids."""
+        if target in self.added.get(source, ()):
+            return True
+        if target in self.removed.get(source, ()):
+            return False
+        row = self._row(self.followees_offsets, self.followees_ids, source)
+        index = bisect_left(row, target)
+        return index < len(row) and row[index] == target
+
+    def add_user(self, name: str) -> None:
+        """Registers new user."""
+        self._append("u", name)
+
+    def subscribe(self, source: str, target: str) -> None:
+        """Registers new subscription."""
+        self._append("+", source, target)
+
+    def unsubscribe(self, source: str, target: str) -> None:
+        """Registers removed subscription."""
+        self._append("-", source, target)
+
+    def has_user(self, name: str) -> bool:
+        """Checks whether user is known to the graph. Users who joined moments ago in other workers may be missing."""
+        with self._current():
+            return name in self.ids
+
+    def complete(self, prefix: str, limit: int, ranked: bool = False) -> list[str]:
+        """Usernames starting with given prefix, case insensitive, in alphabetical order.
+
+        If ranked, up to MAX_RANKED_COMPLETIONS first matches are ordered by subscribers count instead.
+        """
+        with self._current():
+            prefix = prefix.casefold()
+            start = bisect_left(self.completion_order, prefix, key=self._completion_key)
+            matches = []
+            for user_id in self.completion_order[start : start + (MAX_RANKED_COMPLETIONS if ranked else limit)]:
+                if not self.names[user_id].casefold().startswith(prefix):
+                    break
+                matches.append(user_id)
+            if ranked:
+                matches = heapq.nlargest(limit, matches, key=self._followers_count)
+            return [self.names[x] for x in matches]
+
+    def is_following(self, source: str, target: str) -> bool:
+        """Checks whether source user is subscribed to target one."""
+        with self._current():
+            if source not in self.ids or target not in self.ids:
+                return False
+            return self._is_following(self.ids[source], self.ids[target])
+
+    def followees(self, name: str) -> list[str]:
+        """Usernames the user is subscribed to."""
+        with self._current():
+            if name not in self.ids:
+                return []
+            user_id = self.ids[name]
+            row = self._row(self.followees_offsets, self.followees_ids, user_id)
+            removed = self.removed.get(user_id, ())
+            ids = chain((x for x in row if x not in removed), self.added.get(user_id, ()))
+            return [self.names[x] for x in ids]
+
+    def followees_snapshot(self) -> tuple[list[str], memoryview, memoryview, dict[int, set[int]], dict[int, set[int]]]:
+        """Usernames, followees arrays of the snapshot, zero-copy, and subscriptions added and removed since by ids."""
+        with self._current():
+            added = {k: set(v) for k, v in self.added.items() if v}
+            removed = {k: set(v) for k, v in self.removed.items() if v}
+            return list(self.names), self.followees_offsets, self.followees_ids, added, removed
+
+    def followees_count(self, name: str) -> int:
+        """Count of subscriptions of the user."""
+        with self._current():
+            if name not in self.ids:
+                return 0
+            user_id = self.ids[name]
+            return len(self._row(self.followees_offsets, self.followees_ids, user_id)) + self.followees_delta[user_id]
+
+    def followers_count(self, name: str) -> int:
+        """Count of subscribers of the user."""
+        with self._current():
+            if name not in self.ids:
+                return 0
+            return self._followers_count(self.ids[name])
+
+    def _followers_count(self, user_id: int) -> int:
+        """Count of subscribers by user id."""
+        return len(self._row(self.followers_offsets, self.followers_ids, user_id)) + self.followers_delta[user_id]
+
+
+class GraphConsumer(Consumer):
+    """Brings graph index up to date with changes recorded to events log by workers of any host.
+
+    Changes made by the workers sharing index files are in the journal already, so they are skipped.
+    Offsets are moved by SocialGraph.rebuild() to the events its snapshot reflects. Shard restored from
+    a backup may have lost changes the index has seen, so the index is rebuilt then.
+    """
+
+    def __init__(self, graph: SocialGraph, name: str) -> None:
+        self.graph = graph
+        self.name = name
+        self.restored = False
+        graph.consumer = self
+
+    def poll_shard(self, shard: Database) -> int:
+        """Handles the next batch with the graph locked, so snapshot can't be rebuilt in the meantime."""
+        with self.graph.locked():
+            handled = super().poll_shard(shard)
+            # Rebuilt once the batch is committed, since it moves offsets of every shard.
+            if self.restored:
+                self.restored = False
+                self.graph.rebuild()
+            return handled
+
+    def poll(self) -> int:
+        """Handles pending events, then retakes the snapshot if the journal grew too long, see SocialGraph.compact()."""
+        handled = super().poll()
+        self.graph.compact()
+        return handled
+
+    def handle(self, events: list[Event]) -> None:
+        """Writes changes missing from the graph to its journal.
+
+        Only the last change of a subscription within the batch counts, so readers don't see it flip back and forth.
+        """
+        records: dict[tuple[str, ...], str] = {}
+        for event in events:
+            if event.kind == SHARD_RESTORED:
+                self.restored = True
+            elif event.kind == USER_CREATED:
+                records[(event.username,)] = "u"
+            elif event.kind in (SUBSCRIPTION_ADDED, SUBSCRIPTION_DELETED):
+                records[(event.username, event.as_dict()["payload"]["target"])] = (
+                    "+" if event.kind == SUBSCRIPTION_ADDED else "-"
+                )
+        self.graph.sync([(operation, *names) for names, operation in records.items()])
+
+
+graph = SocialGraph(SOCIAL_GRAPH_PATH)
+# Index files are local to the host, so is the position of the consumer feeding them.
+graph_consumer = register_consumer(GraphConsumer(graph, f"graph:{socket.gethostname()}"[:64]))
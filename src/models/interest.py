@@ -0,0 +1,57 @@
+from peewee import CharField, DeferredForeignKey, Model
+
+from models import db
+from models.sharding import scatter
+
+
+def interest_terms(interests: str) -> set[str]:
+    """Normalized terms out of comma separated interests string stored in User model."""
+    return {x.strip().lower() for x in interests.split(",")} - {""}
+
+
+class Interest(Model):
+    """Inverted index of user interests: (term, user) pairs stored in the shard of the user.
+
+    Kept in sync with User.interests by User.update_profile().
+    """
+
+    # id field will be created by ORM
+    user = DeferredForeignKey("User", backref="interest_terms")
+    term = CharField()
+
+    class Meta:
+        """Peewee Meta class."""
+
+        table_name = "user_interests"
+        database = db
+        # Posting list of a term is a range of this index, ordered by username.
+        indexes = ((("term", "user"), True),)
+
+
+def index_interests(username: str, interests: str) -> None:
+    """Brings index of the user in line with interests string, touching changed terms only."""
+    terms = interest_terms(interests)
+    query = Interest.select(Interest.term).where(Interest.user == username).tuples()
+    indexed = {x for (x,) in query}
+    if indexed - terms:
+        Interest.delete().where(Interest.user == username, Interest.term.in_(list(indexed - terms))).execute()
+    if terms - indexed:
+        Interest.insert_many([{"user": username, "term": x} for x in terms - indexed]).execute()
+
+
+def reindex_interests() -> int:
+    """Indexes interests of every user in every shard, for ones saved before the index existed.
+
+    Returns count of users processed.
+    """
+    # Imported here since User model depends on the index itself.
+    from models import User
+
+    def reindex_shard() -> int:
+        users = list(User.select(User.name, User._interests).tuples())
+        with db.atomic():
+            for name, interests in users:
+                index_interests(name, interests)
+        return len(users)
+
+    return sum(scatter(reindex_shard))
@@ -0,0 +1,288 @@
+"""Periodic database upkeep and reconciliation of derived data, run by the server in background.
+
+Every worker runs the scheduler, but each job run is claimed by a single one of them: job has a row
+in the first shard, and a worker claims it with a conditional update moving the time of the next run
+forward. Intervals are jittered, so workers started together don't hit databases at the same moments.
+Outcome of every run is kept in the row as well and exposed at /metrics.
+"""
+
+import asyncio
+import json
+import logging
+import random
+import time
+from collections import Counter
+from collections.abc import Callable
+from datetime import datetime, timedelta
+from itertools import chain
+
+from peewee import CharField, DateTimeField, FloatField, IntegerField, Model, MySQLDatabase, SqliteDatabase, TextField
+
+from models import Subscription, db, graph
+from models.db import shards
+from models.event import SUBSCRIPTION_DELETED, record_event
+from models.sharding import scatter, using_shard
+from models.trending import audit_trending_counters, expire_trending_counters
+
+logger = logging.getLogger(__name__)
+
+# Share of the interval the next run is randomly moved by, either way.
+JITTER = 0.1
+# How often every worker looks for due jobs, jittered as well.
+SCHEDULE_CHECK_SECONDS = 60
+# Rows ANALYZE samples per index of SQLite database, full scan of large tables would take too long.
+ANALYSIS_LIMIT = 1000
+# Free pages of SQLite database returned to file system per run.
+VACUUM_PAGES = 2000
+# SQLite auto_vacuum value of incremental mode.
+INCREMENTAL_VACUUM = 2
+
+
+class MaintenanceJob(Model):
+    """Schedule and outcome of the last run of a maintenance job, stored in the first shard."""
+
+    name = CharField(64, primary_key=True)
+    next_run = DateTimeField(default=datetime.now)
+    started = DateTimeField(null=True)
+    duration = FloatField(null=True)
+    runs = IntegerField(default=0)
+    failures = IntegerField(default=0)
+    # JSON object of numbers returned by the job.
+    result = TextField(default="{}")
+    error = TextField(default="")
+
+    class Meta:
+        """Peewee Meta class."""
+
+        table_name = "maintenance_jobs"
+        database = db
+
+
+class Job:
+    """Function run every `interval`, returning a dict of numbers describing its outcome."""
+
+    def __init__(self, name: str, func: Callable[[], dict[str, float]], interval: timedelta) -> None:
+        self.name = name
+        self.func = func
+        self.interval = interval
+
+    def claim(self) -> bool:
+        """Schedules the next run if this one is due. Returns whether it was this call that did it."""
+        with using_shard(shards[0]):
+            MaintenanceJob.insert(name=self.name).on_conflict_ignore().execute()
+            now = datetime.now()
+            next_run = now + self.interval * (1 + random.uniform(-JITTER, JITTER))
+            claimed = (
+                MaintenanceJob.update(next_run=next_run, started=now)
+                .where(MaintenanceJob.name == self.name, MaintenanceJob.next_run <= now)
+                .execute()
+            )
+        return bool(claimed)
+
+    def run(self) -> dict[str, float] | None:
+        """Runs the job if it's due and not claimed by another worker, records its outcome. Returns the result."""
+        if not self.claim():
+            return None
+        started = time.perf_counter()
+        try:
+            result = self.func()
+        except Exception as e:
+            logger.exception("Maintenance job %s failed", self.name)
+            update = {"failures": MaintenanceJob.failures + 1, "error": repr(e)}
+            result = None
+        else:
+            update = {"result": json.dumps(result), "error": ""}
+        update.update(runs=MaintenanceJob.runs + 1, duration=time.perf_counter() - started)
+        with using_shard(shards[0]):
+            MaintenanceJob.update(**update).where(MaintenanceJob.name == self.name).execute()
+        return result
+
+
+# Jobs run by the server in background, see run_maintenance()
+jobs: dict[str, Job] = {}
+
+
+def register_job(name: str, interval: timedelta) -> Callable:
+    """Decorator adding function to the jobs run in background by the server."""
+
+    def decorator(func: Callable[[], dict[str, float]]) -> Callable[[], dict[str, float]]:
+        jobs[name] = Job(name, func, interval)
+        return func
+
+    return decorator
+
+
+@register_job("analyze", timedelta(hours=24))
+def analyze_databases() -> dict[str, float]:
+    """Refreshes query planner statistics of every shard."""
+
+    def analyze_shard() -> None:
+        if isinstance(db.obj, SqliteDatabase):
+            db.execute_sql(f"PRAGMA analysis_limit = {ANALYSIS_LIMIT}")
+            db.execute_sql("ANALYZE")
+        elif isinstance(db.obj, MySQLDatabase):
+            db.execute_sql(f"ANALYZE TABLE {', '.join(db.get_tables())}")
+        else:
+            db.execute_sql("ANALYZE")
+
+    return {"shards": len(scatter(analyze_shard))}
+
+
+@register_job("vacuum", timedelta(hours=1))
+def vacuum_databases(pages: int = VACUUM_PAGES) -> dict[str, float]:
+    """Returns free pages of SQLite shards to file system a batch at a time. Postgres runs autovacuum itself.
+
+    Works with databases created in incremental auto_vacuum mode only, see models.db.get_db.
+    Older ones are switched to it by running `PRAGMA auto_vacuum = incremental; VACUUM;` once.
+    """
+
+    def vacuum_shard() -> int:
+        if not isinstance(db.obj, SqliteDatabase):
+            return 0
+        if db.execute_sql("PRAGMA auto_vacuum").fetchone()[0] != INCREMENTAL_VACUUM:
+            return 0
+        before = db.execute_sql("PRAGMA freelist_count").fetchone()[0]
+        # Executing the pragma as a regular statement frees a single page only.
+        db.connection().executescript(f"PRAGMA incremental_vacuum({pages})")
+        return before - db.execute_sql("PRAGMA freelist_count").fetchone()[0]
+
+    return {"freed_pages": sum(scatter(vacuum_shard))}
+
+
+@register_job("orphaned_subscriptions", timedelta(hours=24))
+def clean_orphaned_subscriptions() -> dict[str, float]:
+    """Deletes subscriptions of or to users that don't exist anymore.
+
+    Targets are not foreign keys enforced by database, since they may live in other shards.
+    Removals are recorded to the events log on behalf of subscribers, so graph index of every host drops them.
+    """
+    # Imported here since User model depends on subscriptions.
+    from models import User
+
+    def targets_of_shard() -> set[str]:
+        return {x for (x,) in Subscription.select(Subscription.target).distinct().tuples()}
+
+    # Targets are read before users, so users joined in the meantime can't be taken for missing.
+    targets = set(chain(*scatter(targets_of_shard)))
+    names = set(chain(*scatter(lambda: [x for (x,) in User.select(User.name).tuples()])))
+    missing = list(targets - names)
+
+    def orphans_of_shard() -> list[tuple[str, str]]:
+        query = Subscription.select(Subscription.source, Subscription.target).where(
+            Subscription.source.not_in(User.select(User.name)) | Subscription.target.in_(missing)
+        )
+        return list(query.tuples())
+
+    orphans = scatter(orphans_of_shard)
+    # Missing users may have joined while the tables were read.
+    joined = set(chain(*scatter(lambda: [x for (x,) in User.select(User.name).where(User.name.in_(missing)).tuples()])))
+    still_missing = [x for x in missing if x not in joined]
+
+    deleted = 0
+    for shard, pairs in zip(shards, orphans):
+        records = []
+        with using_shard(shard), db.atomic():
+            for source, target in pairs:
+                # Deleted only if still orphaned, rows read above may be stale by now.
+                if Subscription.delete().where(
+                    Subscription.source == source,
+                    Subscription.target == target,
+                    Subscription.source.not_in(User.select(User.name)) | Subscription.target.in_(still_missing),
+                ).execute():
+                    record_event(SUBSCRIPTION_DELETED, source, {"target": target})
+                    records.append(("-", source, target))
+        graph.sync(records)
+        deleted += len(records)
+    return {"deleted": deleted}
+
+
+def count_subscriptions(names: list[str] | None = None) -> tuple[Counter, Counter]:
+    """Subscriptions and subscribers counts by username across the shards, of given users only if passed."""
+    query = Subscription.select(Subscription.source, Subscription.target)
+    if names is not None:
+        query = query.where(Subscription.source.in_(names) | Subscription.target.in_(names))
+    followees, followers = Counter(), Counter()
+    for source, target in chain(*scatter(lambda: list(query.tuples()))):
+        followees[source] += 1
+        followers[target] += 1
+    return followees, followers
+
+
+@register_job("audit_counters", timedelta(hours=6))
+def audit_counters() -> dict[str, float]:
+    """Checks counts served from graph index and trending counters against the tables they are derived from.
+
+    Graph index is rebuilt if any of its counts is off, trending counters are reported only.
+    """
+    followees, followers = count_subscriptions()
+    graph.refresh()
+    names = set(graph.names) | followees.keys() | followers.keys()
+    suspects = [
+        x for x in names if graph.followees_count(x) != followees[x] or graph.followers_count(x) != followers[x]
+    ]
+    subscriptions_mismatches = subscribers_mismatches = 0
+    if suspects:
+        # Tables were read without the graph locked, so counts of the suspects are taken once again.
+        with graph.locked():
+            followees, followers = count_subscriptions(suspects)
+            graph.refresh()
+            subscriptions_mismatches = sum(graph.followees_count(x) != followees[x] for x in suspects)
+            subscribers_mismatches = sum(graph.followers_count(x) != followers[x] for x in suspects)
+            if subscriptions_mismatches or subscribers_mismatches:
+                logger.warning(
+                    "Graph index is off for %s subscriptions and %s subscribers counts, rebuilding",
+                    subscriptions_mismatches,
+                    subscribers_mismatches,
+                )
+                graph.rebuild()
+    return {
+        "users": len(names),
+        "subscriptions_mismatches": subscriptions_mismatches,
+        "subscribers_mismatches": subscribers_mismatches,
+        "trending_mismatches": audit_trending_counters(),
+    }
+
+
+@register_job("expire_trending", timedelta(hours=1))
+def expire_trending() -> dict[str, float]:
+    """Drops trending counters out of the longest window."""
+    return {"deleted": expire_trending_counters()}
+
+
+async def run_maintenance(check_seconds: float = SCHEDULE_CHECK_SECONDS) -> None:
+    """Runs due jobs forever, in a thread, so requests are served in the meantime."""
+    while True:
+        for job in jobs.values():
+            try:
+                await asyncio.to_thread(job.run)
+            except Exception:
+                logger.exception("Maintenance job %s couldn't be scheduled", job.name)
+        await asyncio.sleep(check_seconds * random.uniform(1 - JITTER, 1 + JITTER))
+
+
+def job_metrics() -> str:
+    """Outcome of the last run of every job in Prometheus text format."""
+    with using_shard(shards[0]):
+        rows = list(MaintenanceJob.select().order_by(MaintenanceJob.name))
+    series = {
+        "maintenance_job_runs_total": ("counter", "Runs of the job.", lambda x: x.runs),
+        "maintenance_job_failures_total": ("counter", "Failed runs of the job.", lambda x: x.failures),
+        "maintenance_job_duration_seconds": ("gauge", "Duration of the last run.", lambda x: x.duration or 0),
+        "maintenance_job_started_timestamp_seconds": (
+            "gauge",
+            "Start time of the last run.",
+            lambda x: x.started.timestamp() if x.started else 0,
+        ),
+    }
+    lines = []
+    for metric, (kind, description, value) in series.items():
+        lines += [f"# HELP {metric} {description}", f"# TYPE {metric} {kind}"]
+        lines += [f'{metric}{{job="{x.name}"}} {value(x)}' for x in rows]
+    lines += [
+        "# HELP maintenance_job_result Numbers reported by the last successful run.",
+        "# TYPE maintenance_job_result gauge",
+    ]
+    for row in rows:
+        for key, value in json.loads(row.result).items():
+            lines.append(f'maintenance_job_result{{job="{row.name}",value="{key}"}} {value}')
+    return "\n".join(lines) + "\n"
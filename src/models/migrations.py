@@ -0,0 +1,79 @@
+"""Schema migration step, run once per deploy before workers start: `python -m models.migrations`.
+
+Missing tables and indexes are created, columns whose types changed since tables were created
+by older versions are altered, offsets of change events consumers are seeded, and a fresh graph index
+snapshot is taken for the workers to map.
+Importing models or the server never touches the database by itself.
+"""
+
+import logging
+from itertools import chain
+
+from peewee import MySQLDatabase, PostgresqlDatabase
+
+from models import db, graph
+from models.consumers import seed_offsets
+from models.sharding import scatter
+from models.utils import MODELS, create_tables
+
+logger = logging.getLogger(__name__)
+
+# Column type changes made after the first release: (table, column, old type, Postgres alter, MySQL alter).
+COLUMN_CHANGES = [
+    # 64-bit post ids, generated for sharded setup, see models.sharding.next_id
+    (
+        "posts",
+        "id",
+        "int",
+        "ALTER TABLE posts ALTER COLUMN id TYPE bigint",
+        "ALTER TABLE posts MODIFY id BIGINT NOT NULL AUTO_INCREMENT",
+    ),
+    # Compressed post texts, see models.compression
+    (
+        "posts",
+        "text",
+        "text",
+        "ALTER TABLE posts ALTER COLUMN text TYPE bytea USING convert_to(text, 'UTF8')",
+        "ALTER TABLE posts MODIFY text BLOB NOT NULL",
+    ),
+]
+
+
+def upgrade_columns() -> list[str]:
+    """Alters outdated columns of the current shard. Returns statements executed.
+
+    SQLite columns accept values of any type, so it's never altered.
+    """
+    if not isinstance(db.obj, PostgresqlDatabase | MySQLDatabase):
+        return []
+    executed = []
+    for table, column, old_type, postgres, mysql in COLUMN_CHANGES:
+        types = {x.name: x.data_type.lower() for x in db.get_columns(table)}
+        # Postgres reports "integer", MySQL "int".
+        if types[column].startswith(old_type):
+            statement = postgres if isinstance(db.obj, PostgresqlDatabase) else mysql
+            db.execute_sql(statement)
+            logger.info(statement)
+            executed.append(statement)
+    return executed
+
+
+def missing_tables() -> list[str]:
+    """Tables of the models missing in any of the shards, i.e. whether migration is due."""
+    expected = {x._meta.table_name for x in MODELS}
+    return sorted(set(chain(*scatter(lambda: expected - set(db.get_tables())))))
+
+
+def migrate() -> list[str]:
+    """Brings schema of every shard up to date and takes graph index snapshot. Returns statements executed."""
+    create_tables()
+    executed = list(chain(*scatter(upgrade_columns)))
+    scatter(seed_offsets)
+    graph.rebuild()
+    logger.info("Schema is up to date.")
+    return executed
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    migrate()
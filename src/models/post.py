@@ -1,17 +1,21 @@
+from collections.abc import Iterator
 from datetime import datetime
 
-from peewee import CharField, DateTimeField, DeferredForeignKey, Model, TextField
+from peewee import BigAutoField, CharField, DateTimeField, DeferredForeignKey, Model
 
 from models import db
+from models.compression import CompressedTextField, decompress_preview
+from models.rows import PostRow
 
 
 class Post(Model):
     """Post model."""
 
-    # id field will be created by ORM
+    # 64-bit, since ids generated for sharded setup don't fit into 32 bits, see models.sharding
+    id = BigAutoField()
     author = DeferredForeignKey("User", backref="posts")
     title = CharField(100)
-    text = TextField()
+    text = CompressedTextField()
     created = DateTimeField(default=datetime.now)
 
     class Meta:
@@ -19,6 +23,12 @@ class Post(Model):
 
         table_name = "posts"
         database = db
+        indexes = (
+            # Per author index to scan posts newest first, see models.utils.merge_author_feeds
+            (("author", "id"), False),
+            # Date range filters and new posts count since last activity
+            (("created",), False),
+        )
 
     def as_dict(self) -> dict:
         """Returns a dictionary representation of the post."""
@@ -26,6 +36,27 @@ class Post(Model):
             "id": self.id,
             "title": self.title,
             "text": self.text,
-            "author": self.author.name,
+            "author": self.author_id,
             "created": self.created,
         }
+
+
+def post_columns(text_length: int | None = None) -> list:
+    """Columns to select posts with, in order of PostRow fields.
+
+    If text_length is given texts are left as stored, see truncate_text().
+    """
+    text = Post.text.coerce(False) if text_length else Post.text
+    return [Post.id, Post.author, Post.title, text, Post.created]
+
+
+def post_rows(query) -> Iterator[PostRow]:
+    """Rows of posts query selecting post_columns(), without building Post instances."""
+    return (PostRow(*x) for x in query.tuples())
+
+
+def truncate_text(post: Post | PostRow, text_length: int | None = None) -> Post | PostRow:
+    """Cuts text of the post selected with post_columns() down to text_length, decompressing as little as possible."""
+    if text_length:
+        post.text = decompress_preview(post.text, text_length)
+    return post
@@ -0,0 +1,27 @@
+import json
+from datetime import datetime
+
+from peewee import BigIntegerField, DateTimeField, DeferredForeignKey, Model, TextField
+
+from models import db
+
+
+class Recommendation(Model):
+    """Precomputed list of users to subscribe to, refreshed by models.recommender batch job."""
+
+    user = DeferredForeignKey("User", primary_key=True)
+    # JSON list of [username, score] pairs, best matches first.
+    items = TextField(default="[]")
+    # Hash of user subscriptions and interests recommendations were computed with.
+    signature = BigIntegerField(default=0)
+    updated = DateTimeField(default=datetime.now)
+
+    class Meta:
+        """Peewee Meta class."""
+
+        table_name = "recommendations"
+        database = db
+
+    def as_list(self) -> list[tuple[str, float]]:
+        """Returns list of (username, score) pairs."""
+        return [(name, score) for name, score in json.loads(self.items)]
@@ -0,0 +1,155 @@
+"""Batch job computing "who to follow" recommendations for all users at once.
+
+Subscriptions are taken straight from the graph index snapshot as sparse users x users matrix S,
+with changes made after the snapshot was taken applied on top,
+interests are turned into sparse users x interests matrix I. Then for a batch of users:
+- friends of friends score is S[batch] @ S: how many of user subscriptions are subscribed to candidate,
+- shared interests score is I[batch] @ I.T: how many interests user and candidate have in common.
+Users already subscribed to and user himself/herself are excluded, top RECOMMENDATIONS_COUNT are stored.
+
+Only users whose subscriptions or interests changed, their subscribers and users with outdated
+recommendations are recomputed, unless full refresh is asked for.
+Requires numpy and scipy, which the API itself doesn't need.
+"""
+
+import json
+import zlib
+from datetime import datetime, timedelta
+from itertools import chain
+
+import numpy as np
+from peewee import chunked
+from scipy import sparse
+
+from config import RECOMMENDATIONS_COUNT, RECOMMENDATIONS_MAX_AGE_HOURS
+from models import Recommendation, User, db, graph
+from models.sharding import group_by_shard, scatter, using_shard
+
+FRIENDS_OF_FRIENDS_WEIGHT = 1.0
+SHARED_INTERESTS_WEIGHT = 0.5
+# Interests shared by too many users tell nothing about them and blow up the product size.
+MAX_INTEREST_USERS = 1000
+BATCH_SIZE = 1024
+
+
+def follows_matrix() -> tuple[list[str], sparse.csr_matrix]:
+    """Usernames and subscriptions matrix of the current graph index.
+
+    Snapshot arrays are used without copying, matrix is copied only to apply changes journaled since.
+    """
+    names, offsets, ids, added, removed = graph.followees_snapshot()
+    size = len(names)
+    indptr = np.frombuffer(offsets, dtype=np.uint32)
+    # Rows of users who joined after the snapshot are empty.
+    indptr = np.concatenate([indptr, np.full(size + 1 - len(indptr), indptr[-1], dtype=np.uint32)])
+    indices = np.frombuffer(ids, dtype=np.uint32)
+    data = np.ones(len(indices), dtype=np.float32)
+    matrix = sparse.csr_matrix((data, indices, indptr), shape=(size, size))
+    changes = [(row, x, 1.0) for row, targets in added.items() for x in targets]
+    changes += [(row, x, -1.0) for row, targets in removed.items() for x in targets]
+    if changes:
+        rows, columns, values = zip(*changes)
+        matrix = matrix + sparse.csr_matrix((values, (rows, columns)), shape=(size, size), dtype=np.float32)
+        matrix.eliminate_zeros()
+    return names, matrix
+
+
+def interests_matrix(names: list[str]) -> tuple[sparse.csr_matrix, np.ndarray]:
+    """Users x interests matrix with too common interests dropped, plus per user interests hashes."""
+    ids = {x: i for i, x in enumerate(names)}
+    rows, columns, terms = [], [], {}
+    hashes = np.zeros(len(names), dtype=np.uint64)
+    for name, interests in chain(*scatter(lambda: list(User.select(User.name, User._interests).tuples()))):
+        if name not in ids:
+            continue
+        hashes[ids[name]] = zlib.crc32(interests.encode())
+        for term in {x.strip().lower() for x in interests.split(",")} - {""}:
+            rows.append(ids[name])
+            columns.append(terms.setdefault(term, len(terms)))
+
+    data = np.ones(len(rows), dtype=np.float32)
+    matrix = sparse.csr_matrix((data, (rows, columns)), shape=(len(names), len(terms)))
+    users_per_term = np.asarray(matrix.sum(axis=0)).ravel()
+    return matrix[:, users_per_term <= MAX_INTEREST_USERS].tocsr(), hashes
+
+
+def signatures(names: list[str], follows: sparse.csr_matrix, interests_hashes: np.ndarray) -> np.ndarray:
+    """Per user hash of subscriptions and interests, order independent and stable across snapshots."""
+    names_hashes = np.array([zlib.crc32(x.encode()) for x in names], dtype=np.uint64)
+    names_hashes *= np.uint64(0x9E3779B97F4A7C15)
+    followees_hashes = np.zeros(len(names), dtype=np.uint64)
+    non_empty = np.diff(follows.indptr) > 0
+    followees_hashes[non_empty] = np.add.reduceat(names_hashes[follows.indices], follows.indptr[:-1][non_empty])
+    return (followees_hashes ^ interests_hashes) & np.uint64(0x7FFFFFFFFFFFFFFF)
+
+
+def scoring_matrices(
+    follows: sparse.csr_matrix, interests: sparse.csr_matrix
+) -> tuple[sparse.csr_matrix, sparse.csr_matrix]:
+    """Stacks matrices so a single product gives the whole score: [S, w*I] @ [S; I.T] = S @ S + w * I @ I.T."""
+    left = sparse.hstack([FRIENDS_OF_FRIENDS_WEIGHT * follows, SHARED_INTERESTS_WEIGHT * interests])
+    right = sparse.vstack([follows, interests.T])
+    return left.tocsr(), right.tocsr()
+
+
+def top_candidates(
+    left: sparse.csr_matrix, right: sparse.csr_matrix, follows: sparse.csr_matrix, rows: np.ndarray, count: int
+) -> list[list[tuple[int, float]]]:
+    """Top scored (user id, score) candidates for every given user id, see scoring_matrices()."""
+    scores = left[rows] @ right
+    result = []
+    for index, row in enumerate(rows):
+        start, end = scores.indptr[index], scores.indptr[index + 1]
+        data, indices = scores.data[start:end], scores.indices[start:end]
+        # Users already subscribed to and user himself/herself are filtered out after sorting, so taking extra.
+        excluded = set(follows.indices[follows.indptr[row] : follows.indptr[row + 1]].tolist())
+        excluded.add(row)
+        size = count + len(excluded)
+        top = np.argpartition(-data, size)[:size] if len(data) > size else np.arange(len(data))
+        top = top[np.argsort(-data[top], kind="stable")]
+        candidates = zip(indices[top].tolist(), data[top].tolist())
+        result.append([x for x in candidates if x[0] not in excluded][:count])
+    return result
+
+
+def refresh_recommendations(full: bool = False) -> int:
+    """Recomputes recommendations which might have changed since the last run. Returns count of updated users."""
+    names, follows = follows_matrix()
+    interests, interests_hashes = interests_matrix(names)
+    current = signatures(names, follows, interests_hashes)
+
+    stored = dict.fromkeys(names, (-1, datetime.min))
+    query = Recommendation.select(Recommendation.user, Recommendation.signature, Recommendation.updated).tuples()
+    for name, signature, updated in chain(*scatter(lambda: list(query.clone()))):
+        stored[name] = (signature, updated)
+
+    if full:
+        dirty = np.ones(len(names), dtype=bool)
+    else:
+        outdated = datetime.now() - timedelta(hours=RECOMMENDATIONS_MAX_AGE_HOURS)
+        changed = np.array([stored[x][0] != int(current[i]) for i, x in enumerate(names)], dtype=bool)
+        stale = np.array([stored[x][1] < outdated for x in names], dtype=bool)
+        # Users subscribed to changed ones get different friends of friends as well.
+        subscribers = np.asarray(follows[:, changed].sum(axis=1)).ravel() > 0
+        dirty = changed | stale | subscribers
+
+    rows = np.flatnonzero(dirty)
+    left, right = scoring_matrices(follows, interests)
+    now = datetime.now()
+    for start in range(0, len(rows), BATCH_SIZE):
+        batch = rows[start : start + BATCH_SIZE]
+        items = {
+            names[row]: {
+                "user": names[row],
+                "items": json.dumps([[names[x], round(score, 2)] for x, score in candidates]),
+                "signature": int(current[row]),
+                "updated": now,
+            }
+            for row, candidates in zip(batch, top_candidates(left, right, follows, batch, RECOMMENDATIONS_COUNT))
+        }
+        for shard, group in group_by_shard(list(items)).items():
+            with using_shard(shard), db.atomic():
+                Recommendation.delete().where(Recommendation.user.in_(group)).execute()
+                for chunk in chunked([items[x] for x in group], 100):
+                    Recommendation.insert_many(chunk).execute()
+    return len(rows)
@@ -0,0 +1,37 @@
+"""Read-only rows returned by hot read paths instead of Model instances.
+
+A Model instance carries field tracking and a dict of values, while rows are slotted dataclasses filled
+straight from query tuples. Outbound schemas take them with from_orm() and orjson serializes them as they are,
+so list endpoints return them without building schema instances first.
+"""
+
+from dataclasses import dataclass, field
+from datetime import date, datetime
+
+
+@dataclass(slots=True)
+class PostRow:
+    """Post as shown in lists and feeds, fields in order of models.post.post_columns()."""
+
+    id: int
+    author: str
+    title: str
+    text: str
+    created: datetime
+
+
+@dataclass(slots=True)
+class ProfileRow:
+    """Public profile of a user with latest posts, see models.utils.get_profiles."""
+
+    name: str
+    country: str
+    city: str
+    birthdate: date | None
+    interests: list[str]
+    bio: str
+    subscriptions: list[str]
+    subscribers_count: int
+    subscriptions_count: int
+    post_count: int
+    posts: list[PostRow] = field(default_factory=list)
@@ -0,0 +1,145 @@
+"""Horizontal sharding helpers.
+
+User row, his/her posts (archived ones included) and outbound subscriptions are stored
+in the shard chosen by a hash of username. Operations spanning several users are
+explicit scatter-gathers over shards, see models.utils.
+"""
+
+import os
+import threading
+import time
+import zlib
+from collections import defaultdict
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from functools import wraps
+
+from peewee import Database, IntegrityError, Model
+
+from models.db import current_shard, db, shards
+
+# Post and event ids are generated as milliseconds since this moment shifted left by 22 bits,
+# followed by 6 bits of shard index, 10 bits of process tag and 6 bits of per millisecond sequence.
+ID_EPOCH = datetime(2022, 9, 1, tzinfo=timezone.utc)
+# Tags are random, so two processes may still draw the same one, see create_with_id().
+ID_ATTEMPTS = 3
+
+
+class IdGenerator:
+    """Per process state of next_id(): random tag, redrawn in forked children, and sequence within a millisecond."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.reseed()
+
+    def reseed(self) -> None:
+        """Draws a new process tag, workers forked from a preloaded app must not share the parent's one."""
+        self.tag = int.from_bytes(os.urandom(2), "big") & 0x3FF
+        self.millis = 0
+        self.sequence = 0
+
+    def next(self, shard_index: int) -> int:
+        """Next id, waiting for the next millisecond if this one has run out of sequence numbers."""
+        with self._lock:
+            while True:
+                millis = (time.time_ns() - int(ID_EPOCH.timestamp()) * 10**9) // 10**6
+                if millis > self.millis:
+                    self.millis, self.sequence = millis, 0
+                    break
+                if self.sequence < 0x3F:
+                    self.sequence += 1
+                    break
+                time.sleep(0.0001)
+            return self.millis << 22 | shard_index << 16 | self.tag << 6 | self.sequence
+
+
+_ids = IdGenerator()
+os.register_at_fork(after_in_child=_ids.reseed)
+
+
+def jump_hash(key: int, buckets: int) -> int:
+    """Jump consistent hash by Lamping and Veach.
+
+    When buckets count grows from N to N+1 only 1/(N+1) of keys are moved, all of them into the new bucket.
+    """
+    bucket, jump = -1, 0
+    while jump < buckets:
+        bucket = jump
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        jump = int((bucket + 1) * (1 << 31) / ((key >> 33) + 1))
+    return bucket
+
+
+def shard_for(username: str) -> Database:
+    """Shard storing data of the user."""
+    return shards[jump_hash(zlib.crc32(username.encode()), len(shards))]
+
+
+def group_by_shard(usernames: list[str]) -> dict[Database, list[str]]:
+    """Splits usernames into groups stored in the same shard."""
+    groups = defaultdict(list)
+    for username in usernames:
+        groups[shard_for(username)].append(username)
+    return groups
+
+
+@contextmanager
+def using_shard(shard: Database) -> Iterator[Database]:
+    """Routes all queries within the context to given shard."""
+    token = current_shard.set(shard)
+    try:
+        yield shard
+    finally:
+        current_shard.reset(token)
+
+
+def using_user_shard(username: str):  # noqa: ANN201
+    """Routes all queries within the context to the shard of the user."""
+    return using_shard(shard_for(username))
+
+
+def on_own_shard(method: Callable) -> Callable:
+    """Decorator running User method against the shard of the user."""
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):  # noqa: ANN001, ANN202
+        with using_user_shard(self.name):
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+def scatter(func: Callable, *args, **kwargs) -> list:
+    """Calls function against every shard in turn, returns list of results."""
+    result = []
+    for shard in shards:
+        with using_shard(shard):
+            result.append(func(*args, **kwargs))
+    return result
+
+
+def next_id() -> int | None:
+    """Time ordered row id unique across shards, should be called within the shard row is stored in.
+
+    Returns None if there is only one shard, so database autoincrement is used as usual.
+    """
+    if len(shards) == 1:
+        return None
+    return _ids.next(shards.index(db.obj))
+
+
+def create_with_id(model: type[Model], **fields) -> Model:
+    """Creates a row of the model with next_id(), should be called within the shard row is stored in.
+
+    Two processes having drawn the same tag can generate the same id within a millisecond,
+    then the insert is retried with a fresh one in a savepoint, so the enclosing transaction goes on.
+    """
+    if len(shards) > 1:
+        for _ in range(ID_ATTEMPTS - 1):
+            try:
+                with db.atomic():
+                    return model.create(id=next_id(), **fields)
+            except IntegrityError:
+                pass
+    return model.create(id=next_id(), **fields)
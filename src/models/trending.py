@@ -0,0 +1,148 @@
+"""Hourly counters of new posts and subscribers per user, behind "trending" users lists.
+
+Counters are kept up to date by a consumer of change events log, in the shard events came from,
+so the same user may have partial counters in several shards. Window score is a sum of its buckets.
+Expired counters are dropped and counters are audited against events by maintenance jobs, see models.maintenance.
+"""
+
+from collections import Counter
+from collections.abc import Iterable
+from datetime import datetime, timedelta
+
+from peewee import CharField, DateTimeField, IntegerField, Model, fn
+
+from models import Event, EventOffset, db
+from models.consumers import Consumer, register_consumer
+from models.event import POST_ADDED, SUBSCRIPTION_ADDED, SUBSCRIPTION_DELETED, last_event_id
+from models.sharding import scatter
+
+# Supported windows in hours, counters older than the longest one are dropped.
+TRENDING_WINDOWS = {"24h": 24, "7d": 24 * 7}
+MAX_WINDOW_HOURS = max(TRENDING_WINDOWS.values())
+
+
+def bucket_of(moment: datetime) -> datetime:
+    """Start of the hour counter of given moment belongs to."""
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+def window_start(hours: int) -> datetime:
+    """First bucket of the window of given hours, current one included."""
+    return bucket_of(datetime.now()) - timedelta(hours=hours - 1)
+
+
+def count_events(events: Iterable[Event]) -> tuple[Counter, Counter]:
+    """New posts and net new subscribers per (username, bucket) within the longest window."""
+    oldest = window_start(MAX_WINDOW_HOURS)
+    posts, subscribers = Counter(), Counter()
+    for event in events:
+        if event.created < oldest:
+            continue
+        if event.kind == POST_ADDED:
+            posts[event.username, bucket_of(event.created)] += 1
+        elif event.kind in (SUBSCRIPTION_ADDED, SUBSCRIPTION_DELETED):
+            target = event.as_dict()["payload"]["target"]
+            subscribers[target, bucket_of(event.created)] += 1 if event.kind == SUBSCRIPTION_ADDED else -1
+    return posts, subscribers
+
+
+class TrendingCounter(Model):
+    """Count of new posts and net count of new subscribers of the user within an hour."""
+
+    # id field will be created by ORM
+    username = CharField(15)
+    bucket = DateTimeField()
+    posts = IntegerField(default=0)
+    subscribers = IntegerField(default=0)
+
+    class Meta:
+        """Peewee Meta class."""
+
+        table_name = "trending_counters"
+        database = db
+        indexes = ((("bucket", "username"), True),)
+
+
+class TrendingConsumer(Consumer):
+    """Counts posts and subscriptions events into hourly buckets."""
+
+    name = "trending"
+
+    def handle(self, events: list[Event]) -> None:
+        """Sums up batch in memory, then applies a single update per user and bucket."""
+        posts, subscribers = count_events(events)
+        for username, bucket in posts.keys() | subscribers.keys():
+            delta = {"posts": posts[username, bucket], "subscribers": subscribers[username, bucket]}
+            updated = (
+                TrendingCounter.update(
+                    posts=TrendingCounter.posts + delta["posts"],
+                    subscribers=TrendingCounter.subscribers + delta["subscribers"],
+                )
+                .where(TrendingCounter.username == username, TrendingCounter.bucket == bucket)
+                .execute()
+            )
+            if not updated:
+                TrendingCounter.create(username=username, bucket=bucket, **delta)
+
+
+trending_consumer = register_consumer(TrendingConsumer())
+
+
+def trending_scores(hours: int) -> Counter:
+    """Posts plus subscribers count per user within the window, summed over all shards."""
+    query = (
+        TrendingCounter.select(
+            TrendingCounter.username, fn.SUM(TrendingCounter.posts + TrendingCounter.subscribers)
+        )
+        .where(TrendingCounter.bucket >= window_start(hours))
+        .group_by(TrendingCounter.username)
+        .tuples()
+    )
+    scores = Counter()
+    for rows in scatter(lambda: list(query.clone())):
+        for username, score in rows:
+            scores[username] += score
+    return scores
+
+
+def expire_trending_counters() -> int:
+    """Drops counters out of the longest window in every shard. Returns count of dropped ones."""
+    query = TrendingCounter.delete().where(TrendingCounter.bucket < window_start(MAX_WINDOW_HOURS))
+    return sum(scatter(lambda: query.clone().execute()))
+
+
+def reset_trending_counters() -> None:
+    """Recounts counters of the current shard from its events, the consumer goes on after the latest of them."""
+    with db.atomic():
+        offset = last_event_id()
+        events = Event.select().where(Event.id <= offset, Event.created >= window_start(MAX_WINDOW_HOURS))
+        posts, subscribers = count_events(events)
+        TrendingCounter.delete().execute()
+        rows = [
+            {"username": x[0], "bucket": x[1], "posts": posts[x], "subscribers": subscribers[x]}
+            for x in posts.keys() | subscribers.keys()
+        ]
+        for i in range(0, len(rows), 1000):
+            TrendingCounter.insert_many(rows[i : i + 1000]).execute()
+        trending_consumer.seek(offset)
+
+
+def audit_trending_counters() -> int:
+    """Recounts events already handled by the consumer in every shard. Returns count of counters not matching."""
+
+    def audit_shard() -> int:
+        oldest = window_start(MAX_WINDOW_HOURS)
+        # Single transaction, so offset, events and counters are read as of the same moment.
+        with db.atomic():
+            offset = EventOffset.get_or_none(EventOffset.consumer == trending_consumer.name)
+            events = Event.select().where(
+                Event.id <= (offset.event_id if offset else 0), Event.created >= oldest
+            )
+            posts, subscribers = count_events(events)
+            counters = TrendingCounter.select().where(TrendingCounter.bucket >= oldest)
+            actual = {(x.username, x.bucket): (x.posts, x.subscribers) for x in counters}
+        expected = {x: (posts[x], subscribers[x]) for x in posts.keys() | subscribers.keys()}
+        keys = {x for x in expected.keys() | actual.keys() if expected.get(x, (0, 0)) != actual.get(x, (0, 0))}
+        return len(keys)
+
+    return sum(scatter(audit_shard))
@@ -1,6 +1,6 @@
 from datetime import datetime, timezone
 
-from peewee import CharField, DateField, DateTimeField, DoesNotExist, Model, TextField
+from peewee import CharField, DateField, DateTimeField, Model, TextField
 from playhouse.hybrid import hybrid_property
 
 from exceptions import (
@@ -9,18 +9,31 @@ from exceptions import (
     subscription_not_found_exception,
     user_not_found_exception,
 )
-from models import Post, Subscription, db
+from models import Post, Subscription, db, graph
+from models.interest import index_interests
+from models.rows import PostRow
+from models.archive import archived_post_count
+from models.event import POST_ADDED, SUBSCRIPTION_ADDED, SUBSCRIPTION_DELETED, USER_UPDATED, record_event
+from models.sharding import create_with_id, on_own_shard, using_user_shard
 
 MAX_SUBSCRIPTIONS = 100
 
 
+def split_interests(interests: str) -> list[str]:
+    """List of interests out of a comma separated string stored in DB."""
+    return [x.strip() for x in interests.split(",")]
+
+
 class User(Model):
-    """Database User model."""
+    """Database User model.
+
+    Every method is run against the shard the user is stored in, see models.sharding.
+    """
 
     name = CharField(15, primary_key=True)
     password = CharField()
-    country = CharField(default="")
-    city = CharField(default="")
+    country = CharField(default="", index=True)
+    city = CharField(default="", index=True)
     birthdate = DateField(null=True)
     _interests = TextField(default="", column_name="interests")
     bio = TextField(default="")
@@ -35,61 +48,94 @@ class User(Model):
     @hybrid_property
     def interests(self) -> list[str]:
         """Gets list of user interests from a comma separated string stored in DB."""
-        return [x.strip() for x in self._interests.split(",")]
+        return split_interests(self._interests)
 
     @hybrid_property
     def subscribers_count(self) -> int:
         """Returns the number of subscribers."""
-        return self.subscribed_by.count()
+        return graph.followers_count(self.name)
 
     @hybrid_property
     def subscriptions_count(self) -> int:
         """Returns the number of subscriptions."""
-        return self.subscribed_to.count()
+        return graph.followees_count(self.name)
 
     @hybrid_property
+    @on_own_shard
     def post_count(self) -> int:
-        """Returns the number of posts."""
-        return len(self.posts)
+        """Returns the number of posts, archived ones included."""
+        return Post.select().where(Post.author == self.name).count() + archived_post_count(self.name)
 
     @hybrid_property
     def subscriptions(self) -> list[str]:
         """Returns a list of usernames that current user is subscribed to."""
-        return [x.target.name for x in self.subscribed_to]
+        return graph.followees(self.name)
 
-    def add_subscription(self, username: str) -> Subscription:
-        """Adds username to self.subscriptons.
+    @on_own_shard
+    def add_subscription(self, username: "str | User") -> Subscription:
+        """Adds username to self.subscriptons, User instance is accepted as well.
 
         Added an extra check because Sqlite wasn't following foreign key constraints for some reason.
         """
+        if isinstance(username, User):
+            username = username.name
         if self.name == username:
             raise cant_subscribe_to_youserlf
-        if self.subscriptions_count >= MAX_SUBSCRIPTIONS:
-            raise add_subscription_exception
-        target = User.get_or_none(User.name == username)
-        if not target:
-            raise user_not_found_exception
-        return Subscription.insert(source=self, target=target).execute()
-
-    def delete_subscription(self, username: str) -> None:
-        """Deletes subscription by username."""
-        try:
-            subscription = Subscription.get(source=self.name, target=username)
-        except DoesNotExist:
-            raise subscription_not_found_exception
-        Subscription.delete_by_id(subscription.id)
-
+        # Users who joined moments ago may be missing in the graph yet.
+        if not graph.has_user(username):
+            with using_user_shard(username):
+                if not User.get_or_none(User.name == username):
+                    raise user_not_found_exception
+        with db.atomic():
+            # No-op update locks the user row, so concurrent requests of the user can't exceed the limit.
+            User.update(bio=User.bio).where(User.name == self.name).execute()
+            if Subscription.select().where(Subscription.source == self.name).count() >= MAX_SUBSCRIPTIONS:
+                raise add_subscription_exception
+            subscription = Subscription.insert(source=self, target=username).execute()
+            record_event(SUBSCRIPTION_ADDED, self.name, {"target": username})
+        graph.subscribe(self.name, username)
+        return subscription
+
+    @on_own_shard
+    def delete_subscription(self, username: "str | User") -> None:
+        """Deletes subscription by username or User instance."""
+        if isinstance(username, User):
+            username = username.name
+        with db.atomic():
+            deleted = Subscription.delete().where(
+                Subscription.source == self.name, Subscription.target == username
+            ).execute()
+            if not deleted:
+                raise subscription_not_found_exception
+            record_event(SUBSCRIPTION_DELETED, self.name, {"target": username})
+        graph.unsubscribe(self.name, username)
+
+    @on_own_shard
     def add_post(self, title: str, text: str) -> Post:
         """Adds a post to current user."""
-        return Post.create(title=title, text=text, author=self)
-
-    def feed(self) -> list[Post]:
-        """Posts by current user subscriptions."""
-        subquery = Subscription.select(Subscription.target).where(
-            Subscription.source == self.name
-        )
-        return Post.select().where(Post.author.in_(subquery)).order_by(Post.id.desc())
-
+        with db.atomic():
+            post = create_with_id(Post, title=title, text=text, author=self)
+            record_event(POST_ADDED, self.name, post.as_dict())
+        return post
+
+    @on_own_shard
+    def update_profile(self, **fields) -> "User":
+        """Updates given profile fields, returns updated User."""
+        with db.atomic():
+            User.update(**fields).where(User.name == self.name).execute()
+            if "interests" in fields:
+                index_interests(self.name, fields["interests"])
+            record_event(USER_UPDATED, self.name, fields)
+        return User.get_by_id(self.name)
+
+    def feed(self, **filters) -> list[PostRow]:
+        """Posts by current user subscriptions. Accepts same arguments as models.utils.get_feed()."""
+        # Imported here since models.utils depends on User itself.
+        from models.utils import get_feed
+
+        return get_feed(self, **filters)
+
+    @on_own_shard
     def bump(self) -> None:
         """Small helper to update last_activity timestamp."""
         User.update(last_activity=datetime.now(tz=timezone.utc)).where(
@@ -1,16 +1,172 @@
-from datetime import date
+import heapq
+from collections import defaultdict
+from collections.abc import Iterator
+from datetime import date, datetime, time, timedelta
+from itertools import chain, islice
+from operator import attrgetter
 
-from models import Post, Subscription, User, db
+from peewee import Field, fn
+
+from config import EVENTS_BATCH_SIZE, FEED_PAGE_SIZE, USERS_PAGE_SIZE
+from exceptions import usernames_not_found_exception
+from models import Event, EventOffset, Interest, Post, PostArchive, Recommendation, Subscription, User, db, graph
+from models.archive import iter_archived_posts
+from models.compression import CompressionDictionary
+from models.event import USER_CREATED, read_events, record_event
+from models.maintenance import MaintenanceJob
+from models.post import post_columns, post_rows, truncate_text
+from models.rows import PostRow, ProfileRow
+from models.db import shards
+from models.sharding import group_by_shard, scatter, shard_for, using_shard, using_user_shard
+from models.trending import TrendingCounter, trending_scores
+from models.user import split_interests
 
 
 def add_user(username: str, password: str) -> User | None:
     """Creates and returns new User() or None if user exists."""
-    user, created = User.get_or_create(name=username, defaults={"password": password})
+    with using_user_shard(username), db.atomic():
+        user, created = User.get_or_create(name=username, defaults={"password": password})
+        if created:
+            record_event(USER_CREATED, username, {"name": username})
     if created:
+        graph.add_user(username)
         return user
     return None
 
 
+def get_user(username: str) -> User | None:
+    """Gets User by username from his/her shard or None if user doesn't exist."""
+    with using_user_shard(username):
+        return User.get_or_none(User.name == username)
+
+
+def get_users(usernames: list[str]) -> list[User]:
+    """Users with given names in the same order using a single query per shard, missing ones are skipped."""
+    users = {}
+    for shard, group in group_by_shard(usernames).items():
+        with using_shard(shard):
+            users.update((x.name, x) for x in User.select().where(User.name.in_(group)))
+    return [users[x] for x in usernames if x in users]
+
+
+def get_profiles(
+    usernames: list[str], preview_count: int = 0, text_length: int | None = None
+) -> list[ProfileRow]:
+    """Public profiles of given users in the same order with up to preview_count latest posts, missing ones are skipped."""
+    profiles = {}
+    for shard, group in group_by_shard(usernames).items():
+        with using_shard(shard):
+            profiles.update((x.name, x) for x in shard_profiles(group, preview_count, text_length))
+    return [profiles[x] for x in usernames if x in profiles]
+
+
+def get_all_user_profiles(preview_count: int = 0, text_length: int | None = None) -> list[ProfileRow]:
+    """Public profiles of all users from all shards ordered by name, with up to preview_count latest posts."""
+    per_shard = scatter(shard_profiles, None, preview_count, text_length)
+    return list(heapq.merge(*per_shard, key=attrgetter("name")))
+
+
+def shard_profiles(
+    usernames: list[str] | None, preview_count: int = 0, text_length: int | None = None
+) -> list[ProfileRow]:
+    """Profiles of given users, or of all users if None, stored in the current shard, ordered by name.
+
+    Takes a fixed count of queries no matter how many users are asked for: users, posts counts,
+    archived posts counts, latest posts and latest archive partitions of authors short of recent posts.
+    Subscriptions and their counts come from the graph index.
+    """
+
+    def of_users(query, field: Field):
+        return query if usernames is None else query.where(field.in_(usernames))
+
+    users = of_users(
+        User.select(User.name, User.country, User.city, User.birthdate, User._interests, User.bio), User.name
+    )
+    users = list(users.order_by(User.name).tuples())
+    counts = dict(of_users(Post.select(Post.author, fn.COUNT(Post.id)), Post.author).group_by(Post.author).tuples())
+    archived = dict(
+        of_users(PostArchive.select(PostArchive.author, fn.SUM(PostArchive.post_count)), PostArchive.author)
+        .group_by(PostArchive.author)
+        .tuples()
+    )
+    posts = defaultdict(list)
+    if preview_count:
+        for row in latest_rows(Post, Post.id, usernames, preview_count, post_columns(text_length)):
+            post = PostRow(*row)
+            posts[post.author].append(truncate_text(post, text_length))
+        short = [name for name, *_ in users if archived.get(name) and counts.get(name, 0) < preview_count]
+        for partition in latest_rows(PostArchive, PostArchive.period, short, preview_count):
+            author = partition.author_id
+            archived_posts = partition.unpack()[: preview_count - len(posts[author])]
+            posts[author] += [truncate_text(x, text_length) for x in archived_posts]
+
+    return [
+        ProfileRow(
+            name,
+            country,
+            city,
+            birthdate,
+            split_interests(interests),
+            bio,
+            graph.followees(name),
+            graph.followers_count(name),
+            graph.followees_count(name),
+            counts.get(name, 0) + (archived.get(name) or 0),
+            posts[name],
+        )
+        for name, country, city, birthdate, interests, bio in users
+    ]
+
+
+def latest_rows(
+    model: type[Post] | type[PostArchive],
+    order: Field,
+    authors: list[str] | None,
+    count: int,
+    columns: list | None = None,
+) -> list:
+    """Up to count latest rows of every author, or of all authors if None, in a single query.
+
+    Rows are ordered by author and given field descending. They are model instances, or tuples if columns are given.
+    """
+    if authors is not None and not authors:
+        return []
+    rank = fn.ROW_NUMBER().over(partition_by=[model.author], order_by=[order.desc()])
+    ranked = model.select(model.id, rank.alias("rank"))
+    if authors is not None:
+        ranked = ranked.where(model.author.in_(authors))
+    ranked = ranked.alias("ranked")
+    query = model.select(*(columns or [model])).join(ranked, on=(model.id == ranked.c.id)).where(ranked.c.rank <= count)
+    query = query.order_by(model.author, order.desc())
+    return list(query.tuples() if columns else query)
+
+
+def search_users(
+    interest: list[str] | None = None,
+    country: str | None = None,
+    city: str | None = None,
+    after: str | None = None,
+    limit: int = USERS_PAGE_SIZE,
+) -> list[User]:
+    """Users having all of given interests from given country and city, ordered by name.
+
+    Every interest is looked up in the inverted index, so posting lists are intersected by the database
+    instead of scanning interests strings. Every shard returns up to `limit` users, then they are merged.
+    """
+    query = User.select()
+    for term in interest or []:
+        query = query.where(User.name.in_(Interest.select(Interest.user).where(Interest.term == term)))
+    if country:
+        query = query.where(User.country == country)
+    if city:
+        query = query.where(User.city == city)
+    if after:
+        query = query.where(User.name > after)
+    query = query.order_by(User.name).limit(limit)
+    merged = heapq.merge(*scatter(lambda: list(query.clone())), key=attrgetter("name"))
+    return list(islice(merged, limit))
+
+
 def post_filter_query_builder(
     query,
     keyword: str | None = None,
@@ -21,33 +177,209 @@ def post_filter_query_builder(
 
     User can search his/her posts by the title name via a simple substring match.
     User can search his/her posts by date published via start date and end date filters.
+    Dates are compared as a plain range of `created` values, so index on it can be used.
     """
     if keyword:
         query = query.where(Post.title.contains(keyword))
     if start:
-        query = query.where(Post.created.date() >= start)
+        query = query.where(Post.created >= datetime.combine(start, time.min))
     if end:
-        query = query.where(Post.created.date() <= end)
+        query = query.where(Post.created < datetime.combine(end + timedelta(days=1), time.min))
     return query
 
 
-def get_top_users(limit: int = 20) -> list[User]:
-    """Custom rating implemented as sum of user subscribers count and posts count."""
-    raw_query = f"""
-        SELECT u.*, COUNT(scores.x) AS score
+def iter_user_posts(
+    author: str,
+    limit: int | None = None,
+    before: int | None = None,
+    text_length: int | None = None,
+    **filters,
+) -> Iterator[PostRow]:
+    """Posts of the author, most recent first, falling back to archive once recent posts are exhausted.
+
+    Up to limit recent posts are fetched by a single query, archive is only read if there are fewer of them.
+    If text_length is given, texts are cut down to it without decompressing them in full.
+    """
+    query = Post.select(*post_columns(text_length)).where(Post.author == author)
+    if before is not None:
+        query = query.where(Post.id < before)
+    query = post_filter_query_builder(query, **filters).order_by(Post.id.desc()).limit(limit)
+    posts = chain(post_rows(query), iter_archived_posts(author, before=before, **filters))
+    return (truncate_text(x, text_length) for x in posts)
+
+
+def get_user_posts(author: str, limit: int | None = None, **filters) -> list[PostRow]:
+    """List of author posts, most recent first, archived ones included."""
+    with using_user_shard(author):
+        return list(islice(iter_user_posts(author, limit, **filters), limit))
+
+
+def check_usernames_exist(usernames: list[str]) -> None:
+    """Checks that all of unique usernames exist using a single query per shard. Raises corresponding exception otherwise."""
+    found = 0
+    for shard, names in group_by_shard(usernames).items():
+        with using_shard(shard):
+            found += User.select(User.name).where(User.name.in_(names)).count()
+    if found != len(usernames):
+        raise usernames_not_found_exception
+
+
+def merge_author_feeds(
+    authors: list[str],
+    limit: int = FEED_PAGE_SIZE,
+    before: int | None = None,
+    **filters,
+) -> list[PostRow]:
+    """Most recent posts of given authors, filtered with post_filter_query_builder.
+
+    Instead of sorting the whole set of matching posts, every author is scanned separately
+    over (author_id, id DESC) index taking up to `limit` posts, then streams are k-way merged.
+    So a page costs O(limit * authors) rows no matter how long posting history is.
+    Archived posts are only read when author stream runs out of recent ones.
+    Authors can be stored in different shards, post ids are unique and time ordered across them.
+    """
+    streams = [get_user_posts(x, limit=limit, before=before, **filters) for x in authors]
+    merged = heapq.merge(*streams, key=attrgetter("id"), reverse=True)
+    return list(islice(merged, limit))
+
+
+def get_feed(
+    user: User,
+    usernames: list[str] | None = None,
+    limit: int = FEED_PAGE_SIZE,
+    before: int | None = None,
+    **filters,
+) -> list[PostRow]:
+    """Page of posts by user subscriptions, optionally narrowed down to given usernames."""
+    authors = user.subscriptions
+    if usernames:
+        check_usernames_exist(usernames)
+        authors = [x for x in authors if x in usernames]
+    return merge_author_feeds(authors, limit=limit, before=before, **filters)
+
+
+def count_new_posts(user: User) -> int:
+    """Count of posts by user subscriptions published since his/her last activity."""
+    result = 0
+    for shard, authors in group_by_shard(user.subscriptions).items():
+        with using_shard(shard):
+            query = Post.select().where(Post.author.in_(authors))
+            if user.last_activity:
+                query = query.where(Post.created > user.last_activity)
+            result += query.count()
+    return result
+
+
+def top_usernames(limit: int = 20) -> list[str]:
+    """Custom rating implemented as sum of user subscribers count and posts count, archived posts included.
+
+    Scatter-gather: every shard counts posts of its users, subscribers are counted by the graph index.
+    """
+    posts_query = """
+        SELECT u.name, COALESCE(p.x, 0) + COALESCE(a.x, 0)
         FROM users u
         LEFT JOIN (
-            SELECT author_id AS author, title AS x from posts
-            UNION
-            SELECT target_id, source_id from subscriptions
-            ) scores ON scores.author = u.name
-        GROUP BY u.name
-        ORDER BY score DESC
-        LIMIT {limit}
+            SELECT author_id AS author, COUNT(*) AS x FROM posts GROUP BY author_id
+            ) p ON p.author = u.name
+        LEFT JOIN (
+            SELECT author_id AS author, SUM(post_count) AS x FROM posts_archive GROUP BY author_id
+            ) a ON a.author = u.name
+    """
+    scores = {}
+    for posts in scatter(lambda: db.execute_sql(posts_query).fetchall()):
+        scores.update((name, count + graph.followers_count(name)) for name, count in posts)
+    return heapq.nlargest(limit, scores, key=scores.__getitem__)
+
+
+def get_top_users(limit: int = 20) -> list[User]:
+    """Users with the top scores of top_usernames(), fetched from their shards."""
+    return get_users(top_usernames(limit))
+
+
+def trending_usernames(hours: int, limit: int = 20) -> list[str]:
+    """Users with the most new posts and subscribers within the last hours, see models.trending."""
+    scores = trending_scores(hours)
+    return heapq.nlargest(limit, (x for x in scores if scores[x] > 0), key=scores.__getitem__)
+
+
+def get_trending_users(hours: int, limit: int = 20) -> list[User]:
+    """Users of trending_usernames(), fetched from their shards."""
+    return get_users(trending_usernames(hours, limit))
+
+
+def get_recommendations(user: User) -> list[tuple[str, float]]:
+    """Precomputed list of (username, score) to subscribe to, users subscribed to since then are skipped."""
+    with using_user_shard(user.name):
+        recommendation = Recommendation.get_or_none(Recommendation.user == user.name)
+    if not recommendation:
+        return []
+    return [(name, score) for name, score in recommendation.as_list() if not graph.is_following(user.name, name)]
+
+
+def get_events(after: int = 0, limit: int = EVENTS_BATCH_SIZE) -> list[Event]:
+    """Events of all shards following given id, oldest first.
+
+    Every shard returns up to `limit` events in id order, then they are merged like feed streams.
     """
-    return User.raw(raw_query)
+    merged = heapq.merge(*scatter(read_events, after=after, limit=limit), key=attrgetter("id"))
+    return list(islice(merged, limit))
+
+
+def rebalance() -> int:
+    """Moves users data to the shards they belong to, should be run after DB_SHARD_URIS change.
+
+    Returns count of moved users. Rows already present in the target shard are kept,
+    so the tool can be interrupted and run again at any moment.
+    """
+    moved = 0
+    for source in shards:
+        with using_shard(source):
+            names = [x for (x,) in User.select(User.name).tuples() if shard_for(x) is not source]
+
+        for name in names:
+            with using_shard(source), db.atomic():
+                rows = [
+                    (User, list(User.select().where(User.name == name).dicts())),
+                    (Post, list(Post.select().where(Post.author == name).dicts())),
+                    (PostArchive, list(PostArchive.select().where(PostArchive.author == name).dicts())),
+                    (Subscription, list(Subscription.select().where(Subscription.source == name).dicts())),
+                    (Interest, list(Interest.select().where(Interest.user == name).dicts())),
+                    (Recommendation, list(Recommendation.select().where(Recommendation.user == name).dicts())),
+                ]
+                with using_shard(shard_for(name)), db.atomic():
+                    for model, items in rows:
+                        if model in (PostArchive, Subscription, Interest):
+                            # Their ids are not exposed anywhere, so letting target shard assign new ones.
+                            items = [{k: v for k, v in x.items() if k != "id"} for x in items]
+                        if items:
+                            model.insert_many(items).on_conflict_ignore().execute()
+
+                Recommendation.delete().where(Recommendation.user == name).execute()
+                Interest.delete().where(Interest.user == name).execute()
+                Subscription.delete().where(Subscription.source == name).execute()
+                PostArchive.delete().where(PostArchive.author == name).execute()
+                Post.delete().where(Post.author == name).execute()
+                User.delete().where(User.name == name).execute()
+            moved += 1
+    return moved
+
+
+# Every model stored in each of the shards
+MODELS = [
+    User,
+    Post,
+    PostArchive,
+    Subscription,
+    Interest,
+    Recommendation,
+    Event,
+    EventOffset,
+    TrendingCounter,
+    CompressionDictionary,
+    MaintenanceJob,
+]
 
 
 def create_tables() -> None:
-    """Helper to initialize tables."""
-    db.create_tables([User, Post, Subscription])
+    """Helper to initialize tables in every shard."""
+    scatter(db.create_tables, MODELS)
@@ -1,9 +1,30 @@
 import re
 from datetime import date
+from enum import Enum
 
 from fastapi import Body, Query
 from pydantic import BaseModel, validator
 
+from config import FEED_PAGE_SIZE, USERS_PAGE_SIZE
+
+# Max count of usernames subscriptions feed can be filtered with
+MAX_FILTER_USERNAMES = 10
+
+# Max count of interests users can be searched by at once
+MAX_SEARCH_INTERESTS = 5
+
+# Max length of post text, also the max length texts of listed posts can be cut down to
+MAX_TEXT_LENGTH = 1000
+
+# Max count of profiles to be looked up at once
+MAX_BATCH_USERNAMES = 50
+
+# Max count of usernames returned by prefix completion
+MAX_COMPLETIONS = 20
+
+# Max time change events stream can be kept open waiting for new events, in seconds
+MAX_EVENTS_WAIT = 60
+
 
 class UpdateUserProfilePayload(BaseModel):
     """User can update the following parts of his/her profile: short biography, birth date, country, city, list of interests."""
@@ -12,7 +33,7 @@ class UpdateUserProfilePayload(BaseModel):
     city: str | None = Body(None, title="Users city")
     bio: str | None = Body(None, title="Users shoty biography")
     birthdate: date | None = Body(None, title="User birth date")
-    interests: list[str] = Body([], title="List of user interests")
+    interests: list[str] | None = Body(None, title="List of user interests")
 
     class Config:
         schema_extra = {
@@ -79,12 +100,23 @@ class LoginPayload(Username):
         }
 
 
+def check_text_length(v: int | None) -> int | None:
+    """Shared validator of post texts preview length."""
+    assert v is None or 0 < v <= MAX_TEXT_LENGTH, f"Text length should be 1 to {MAX_TEXT_LENGTH}"
+    return v
+
+
 class PostFilterPayload(BaseModel):
     """Values for posts and subscription post filtration."""
 
     keyword: str | None = Query(None, title="Keyword to loop up in post title")
     start: date | None = Query(None, title="Post shoud be created after this date")
     end: date | None = Query(None, title="Post should be created before this date")
+    text_length: int | None = Query(None, title="Cut post texts down to this count of characters")
+
+    @validator("text_length")
+    def validate_text_length(cls, v):
+        return check_text_length(v)
 
     class Config:
         schema_extra = {
@@ -96,6 +128,121 @@ class PostFilterPayload(BaseModel):
         }
 
 
+class FeedFilterPayload(PostFilterPayload):
+    """Values for subscription posts filtration and pagination."""
+
+    usernames: str | None = Query(
+        None, title=f"Comma separated list of up to {MAX_FILTER_USERNAMES} usernames"
+    )
+    before: int | None = Query(None, title="Post id to show older posts than, used for pagination")
+    limit: int = Query(FEED_PAGE_SIZE, title="Max count of posts to show")
+
+    @validator("usernames")
+    def validate_usernames(cls, v):
+        """Casts comma separated string into a list of unique usernames."""
+        if v is None:
+            return v
+        usernames = list(dict.fromkeys(x.strip() for x in v.split(",") if x.strip()))
+        assert (
+            len(usernames) <= MAX_FILTER_USERNAMES
+        ), f"No more than {MAX_FILTER_USERNAMES} usernames allowed"
+        return usernames
+
+    @validator("limit")
+    def validate_limit(cls, v):
+        assert 0 < v <= FEED_PAGE_SIZE, f"Limit should be 1 to {FEED_PAGE_SIZE}"
+        return v
+
+
+class UserSearchPayload(BaseModel):
+    """Users search filters and pagination."""
+
+    interest: str | None = Query(
+        None, title=f"Comma separated list of up to {MAX_SEARCH_INTERESTS} interests user should have all of"
+    )
+    country: str | None = Query(None, title="Users country")
+    city: str | None = Query(None, title="Users city")
+    after: str | None = Query(None, title="Username to show next users after, used for pagination")
+    limit: int = Query(USERS_PAGE_SIZE, title="Max count of users to show")
+
+    @validator("interest")
+    def validate_interest(cls, v):
+        """Casts comma separated string into a list of unique normalized interests."""
+        if v is None:
+            return v
+        interests = list(dict.fromkeys(x.strip().lower() for x in v.split(",") if x.strip()))
+        assert (
+            len(interests) <= MAX_SEARCH_INTERESTS
+        ), f"No more than {MAX_SEARCH_INTERESTS} interests allowed"
+        return interests
+
+    @validator("limit")
+    def validate_limit(cls, v):
+        assert 0 < v <= USERS_PAGE_SIZE, f"Limit should be 1 to {USERS_PAGE_SIZE}"
+        return v
+
+
+class UserBatchPayload(BaseModel):
+    """Usernames to look profiles up for."""
+
+    names: str = Query(..., title=f"Comma separated list of up to {MAX_BATCH_USERNAMES} usernames")
+    posts: bool = Query(False, title="Include latest posts of every user")
+    text_length: int | None = Query(None, title="Cut post texts down to this count of characters")
+
+    @validator("names")
+    def validate_names(cls, v):
+        """Casts comma separated string into a list of unique usernames."""
+        names = list(dict.fromkeys(x.strip() for x in v.split(",") if x.strip()))
+        assert 0 < len(names) <= MAX_BATCH_USERNAMES, f"Provide 1 to {MAX_BATCH_USERNAMES} usernames"
+        return names
+
+    @validator("text_length")
+    def validate_text_length(cls, v):
+        return check_text_length(v)
+
+
+class CompletionPayload(BaseModel):
+    """Username prefix to complete."""
+
+    prefix: str = Query(..., title="Beginning of username, case insensitive")
+    limit: int = Query(10, title=f"Max count of usernames to show, up to {MAX_COMPLETIONS}")
+    ranked: bool = Query(False, title="Show users with the most subscribers first instead of alphabetical order")
+
+    @validator("prefix")
+    def validate_prefix(cls, v):
+        assert 0 < len(v) < 15, "Prefix should be 1 to 14 characters long"
+        return v
+
+    @validator("limit")
+    def validate_limit(cls, v):
+        assert 0 < v <= MAX_COMPLETIONS, f"Limit should be 1 to {MAX_COMPLETIONS}"
+        return v
+
+
+class EventsPayload(BaseModel):
+    """Cursor of change events stream."""
+
+    after: int = Query(0, title="Id of the last event seen, stream starts right after it")
+    wait: int = Query(0, title=f"Seconds to wait for new events before closing stream, up to {MAX_EVENTS_WAIT}")
+
+    @validator("after")
+    def validate_after(cls, v):
+        assert v >= 0, "Event id can't be negative"
+        return v
+
+    @validator("wait")
+    def validate_wait(cls, v):
+        assert 0 <= v <= MAX_EVENTS_WAIT, f"Wait should be 0 to {MAX_EVENTS_WAIT} seconds"
+        return v
+
+
+class TrendingWindow(str, Enum):
+    """Time windows of trending users list, see models.trending."""
+
+    day = "24h"
+    week = "7d"
+
+
 class NewPostPayload(BaseModel):
     """Payload for adding new post."""
 
@@ -109,7 +256,7 @@ class NewPostPayload(BaseModel):
 
     @validator("text")
     def validate_text(cls, v):
-        assert 10 < len(v) < 1000, "Post text should 10 to 1000 characters long"
+        assert 10 < len(v) < MAX_TEXT_LENGTH, f"Post text should 10 to {MAX_TEXT_LENGTH} characters long"
         return v
 
     class Config:
@@ -74,7 +74,47 @@ class UserProfile(BaseModel):
 class UserProfileWithPosts(UserProfile):
     """User profile data with post samples included."""
 
-    posts: list[PostSchema] = []
+    posts: list[PostWithAuthorSchema] = []
+
+
+class RecommendationSchema(BaseModel):
+    """User recommended to subscribe to."""
+
+    name: str
+    score: float
+
+    class Config:
+        """Pydantic config."""
+
+        schema_extra = {
+            "example": {
+                "name": "User1",
+                "score": 3.5,
+            }
+        }
+
+
+class EventSchema(BaseModel):
+    """Change event, a line of /events stream."""
+
+    id: int
+    kind: str
+    username: str
+    payload: dict
+    created: datetime
+
+    class Config:
+        """Pydantic config."""
+
+        schema_extra = {
+            "example": {
+                "id": 42,
+                "kind": "subscription_added",
+                "username": "User1",
+                "payload": {"target": "User2"},
+                "created": "2022-09-06T11:02:55.123Z",
+            }
+        }
 
 
 class Token(BaseModel):
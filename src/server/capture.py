@@ -0,0 +1,126 @@
+"""Recording of served requests as JSON lines, to be replayed later by benchmarks.replay.
+
+Every record holds what's needed to send the same request again: method, path, query string and
+JSON body, with passwords stripped, plus the user the token was issued to instead of the token itself.
+Route template, status and duration are recorded to compare with replayed ones.
+"""
+
+import json
+import os
+import random
+import time
+from collections.abc import Awaitable, Callable, MutableMapping
+
+from jose import JWTError
+from starlette.routing import Match
+
+from server.utils import decode_jwt
+
+Scope = MutableMapping
+Message = MutableMapping
+Receive = Callable[[], Awaitable[Message]]
+Send = Callable[[Message], Awaitable[None]]
+
+# Requests of probes and scrapers are not traffic worth replaying.
+EXCLUDED_PATHS = {"/health/ready", "/metrics"}
+# Bodies are recorded up to this size, larger ones are marked as truncated and can't be replayed.
+MAX_BODY_SIZE = 64 * 1024
+
+
+def strip_passwords(value: object) -> object:
+    """Drops password fields, as in LoginPayload, at any depth of JSON value."""
+    if isinstance(value, dict):
+        return {k: strip_passwords(v) for k, v in value.items() if "password" not in k.lower()}
+    if isinstance(value, list):
+        return [strip_passwords(x) for x in value]
+    return value
+
+
+def auth_subject(headers: list[tuple[bytes, bytes]]) -> str | None:
+    """User the bearer token of the request was issued to, if it's valid."""
+    for name, value in headers:
+        if name == b"authorization" and value.lower().startswith(b"bearer "):
+            try:
+                return decode_jwt(value[7:].decode()).get("sub")
+            except JWTError:
+                return None
+    return None
+
+
+def route_template(scope: Scope) -> str:
+    """Path of the route request was matched to, e.g. /user/{username}, or the path itself if none."""
+    app = scope.get("app")
+    for route in getattr(app, "routes", ()):
+        if route.matches(scope)[0] == Match.FULL:
+            return route.path
+    return scope["path"]
+
+
+class TrafficCaptureMiddleware:
+    """ASGI middleware appending a record of every HTTP request to the file at path.
+
+    Records are written with a single append each, so several workers can share the file.
+    """
+
+    def __init__(self, app: Callable, path: str, sample: float = 1.0) -> None:
+        self.app = app
+        self.path = path
+        self.sample = sample
+        self._fd: int | None = None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["path"] in EXCLUDED_PATHS or random.random() >= self.sample:
+            await self.app(scope, receive, send)
+            return
+
+        timestamp, started = time.time(), time.perf_counter()
+        body, response = bytearray(), {"status": None, "size": 0}
+
+        async def receive_recording() -> Message:
+            message = await receive()
+            if message["type"] == "http.request" and len(body) <= MAX_BODY_SIZE:
+                body.extend(message.get("body", b""))
+            return message
+
+        async def send_recording(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+            elif message["type"] == "http.response.body":
+                response["size"] += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive_recording, send_recording)
+        finally:
+            self.write(
+                {
+                    "timestamp": timestamp,
+                    "method": scope["method"],
+                    "route": route_template(scope),
+                    "path": scope["path"],
+                    "query": scope["query_string"].decode("latin-1"),
+                    **self.recorded_body(bytes(body)),
+                    "subject": auth_subject(scope["headers"]),
+                    "status": response["status"],
+                    "size": response["size"],
+                    "duration": time.perf_counter() - started,
+                }
+            )
+
+    @staticmethod
+    def recorded_body(body: bytes) -> dict:
+        """JSON body without passwords, or a mark that body couldn't be recorded."""
+        if not body:
+            return {}
+        if len(body) > MAX_BODY_SIZE:
+            return {"truncated": True}
+        try:
+            return {"json": strip_passwords(json.loads(body))}
+        except ValueError:
+            return {"truncated": True}
+
+    def write(self, record: dict) -> None:
+        """Appends record to the file, opened on the first write, so forked workers don't share the descriptor."""
+        if self._fd is None:
+            self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        os.write(self._fd, (json.dumps(record) + "\n").encode())
@@ -0,0 +1,235 @@
+"""Response compression negotiated by Accept-Encoding: zstd, brotli or gzip.
+
+Bodies sent at once are compressed whole if they are at least `minimum_size` bytes long. Chunked responses,
+like /events stream, are compressed on the fly with every chunk flushed, so clients get events without delay.
+Public responses (GET without Authorization, not marked private) reuse compressed bytes of equal bodies,
+so a popular page is compressed once until its content changes.
+"""
+
+import hashlib
+import zlib
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable, MutableMapping
+
+import brotli
+import zstandard
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+
+Scope = MutableMapping
+Message = MutableMapping
+Receive = Callable[[], Awaitable[Message]]
+Send = Callable[[Message], Awaitable[None]]
+
+# Content types worth compressing, JSON and JSON lines mostly.
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/")
+# Bodies larger than this are compressed in a thread, compressors release GIL, so event loop isn't blocked.
+THREAD_MIN_SIZE = 256 * 1024
+
+
+class GzipStream:
+    """Gzip compressor of a chunked response."""
+
+    level = 6
+
+    def __init__(self) -> None:
+        self._compressor = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    @classmethod
+    def compress_body(cls, data: bytes) -> bytes:
+        """Compresses the whole body at once."""
+        compressor = zlib.compressobj(cls.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+
+    def compress(self, data: bytes) -> bytes:
+        """Compresses a chunk, flushing it so client can decode it right away."""
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        """End of the compressed stream."""
+        return self._compressor.flush()
+
+
+class BrotliStream:
+    """Brotli compressor of a chunked response."""
+
+    # Quality over 5 costs several times more CPU for a few percent smaller JSON.
+    level = 5
+
+    def __init__(self) -> None:
+        self._compressor = brotli.Compressor(quality=self.level)
+
+    @classmethod
+    def compress_body(cls, data: bytes) -> bytes:
+        """Compresses the whole body at once."""
+        return brotli.compress(data, quality=cls.level)
+
+    def compress(self, data: bytes) -> bytes:
+        """Compresses a chunk, flushing it so client can decode it right away."""
+        return self._compressor.process(data) + self._compressor.flush()
+
+    def finish(self) -> bytes:
+        """End of the compressed stream."""
+        return self._compressor.finish()
+
+
+class ZstdStream:
+    """Zstandard compressor of a chunked response."""
+
+    level = 3
+
+    def __init__(self) -> None:
+        self._compressor = zstandard.ZstdCompressor(level=self.level).compressobj()
+
+    @classmethod
+    def compress_body(cls, data: bytes) -> bytes:
+        """Compresses the whole body at once."""
+        return zstandard.ZstdCompressor(level=cls.level).compress(data)
+
+    def compress(self, data: bytes) -> bytes:
+        """Compresses a chunk, flushing it so client can decode it right away."""
+        return self._compressor.compress(data) + self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self) -> bytes:
+        """End of the compressed stream."""
+        return self._compressor.flush()
+
+
+# Supported encodings in order of preference among equally weighted ones.
+ENCODINGS = {"zstd": ZstdStream, "br": BrotliStream, "gzip": GzipStream}
+
+
+def negotiate_encoding(accept_encoding: str) -> str | None:
+    """Best supported encoding of Accept-Encoding header by q-values, None to send response as is."""
+    weights = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        weight = 1.0
+        params = params.strip().replace(" ", "")
+        if params.startswith("q="):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        weights[name.strip().lower()] = weight
+    candidates = [x for x in ENCODINGS if weights.get(x, weights.get("*", 0)) > 0]
+    if not candidates:
+        return None
+    return max(candidates, key=lambda x: weights.get(x, weights.get("*", 0)))
+
+
+class CompressedBodies:
+    """Compressed bodies by encoding and digest of the original body, least recently used dropped over size."""
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self._bodies: OrderedDict[tuple[str, bytes], bytes] = OrderedDict()
+
+    async def compress(self, encoding: str, data: bytes) -> bytes:
+        """Compressed body from the cache, or compressed and cached."""
+        key = (encoding, hashlib.blake2b(data, digest_size=16).digest())
+        if key in self._bodies:
+            self.hits += 1
+            self._bodies.move_to_end(key)
+            return self._bodies[key]
+        self.misses += 1
+        compressed = await compress_body(encoding, data)
+        if len(compressed) <= self.size:
+            self._bodies[key] = compressed
+            self.used += len(compressed)
+            while self.used > self.size:
+                _, dropped = self._bodies.popitem(last=False)
+                self.used -= len(dropped)
+        return compressed
+
+    def clear(self) -> None:
+        """Drops all of the bodies."""
+        self._bodies.clear()
+        self.used = 0
+
+
+async def compress_body(encoding: str, data: bytes) -> bytes:
+    """Compresses the whole body, large ones in a thread."""
+    if len(data) >= THREAD_MIN_SIZE:
+        return await run_in_threadpool(ENCODINGS[encoding].compress_body, data)
+    return ENCODINGS[encoding].compress_body(data)
+
+
+def is_compressible(headers: Headers) -> bool:
+    """Whether response is worth compressing: not encoded yet and of a text content type."""
+    content_type = headers.get("content-type", "")
+    return "content-encoding" not in headers and content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+def is_public(scope: Scope, status: int, headers: Headers) -> bool:
+    """Whether response is the same for everyone, so its compressed body can be reused."""
+    if scope["method"] != "GET" or status != 200 or "authorization" in Headers(scope=scope):
+        return False
+    cache_control = headers.get("cache-control", "").lower()
+    return "set-cookie" not in headers and "private" not in cache_control and "no-store" not in cache_control
+
+
+class CompressionMiddleware:
+    """ASGI middleware compressing responses with the encoding client prefers, see negotiate_encoding()."""
+
+    def __init__(self, app: Callable, minimum_size: int = 1024, cache: CompressedBodies | None = None) -> None:
+        self.app = app
+        self.minimum_size = minimum_size
+        self.cache = cache
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        encoding = None
+        if scope["type"] == "http":
+            encoding = negotiate_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if not encoding:
+            await self.app(scope, receive, send)
+            return
+
+        start: Message | None = None
+        stream: GzipStream | BrotliStream | ZstdStream | None = None
+        passthrough = False
+
+        async def send_compressed(message: Message) -> None:
+            nonlocal start, stream, passthrough
+            if message["type"] == "http.response.start":
+                # Held until the first part of the body shows whether it's worth compressing.
+                start = message
+                return
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+
+            body, more_body = message.get("body", b""), message.get("more_body", False)
+            if start is not None:
+                response, start = start, None
+                headers = MutableHeaders(raw=response["headers"])
+                if not is_compressible(headers) or (not more_body and len(body) < self.minimum_size):
+                    passthrough = True
+                    await send(response)
+                    await send(message)
+                    return
+                headers["content-encoding"] = encoding
+                headers.add_vary_header("Accept-Encoding")
+                if not more_body:
+                    if self.cache is not None and is_public(scope, response["status"], headers):
+                        body = await self.cache.compress(encoding, body)
+                    else:
+                        body = await compress_body(encoding, body)
+                    headers["content-length"] = str(len(body))
+                    await send(response)
+                    await send({"type": "http.response.body", "body": body})
+                    return
+                del headers["content-length"]
+                stream = ENCODINGS[encoding]()
+                await send(response)
+
+            data = stream.compress(body) if body else b""
+            if not more_body:
+                data += stream.finish()
+            if data or not more_body:
+                await send({"type": "http.response.body", "body": data, "more_body": more_body})
+
+        await self.app(scope, receive, send_compressed)
@@ -1,7 +1,7 @@
 from exceptions import user_exists_exception
 from fastapi import APIRouter
-from models import Post
-from models.utils import add_user
+from fastapi.concurrency import run_in_threadpool
+from models.utils import add_user, count_new_posts
 from schemas.inbound import LoginPayload
 from schemas.outbound import Token, TokenPlus
 from server.utils import authenticate_user, create_access_token, get_password_hash
@@ -23,7 +23,8 @@ async def signup(
     Create new User by providing a username and password.
     """
     payload.password = get_password_hash(payload.password)
-    user = add_user(**payload.dict())
+    # Graph journal is written under a lock shared by workers, so off the event loop.
+    user = await run_in_threadpool(add_user, **payload.dict())
     if not user:
         raise user_exists_exception
 
@@ -45,14 +46,8 @@ async def login_for_access_token(
     user = authenticate_user(payload.username, payload.password)
     access_token = create_access_token(data={"sub": user.name})
 
-    new_posts_query = Post.select()
-
     # Getting new posts count since last activity of user
-    if last_activity := user.last_activity:
-        new_posts_query = new_posts_query.where(Post.created > last_activity).where(
-            Post.author.in_(user.subscriptions)
-        )
-    new_post_count = new_posts_query.count()
+    new_post_count = count_new_posts(user)
 
     return TokenPlus(
         access_token=access_token,
@@ -0,0 +1,51 @@
+import asyncio
+import time
+from collections.abc import AsyncIterator
+
+from config import EVENTS_POLL_SECONDS
+from fastapi import APIRouter, Depends
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from models import User
+from models.utils import get_events
+from schemas.inbound import EventsPayload
+from schemas.outbound import EventSchema
+from server.utils import get_current_user
+
+router = APIRouter(
+    tags=["Events"],
+)
+
+
+async def stream_events(after: int, wait: int) -> AsyncIterator[str]:
+    """Yields events following given id as JSON lines, until nothing new comes within `wait` seconds."""
+    deadline = time.monotonic() + wait
+    while True:
+        events = await run_in_threadpool(get_events, after)
+        for event in events:
+            yield EventSchema(**event.as_dict()).json() + "\n"
+        if events:
+            after = events[-1].id
+            deadline = time.monotonic() + wait
+        elif time.monotonic() >= deadline:
+            return
+        else:
+            await asyncio.sleep(EVENTS_POLL_SECONDS)
+
+
+@router.get(
+    "/events",
+    name="Tail change events",
+    response_class=StreamingResponse,
+    responses={200: {"content": {"application/x-ndjson": {"schema": EventSchema.schema()}}}},
+)
+async def events(
+    q: EventsPayload = Depends(),
+    current_user: User = Depends(get_current_user),
+) -> StreamingResponse:
+    """
+    Streams change events (signups, profile updates, posts, subscriptions) as JSON lines, oldest first.
+    Stream is closed once no new events come within `wait` seconds.
+    Use id of the last event received as `after` value to continue.
+    """
+    return StreamingResponse(stream_events(q.after, q.wait), media_type="application/x-ndjson")
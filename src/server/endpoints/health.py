@@ -0,0 +1,21 @@
+from exceptions import service_not_ready_exception
+from fastapi import APIRouter, Request
+from models.migrations import missing_tables
+from peewee import DatabaseError
+
+router = APIRouter(tags=["Info"])
+
+
+@router.get("/health/ready", name="Readiness probe.")
+def get_readiness(request: Request) -> dict[str, str]:
+    """
+    OK once the worker has started and every shard is reachable and migrated, 503 otherwise.
+    """
+    if not getattr(request.app.state, "ready", False):
+        raise service_not_ready_exception
+    try:
+        if missing_tables():
+            raise service_not_ready_exception
+    except DatabaseError:
+        raise service_not_ready_exception from None
+    return {"status": "ok"}
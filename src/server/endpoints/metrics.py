@@ -0,0 +1,13 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from models.maintenance import job_metrics
+
+router = APIRouter(tags=["Info"])
+
+
+@router.get("/metrics", response_class=PlainTextResponse, name="Maintenance jobs metrics.")
+def get_metrics() -> str:
+    """
+    Runs, failures, duration and results of the last run of every maintenance job, in Prometheus text format.
+    """
+    return job_metrics()
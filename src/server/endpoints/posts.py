@@ -1,7 +1,7 @@
 from exceptions import user_not_found_exception
 from fastapi import APIRouter, Depends
 from models import User
-from models.utils import post_filter_query_builder
+from models.utils import get_user, get_user_posts
 from schemas.inbound import NewPostPayload, PostFilterPayload
 from schemas.outbound import PostSchema
 from server.utils import get_current_user
@@ -37,11 +37,10 @@ async def get_current_user_posts(
     current_user: User = Depends(get_current_user),
 ) -> list[PostSchema]:
     """
-    List of current User posts.
+    List of current User posts, most recent first.
     """
     result = []
-    posts_query = post_filter_query_builder(current_user.posts, **q.dict())
-    for post in list(posts_query):
+    for post in get_user_posts(current_user.name, **q.dict()):
         result.append(PostSchema.from_orm(post))
     return result
 
@@ -57,13 +56,12 @@ async def get_user_posts_by_username(
     q: PostFilterPayload = Depends(),
 ) -> list[PostSchema]:
     """
-    List posts of the user with target username.
+    List posts of the user with target username, most recent first.
     """
-    user = User.get_or_none(User.name == username)
+    user = get_user(username)
     if not user:
         raise user_not_found_exception
     result = []
-    posts_query = post_filter_query_builder(user.posts, **q.dict())
-    for post in list(posts_query):
+    for post in get_user_posts(user.name, **q.dict()):
         result.append(PostSchema.from_orm(post))
     return result
@@ -1,9 +1,11 @@
 from exceptions import subscription_exists_exception
 from fastapi import APIRouter, Depends
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse
 from models import IntegrityError, User
-from models.utils import post_filter_query_builder
-from schemas.inbound import PostFilterPayload, Username
-from schemas.outbound import MessageSchema, PostSchema, PostWithAuthorSchema
+from models.utils import get_recommendations
+from schemas.inbound import FeedFilterPayload, Username
+from schemas.outbound import MessageSchema, PostSchema, PostWithAuthorSchema, RecommendationSchema
 from server.utils import get_current_user
 
 router = APIRouter(
@@ -17,19 +19,15 @@ router = APIRouter(
     response_model=list[PostWithAuthorSchema],
 )
 async def get_current_user_subscriptions(
-    q: PostFilterPayload = Depends(),
+    q: FeedFilterPayload = Depends(),
     current_user: User = Depends(get_current_user),
-) -> list[PostWithAuthorSchema]:
+) -> ORJSONResponse:
     """
-    Lists posts by current user subscriptions.
+    Lists posts by current user subscriptions, most recent first.
     It was quite complicated to write proper docstring to this function (:
+    Use id of the last post on the page as `before` value to get the next one.
     """
-    result = []
-    posts_query = post_filter_query_builder(current_user.feed(), **q.dict())
-
-    for post in posts_query:
-        result.append(PostWithAuthorSchema(**post.as_dict()))
-    return result
+    return ORJSONResponse(current_user.feed(**q.dict()))
 
 
 @router.post(
@@ -45,7 +43,7 @@ async def subscribe(
     Adds provided username to current user subscriptions.
     """
     try:
-        current_user.add_subscription(payload.username)
+        await run_in_threadpool(current_user.add_subscription, payload.username)
     except IntegrityError:
         raise subscription_exists_exception
     return MessageSchema(detail="Subscription added succeessfully")
@@ -65,5 +63,20 @@ async def delete_subscription(
     """
     # User.delete_subscription() can raise subscription_not_found_exception by itself. In order to handle exceprions properly I would add two levels of custom exceptions:
     # Model level and server level to isolate models dependencies from server package. Keeping this one as it is just for saving time.
-    current_user.delete_subscription(payload.username)
+    await run_in_threadpool(current_user.delete_subscription, payload.username)
     return MessageSchema(detail="Subscription removed succeessfully")
+
+
+@router.get(
+    "/user/me/recommendations",
+    name="Users recommended to subscribe to",
+    response_model=list[RecommendationSchema],
+)
+async def recommendations(
+    current_user: User = Depends(get_current_user),
+) -> list[RecommendationSchema]:
+    """
+    Lists users current user may want to subscribe to, best matches first.
+    Score is based on friends of friends and shared interests, lists are refreshed by `make recommendations`.
+    """
+    return [RecommendationSchema(name=name, score=score) for name, score in get_recommendations(current_user)]
@@ -1,5 +1,7 @@
+from exceptions import user_not_found_exception
 from fastapi import APIRouter, Depends, Path
 from models import User
+from models.utils import get_user as find_user
 from schemas.inbound import UpdateUserProfilePayload
 from schemas.outbound import UserProfile
 from server.utils import get_current_user
@@ -34,8 +36,7 @@ async def update_user(
     Updates current User profile data.
     """
     payload_dict = payload.dict(exclude_none=True)
-    User.update(**payload_dict).where(User.name == current_user.name).execute()
-    return User.get_by_id(current_user.name)
+    return current_user.update_profile(**payload_dict)
 
 
 @router.get(
@@ -47,5 +48,7 @@ async def user_by_username(username: str = Path(..., title="Username of target U
     """
     Gets current User profile data.
     """
-    user = User.get_by_id(username)
+    user = find_user(username)
+    if not user:
+        raise user_not_found_exception
     return UserProfile.from_orm(user)
@@ -1,7 +1,23 @@
-from fastapi import APIRouter
-from models import Post, User
-from models.utils import get_top_users
-from schemas.outbound import UserProfileWithPosts
+from config import POST_PREVIEW_COUNT
+from fastapi import APIRouter, Depends, Query
+from fastapi.responses import ORJSONResponse
+from models import graph
+from models.trending import TRENDING_WINDOWS
+from models.utils import (
+    get_all_user_profiles,
+    get_profiles,
+    search_users,
+    top_usernames,
+    trending_usernames,
+)
+from schemas.inbound import (
+    MAX_TEXT_LENGTH,
+    CompletionPayload,
+    TrendingWindow,
+    UserBatchPayload,
+    UserSearchPayload,
+)
+from schemas.outbound import UserProfile, UserProfileWithPosts
 
 router = APIRouter(tags=["List users"])
 
@@ -11,16 +27,16 @@ router = APIRouter(tags=["List users"])
     response_model=list[UserProfileWithPosts],
     name="List all user profiles with their 5 latest posts.",
 )
-async def get_all_profiles() -> list[UserProfileWithPosts]:
+async def get_all_profiles(
+    text_length: int | None = Query(
+        None, ge=1, le=MAX_TEXT_LENGTH, title="Cut post texts down to this count of characters"
+    ),
+) -> ORJSONResponse:
     """
     List of all users + 5 most recent posts
     """
-    result = []
-    for u in User.select():
-        u.posts = list(u.posts.order_by(Post.id.desc()).limit(5))
-        profileWithPosts = UserProfileWithPosts.from_orm(u)
-        result.append(profileWithPosts)
-    return result
+    # Rows are serialized as they are, see models.rows, response_model documents their shape.
+    return ORJSONResponse(get_all_user_profiles(POST_PREVIEW_COUNT, text_length))
 
 
 @router.get(
@@ -28,13 +44,53 @@ async def get_all_profiles() -> list[UserProfileWithPosts]:
     response_model=list[UserProfileWithPosts],
     name="List top user profiles with their 5 latest posts.",
 )
-async def get_top20_profiles() -> list[UserProfileWithPosts]:
+async def get_top20_profiles(
+    window: TrendingWindow | None = Query(None, title="Rank by activity within this window instead of all-time"),
+    text_length: int | None = Query(
+        None, ge=1, le=MAX_TEXT_LENGTH, title="Cut post texts down to this count of characters"
+    ),
+) -> ORJSONResponse:
     """
     List top20 users with their recent posts.
+    With `window` given users are ranked by count of new posts and subscribers within the last 24h or 7d.
+    """
+    names = trending_usernames(TRENDING_WINDOWS[window.value]) if window else top_usernames()
+    return ORJSONResponse(get_profiles(names, POST_PREVIEW_COUNT, text_length))
+
+
+@router.get(
+    "/users/search",
+    response_model=list[UserProfile],
+    name="Search users by interests, country and city.",
+)
+async def search_profiles(q: UserSearchPayload = Depends()) -> list[UserProfile]:
+    """
+    List of users having all of given interests from given country and city, ordered by name.
+    Use name of the last user on the page as `after` value to get the next one.
+    """
+    return [UserProfile.from_orm(u) for u in search_users(**q.dict())]
+
+
+@router.get(
+    "/users/complete",
+    response_model=list[str],
+    name="Complete username by prefix.",
+)
+async def complete_username(q: CompletionPayload = Depends()) -> list[str]:
+    """
+    Usernames starting with given prefix, served from in-memory index without touching database.
+    """
+    return graph.complete(q.prefix, q.limit, q.ranked)
+
+
+@router.get(
+    "/users/batch",
+    response_model=list[UserProfileWithPosts],
+    name="Look up several user profiles at once.",
+)
+async def get_profiles_batch(q: UserBatchPayload = Depends()) -> ORJSONResponse:
+    """
+    Profiles of given users in the same order, unknown usernames are skipped.
+    With `posts` enabled every profile contains latest posts, as at /users.
     """
-    result = []
-    for u in get_top_users():
-        u.posts = list(u.posts.order_by(Post.id.desc()).limit(5))
-        profileWithPosts = UserProfileWithPosts.from_orm(u)
-        result.append(profileWithPosts)
-    return result
+    return ORJSONResponse(get_profiles(q.names, POST_PREVIEW_COUNT if q.posts else 0, q.text_length))
@@ -1,16 +1,62 @@
-from fastapi import FastAPI
+import asyncio
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, Request, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import RedirectResponse
+from fastapi.responses import JSONResponse, RedirectResponse
+from pydantic import ValidationError
 
-from config import ENABLE_CORS, REMOTE_URL
-from models.utils import create_tables
+from config import (
+    BACKUP_INTERVAL_HOURS,
+    COMPRESSION_CACHE_MB,
+    COMPRESSION_MIN_SIZE,
+    ENABLE_COMPRESSION,
+    ENABLE_CORS,
+    ENABLE_MAINTENANCE,
+    REMOTE_URL,
+    TRAFFIC_CAPTURE_PATH,
+    TRAFFIC_CAPTURE_SAMPLE,
+)
+from models import graph
+from models.backup import run_backups
+from models.consumers import consumers, run_consumers
+from models.maintenance import run_maintenance
+from server.capture import TrafficCaptureMiddleware
+from server.compression import CompressedBodies, CompressionMiddleware
 from server.endpoints.auth import auth_router
+from server.endpoints.events import router as events_router
+from server.endpoints.health import router as health_router
+from server.endpoints.metrics import router as metrics_router
 from server.endpoints.posts import router as posts_router
 from server.endpoints.subscriptions import router as subscriptions_router
 from server.endpoints.user import router as user_router
 from server.endpoints.users import router as users_router
 
-create_tables()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    """Startup and shutdown of a worker.
+
+    Nothing touches the database on import: schema is brought up to date by the migration step,
+    see models.migrations, so the app can be imported once and forked into workers. Every worker maps
+    graph index and runs registered change events consumers, maintenance jobs and scheduled backups.
+    """
+    graph.refresh()
+    tasks = []
+    if consumers:
+        tasks.append(asyncio.create_task(run_consumers()))
+    if ENABLE_MAINTENANCE:
+        tasks.append(asyncio.create_task(run_maintenance()))
+    if BACKUP_INTERVAL_HOURS:
+        tasks.append(asyncio.create_task(run_backups()))
+    app.state.ready = True
+    yield
+    app.state.ready = False
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
 
 app = FastAPI(
     title="Embed.xyz test API",
@@ -19,6 +65,8 @@ app = FastAPI(
     version="0.1.0",
     servers=[{"url": REMOTE_URL}],
 )
+# FastAPI of this version doesn't take lifespan argument yet, Starlette router does.
+app.router.lifespan_context = lifespan
 
 if ENABLE_CORS:
     app.add_middleware(
@@ -29,6 +77,24 @@ if ENABLE_CORS:
         allow_credentials=True,
     )
 
+# Module level, so benchmarks.compression can read hits and clear it.
+compressed_bodies = CompressedBodies(int(COMPRESSION_CACHE_MB * 2**20))
+if ENABLE_COMPRESSION:
+    app.add_middleware(CompressionMiddleware, minimum_size=COMPRESSION_MIN_SIZE, cache=compressed_bodies)
+
+# Added last to be the outermost one, so sizes of responses are recorded as sent.
+if TRAFFIC_CAPTURE_PATH:
+    app.add_middleware(TrafficCaptureMiddleware, path=TRAFFIC_CAPTURE_PATH, sample=TRAFFIC_CAPTURE_SAMPLE)
+
+
+@app.exception_handler(ValidationError)
+async def validation_exception_handler(request: Request, exc: ValidationError) -> JSONResponse:
+    """Query payloads are validated inside of dependencies, so FastAPI doesn't turn their errors into 422 itself."""
+    return JSONResponse(
+        status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+        content={"detail": exc.errors()},
+    )
+
 
 @app.get("/", tags=["Info"], name="Redirect to API docs.")
 def serve_main() -> RedirectResponse:
@@ -41,3 +107,6 @@ app.include_router(users_router)
 app.include_router(user_router)
 app.include_router(posts_router)
 app.include_router(subscriptions_router)
+app.include_router(events_router)
+app.include_router(health_router)
+app.include_router(metrics_router)
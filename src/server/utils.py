@@ -5,6 +5,7 @@ from passlib.context import CryptContext
 
 from exceptions import not_authorized_exception, user_not_found_exception
 from models import User
+from models.utils import get_user
 
 SECRET_KEY = "some_super_secret_key"  # noqa: S105
 ALGORITHM = "HS256"
@@ -25,7 +26,7 @@ async def get_current_user(token: str = Depends(oauth2_scheme)) -> User:
     if not username:
         raise user_not_found_exception
 
-    user = User.get_or_none(name=username)
+    user = get_user(username)
     if not user:
         raise not_authorized_exception
 
@@ -36,7 +37,7 @@ async def get_current_user(token: str = Depends(oauth2_scheme)) -> User:
 
 def authenticate_user(username: str, password: str) -> User | None:
     """Returns User instance of username/password pair is correct. Otherwise rises corresponding Exceptions."""
-    user = User.get_or_none(User.name == username)
+    user = get_user(username)
     if not user:
         raise user_not_found_exception
     if not verify_password(password, user.password):
@@ -0,0 +1,17 @@
+import pytest
+from config import DB_URI
+from models.migrations import migrate
+
+
+@pytest.fixture(autouse=True, scope="session")
+def check_db_name():
+    if "test" not in DB_URI.lower():
+        pytest.exit(
+            reason='You must run tests against test DB provided via DB_URI env var(should contain "test" substring in name)'
+        )
+
+
+@pytest.fixture(autouse=True, scope="session")
+def migrated_db(check_db_name):
+    """Tables are created by the migration step, importing the server doesn't touch the database."""
+    migrate()
@@ -0,0 +1,33 @@
+import importlib
+
+import config
+import pytest
+from config import env_flag
+
+
+@pytest.mark.parametrize("value", ["", "0", "false", "False", "no", "off"])
+def test_env_flag_off(monkeypatch, value):
+    monkeypatch.setenv("TEST_FLAG", value)
+    assert not env_flag("TEST_FLAG", "1")
+
+
+@pytest.mark.parametrize("value", ["1", "true", "yes", "on"])
+def test_env_flag_on(monkeypatch, value):
+    monkeypatch.setenv("TEST_FLAG", value)
+    assert env_flag("TEST_FLAG", "")
+
+
+def test_env_flag_default(monkeypatch):
+    monkeypatch.delenv("TEST_FLAG", raising=False)
+    assert env_flag("TEST_FLAG", "1")
+    assert not env_flag("TEST_FLAG", "0")
+
+
+def test_events_delay_default(monkeypatch):
+    monkeypatch.delenv("EVENTS_DELAY_SECONDS", raising=False)
+    monkeypatch.setenv("DB_SHARD_URIS", "sqlite:///shard1_test.db")
+    try:
+        assert importlib.reload(config).EVENTS_DELAY_SECONDS > 0, "Events of several shards may commit out of order"
+    finally:
+        monkeypatch.undo()
+        importlib.reload(config)
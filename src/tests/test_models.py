@@ -1,18 +1,67 @@
+import contextlib
+import logging
+import os
+import random
+import sqlite3
+import time
+from datetime import date, datetime, timedelta
+
+import models.user
 import pytest
-from config import DB_URI
-from models import User
-from models.utils import add_user
+import zstandard
+from fastapi import HTTPException
+from models import Post, PostArchive, Subscription, User, db, graph
+from models.archive import archive_posts
+from models.backup import BackupError, backup_all, backup_due, list_backups, restore_database
+from models.compression import ZSTD_MAGIC, recompress_posts, reset_dictionaries, train_post_dictionary
+from models.consumers import Consumer
+from models.db import shards
+from models.graph import GraphConsumer, SocialGraph, graph_consumer
+from models.maintenance import (
+    MaintenanceJob,
+    audit_counters,
+    clean_orphaned_subscriptions,
+    jobs,
+    vacuum_databases,
+)
+from models.migrations import migrate, missing_tables
+from models.recommender import follows_matrix, refresh_recommendations
+from models.rows import PostRow
+from models.sharding import shard_for, using_user_shard
+from models.trending import TrendingCounter, expire_trending_counters, trending_consumer, trending_scores
+from models.utils import (
+    add_user,
+    create_tables,
+    get_all_user_profiles,
+    get_events,
+    get_profiles,
+    get_recommendations,
+    get_top_users,
+    get_trending_users,
+    get_user,
+    get_user_posts,
+    rebalance,
+    search_users,
+)
+from peewee import IntegrityError, SqliteDatabase
+from schemas.outbound import UserProfileWithPosts
 
 TEST_USER_1 = "TestUser1"
 TEST_USER_2 = "TestUser2"
 
 
-@pytest.fixture(autouse=True, scope="session")
-def check_db_name():
-    if "test" not in DB_URI.lower():
-        pytest.exit(
-            reason='You must run tests against test DB provided via DB_URI env var(should contain "test" substring in name)'
-        )
+@pytest.fixture()
+def sqlite_shards(tmp_path):
+    """Replaces configured shards with two SQLite files, returns third one to be added by test."""
+    original = shards[:]
+    shards[:] = [SqliteDatabase(tmp_path / f"shard{x}.db") for x in range(2)]
+    db.initialize(shards[0])
+    create_tables()
+    graph.rebuild()
+    yield SqliteDatabase(tmp_path / "shard2.db")
+    shards[:] = original
+    db.initialize(shards[0])
+    graph.rebuild()
 
 
 def test_add_user():
@@ -47,6 +96,25 @@ def test_user_subscribe():
     ], "Should have proper list of subscriptions"
 
 
+def test_signup_with_concurrent_commit(monkeypatch):
+    other = sqlite3.connect(shards[0].database, timeout=0)
+    get_or_create = User.get_or_create
+
+    def get_or_create_racing(**kwargs):
+        User.select().count()
+        # Another connection commits between reads and writes of the transaction, unless it's locked out.
+        with contextlib.suppress(sqlite3.OperationalError):
+            other.execute("INSERT OR REPLACE INTO event_offsets (consumer, event_id) VALUES ('racing', 0)")
+            other.commit()
+        return get_or_create(**kwargs)
+
+    monkeypatch.setattr(User, "get_or_create", get_or_create_racing)
+    try:
+        assert add_user(username="Racing", password="password"), "Signup shouldn't fail on a concurrent commit"
+    finally:
+        other.close()
+
+
 def test_user_add_post():
     user1 = User.get_by_id(TEST_USER_1)
     user2 = User.get_by_id(TEST_USER_2)
@@ -58,5 +126,428 @@ def test_user_add_post():
 
     assert user2.posts.count() == 1, "Posts count should be 1 "
     assert (
-        user1.feed().count() == 1
+        len(user1.feed()) == 1
     ), "User1 feed should be of leghth 1 after User2 adds post"
+
+
+def test_user_feed_filter():
+    user1 = User.get_by_id(TEST_USER_1)
+    user2 = User.get_by_id(TEST_USER_2)
+    older_post = user1.feed()[0]
+    newer_post = user2.add_post("other title", "text")
+
+    feed = user1.feed(usernames=[TEST_USER_2])
+    assert [x.id for x in feed] == [
+        newer_post.id,
+        older_post.id,
+    ], "Feed should be sorted from the most recent post"
+    assert len(user1.feed(limit=1)) == 1, "Feed should be limited by page size"
+    assert [x.id for x in user1.feed(before=newer_post.id)] == [
+        older_post.id
+    ], "Next page should contain older posts only"
+    assert len(user1.feed(keyword="other")) == 1, "Feed should be filtered by keyword"
+
+
+def test_user_posts_limit(caplog):
+    caplog.set_level(logging.DEBUG, logger="peewee")
+    get_user_posts(TEST_USER_1, limit=2)
+    (query,) = [x.getMessage() for x in caplog.records if 'FROM "posts"' in x.getMessage()]
+    assert "LIMIT" in query, "Recent posts should be limited by the query itself"
+
+
+def test_archive_posts():
+    user1 = User.get_by_id(TEST_USER_1)
+    user2 = User.get_by_id(TEST_USER_2)
+    post_count = user2.post_count
+    old_post = user2.add_post("old title", "text")
+    Post.update(created=datetime(2020, 1, 15)).where(Post.id == old_post.id).execute()
+
+    assert archive_posts(date(2020, 2, 1)) == 1, "Should archive only posts older than given month"
+    assert PostArchive.get(author=TEST_USER_2).period == "2020-01", "Should be stored in monthly partition"
+    assert not Post.get_or_none(Post.id == old_post.id), "Archived post should leave posts table"
+
+    assert user2.post_count == post_count + 1, "Archived posts should be counted"
+    assert get_user_posts(TEST_USER_2)[-1].id == old_post.id, "Archived posts should go after recent ones"
+    assert [x.id for x in get_user_posts(TEST_USER_2, keyword="old")] == [old_post.id]
+    assert not get_user_posts(TEST_USER_2, start=date(2020, 1, 16), end=date(2020, 1, 31))
+    assert not get_user_posts(TEST_USER_2, before=0), "Nothing precedes the first post, archived ones included"
+    assert user1.feed()[-1].title == "old title", "Archived posts should be shown in feed"
+
+
+def test_sharding(sqlite_shards):
+    names = [f"ShardUser{x}" for x in range(12)]
+    users = [add_user(username=x, password="password") for x in names]
+    assert len({shard_for(x) for x in names}) == 2, "Users should be spread across shards"
+
+    reader = users[0]
+    for user in users[1:]:
+        reader.add_subscription(user.name)
+    posts = []
+    for user in users[1:4]:
+        posts.append(user.add_post("title", "text"))
+        time.sleep(0.002)
+    assert [x.id for x in reader.feed()] == [x.id for x in reversed(posts)], "Feed should merge all shards"
+    assert users[1].subscribers_count == 1, "Subscribers should be counted in all shards"
+    assert {x.name for x in get_top_users(limit=3)} == set(names[1:4]), "Top users should be scored across shards"
+
+    shards.append(sqlite_shards)
+    create_tables()
+    moved = [x for x in names if shard_for(x) is sqlite_shards]
+    assert moved, "Some users should belong to the new shard"
+    assert rebalance() == len(moved), "Only users of the new shard should be moved"
+    assert rebalance() == 0, "Nothing to move on the second run"
+
+    assert all(get_user(x) for x in names), "Every user should be found in his/her shard"
+    assert [x.id for x in reader.feed()] == [x.id for x in reversed(posts)], "Feed should survive rebalancing"
+    assert sum(get_user(x).post_count for x in names) == len(posts)
+    assert get_user(names[0]).subscriptions_count == len(names) - 1
+
+
+def test_ids_within_millisecond(sqlite_shards, monkeypatch):
+    import models.sharding as sharding
+
+    monkeypatch.setattr(sharding.time, "time_ns", lambda: 1_700_000_000 * 10**9)
+    tags = iter(range(1, 100))
+    monkeypatch.setattr(sharding.os, "urandom", lambda size: next(tags).to_bytes(size, "big"))
+    user = add_user(username="IdUser", password="password")
+    sharding._ids.reseed()
+
+    reader, writer = os.pipe()
+    pid = os.fork()
+    if not pid:
+        # Forked worker, as gunicorn does with preloaded app.
+        with using_user_shard(user.name):
+            os.write(writer, str(sharding.next_id()).encode())
+        os._exit(0)
+    os.close(writer)
+    os.waitpid(pid, 0)
+    with os.fdopen(reader) as f:
+        forked_id = int(f.read())
+    with using_user_shard(user.name):
+        own_id = sharding.next_id()
+    assert own_id != forked_id, "Forked worker should get its own tag"
+    assert own_id >> 16 == forked_id >> 16, "Ids should differ in process tag only"
+
+    sharding._ids.reseed()
+    first = user.add_post("title", "text")
+    # Another process having drawn the same tag starts over within the same millisecond.
+    sharding._ids.millis = sharding._ids.sequence = 0
+    second = user.add_post("title", "text")
+    assert second.id == first.id + 1, "Taken id should be retried with a fresh one"
+    assert user.post_count == 2
+
+
+def test_social_graph():
+    other_worker = SocialGraph(graph.path)
+    user3 = add_user(username="TestUser3", password="password")
+    assert other_worker.has_user(user3.name), "Other workers should see new users"
+
+    user3.add_subscription(TEST_USER_1)
+    assert graph.is_following(user3.name, TEST_USER_1)
+    assert other_worker.followers_count(TEST_USER_1) == 1, "Other workers should see new subscriptions"
+    assert other_worker.followees(user3.name) == [TEST_USER_1]
+
+    graph.rebuild()
+    assert other_worker.followers_count(TEST_USER_1) == 1, "Other workers should switch to a new snapshot"
+    user3.delete_subscription(TEST_USER_1)
+    assert not other_worker.is_following(user3.name, TEST_USER_1)
+    assert other_worker.followers_count(TEST_USER_1) == 0
+
+
+def test_graph_compaction():
+    user = add_user(username="Compacted", password="password")
+    user.add_subscription(TEST_USER_1)
+    generation = graph.generation
+    assert not graph.compact(max_size=1 << 30), "Short journal should be kept"
+    assert graph.compact(max_size=0), "Long journal should be compacted"
+    assert graph.generation != generation and not os.path.getsize(graph.journal_path)
+    assert graph.followees(user.name) == [TEST_USER_1], "Compacted changes should be in the snapshot"
+    user.delete_subscription(TEST_USER_1)
+
+
+def test_subscriptions_limit(monkeypatch):
+    monkeypatch.setattr(models.user, "MAX_SUBSCRIPTIONS", 1)
+    user = add_user(username="Limited", password="password")
+    user.add_subscription(TEST_USER_1)
+    with SocialGraph(graph.path).locked():
+        assert graph.followees(user.name) == [TEST_USER_1], "Reads shouldn't wait for the lock of writers"
+        with pytest.raises(HTTPException):
+            user.add_subscription(TEST_USER_2)
+    user.delete_subscription(TEST_USER_1)
+
+
+def test_graph_of_other_host(tmp_path):
+    graph_consumer.poll()
+    other_host = SocialGraph(str(tmp_path / "graph"))
+    consumer = GraphConsumer(other_host, "graph:other-host")
+    other_host.load()
+    user = add_user(username="Remote", password="password")
+    user.add_subscription(TEST_USER_1)
+    assert not other_host.has_user(user.name), "Hosts shouldn't share index files"
+
+    consumer.poll()
+    assert other_host.is_following(user.name, TEST_USER_1), "Changes should come through the events log"
+    user.delete_subscription(TEST_USER_1)
+    consumer.poll()
+    assert not other_host.is_following(user.name, TEST_USER_1)
+    consumer.seek(0)
+    consumer.poll()
+    assert not other_host.is_following(user.name, TEST_USER_1), "Replayed events should end up in the same state"
+
+    journal_size = os.path.getsize(graph.journal_path)
+    graph_consumer.poll()
+    assert os.path.getsize(graph.journal_path) == journal_size, "Changes made locally shouldn't be written again"
+
+    other_host.rebuild()
+    assert not consumer.poll(), "Snapshot should reflect past events"
+
+
+def test_recommendations():
+    user4 = add_user(username="TestUser4", password="password")
+    user4.add_subscription(TEST_USER_1)
+
+    assert refresh_recommendations() > 0, "Users without recommendations should be computed"
+    assert get_recommendations(user4)[0][0] == TEST_USER_2, "Friends of friends should be recommended"
+    assert refresh_recommendations() == 0, "Nothing to recompute if nothing changed"
+
+    user4.add_subscription(TEST_USER_2)
+    assert TEST_USER_2 not in dict(get_recommendations(user4)), "Users subscribed to should be skipped"
+    assert refresh_recommendations() == 1, "Only user with changed subscriptions should be recomputed"
+
+    User.get_by_id(TEST_USER_1).add_subscription("TestUser3")
+    assert refresh_recommendations() == 2, "User and his/her subscribers should be recomputed"
+
+    graph.rebuild()
+    user4.delete_subscription(TEST_USER_1)
+    user4.add_subscription("TestUser3")
+    generation = graph.generation
+    names, matrix = follows_matrix()
+    assert graph.generation == generation, "Graph snapshot shouldn't be retaken"
+    assert {names[x] for x in matrix[names.index(user4.name)].indices} == {TEST_USER_2, "TestUser3"}
+
+
+class CollectingConsumer(Consumer):
+    name = "test"
+    batch_size = 2
+
+    def __init__(self):
+        self.events = []
+
+    def handle(self, events):
+        self.events += events
+
+
+def test_events(caplog):
+    consumer = CollectingConsumer()
+    assert consumer.poll() == len(consumer.events) > 0, "All of the past events should be handled"
+    caplog.set_level(logging.DEBUG, logger="peewee")
+    assert consumer.poll() == 0, "Handled events shouldn't be handed again"
+    statements = [x.getMessage() for x in caplog.records]
+    assert not [x for x in statements if "SELECT" not in x], "Polls finding nothing new shouldn't write"
+    caplog.set_level(logging.WARNING, logger="peewee")
+
+    user1 = User.get_by_id(TEST_USER_1)
+    post = user1.add_post("title", "text")
+    user1.update_profile(city="Madrid")
+    user1.delete_subscription(TEST_USER_2)
+    assert consumer.poll() == 3
+    assert [x.kind for x in consumer.events[-3:]] == ["post_added", "user_updated", "subscription_deleted"]
+    assert consumer.events[-3].as_dict()["payload"]["id"] == post.id
+    assert [x.id for x in get_events(after=consumer.events[-4].id)] == [x.id for x in consumer.events[-3:]]
+
+    user1.add_subscription(TEST_USER_2)
+    failing = CollectingConsumer()
+    failing.handle = lambda events: 1 / 0
+    with pytest.raises(ZeroDivisionError):
+        failing.poll()
+    assert consumer.poll() == 1, "Offset of failed batch shouldn't move"
+    assert consumer.events[-1].kind == "subscription_added"
+
+    with pytest.raises(IntegrityError, match="(?i)unique|duplicate"):
+        user1.add_subscription(TEST_USER_2)
+    assert consumer.poll() == 0, "Failed change should leave no event"
+
+
+def test_trending():
+    user5 = add_user(username="TestUser5", password="password")
+    user5.add_post("title", "text")
+    User.get_by_id(TEST_USER_1).add_subscription(user5.name)
+    trending_consumer.poll()
+    assert trending_scores(24)[user5.name] == 2, "New posts and subscribers should be counted"
+    assert user5.name in {x.name for x in get_trending_users(24, limit=100)}
+
+    User.get_by_id(TEST_USER_1).delete_subscription(user5.name)
+    trending_consumer.poll()
+    assert trending_scores(24 * 7)[user5.name] == 1, "Unsubscribing should be counted as well"
+
+    TrendingCounter.create(username=user5.name, bucket=datetime.now() - timedelta(days=8), posts=1)
+    assert trending_scores(24)[user5.name] == 1, "Counters out of window shouldn't be summed"
+    assert expire_trending_counters() == 1, "Counters out of the longest window should be dropped"
+
+
+def test_search_users():
+    user6 = add_user(username="TestUser6", password="password")
+    user6.update_profile(country="Spain", city="Madrid", interests="Sleep, code")
+    user7 = add_user(username="TestUser7", password="password")
+    user7.update_profile(country="Spain", city="Barcelona", interests="code, sleepwalking")
+
+    assert [x.name for x in search_users(interest=["code"])] == [user6.name, user7.name]
+    assert [x.name for x in search_users(interest=["sleep"])] == [user6.name], "Should match whole terms only"
+    assert [x.name for x in search_users(interest=["code", "sleep"])] == [user6.name], "Should match all terms"
+    assert [x.name for x in search_users(interest=["code"], city="Barcelona")] == [user7.name]
+    assert [x.name for x in search_users(country="Spain", limit=1)] == [user6.name]
+    assert [x.name for x in search_users(country="Spain", after=user6.name)] == [user7.name]
+
+    user6.update_profile(interests="code")
+    assert not search_users(interest=["sleep"]), "Index should follow profile updates"
+    user6.update_profile(bio="bio")
+    assert search_users(interest=["code"], city="Madrid"), "Index should stay if interests are not changed"
+
+
+def test_complete_usernames():
+    assert graph.complete("testuser", limit=2) == [TEST_USER_1, TEST_USER_2], "Should be case insensitive"
+    assert not graph.complete("NoSuchUser", limit=10)
+
+    other_worker = SocialGraph(graph.path)
+    add_user(username="TestUser10", password="password")
+    assert other_worker.complete("TestUser1", limit=3) == [TEST_USER_1, "TestUser10"], "Should see new users"
+
+    add_user(username="Ranked1", password="password")
+    add_user(username="Ranked2", password="password")
+    User.get_by_id(TEST_USER_2).add_subscription("Ranked2")
+    assert graph.complete("ranked", limit=2, ranked=True) == ["Ranked2", "Ranked1"], "Should rank by subscribers"
+
+
+def test_get_profiles(monkeypatch):
+    names = [TEST_USER_2, "NoSuchUser", TEST_USER_1]
+    expected = []
+    for name in (TEST_USER_2, TEST_USER_1):
+        user = User.get_by_id(name)
+        user.posts = get_user_posts(name, limit=3)
+        expected.append(UserProfileWithPosts.from_orm(user))
+    assert [UserProfileWithPosts.from_orm(x) for x in get_profiles(names, 3)] == expected, "Should match single lookups"
+    assert any(x.created.year == 2020 for x in expected[0].posts), "Archived posts should be previewed too"
+
+    queries = []
+    execute_sql = shards[0].execute_sql
+    monkeypatch.setattr(
+        shards[0], "execute_sql", lambda *args, **kwargs: queries.append(args) or execute_sql(*args, **kwargs)
+    )
+    get_profiles([f"TestUser{x}" for x in range(1, 11)], 3)
+    assert len(queries) <= 5, "Count of queries shouldn't depend on count of users"
+
+
+def test_get_all_user_profiles():
+    profiles = get_all_user_profiles(3, text_length=5)
+    names = [x.name for x in profiles]
+    assert names == sorted(names)
+    assert profiles == get_profiles(names, 3, text_length=5), "Should match lookups by names"
+    assert all(isinstance(x, PostRow) and len(x.text) <= 5 for p in profiles for x in p.posts)
+
+
+def test_post_compression(sqlite_shards, monkeypatch):
+    words = ["post", "text", "about", "the", "weather", "today", "code", "python", "sharding", "is", "fun"]
+    rng = random.Random(1)
+    user = add_user(username="Writer", password="password")
+    for _ in range(300):
+        user.add_post("title", " ".join(rng.choices(words, k=40)))
+    text = " ".join(rng.choices(words, k=40))
+    backslashed = user.add_post("title", "\\x41 and \\\\ should be kept")
+    assert get_user_posts(user.name, limit=1)[0].text == backslashed.text == "\\x41 and \\\\ should be kept"
+    (raw,) = shard_for(user.name).execute_sql("SELECT text FROM posts WHERE id = ?", (backslashed.id,)).fetchone()
+    assert isinstance(raw, bytes), "Plain texts should be bound as blobs"
+
+    monkeypatch.setattr(Post.text, "compress", True)
+    dict_id = train_post_dictionary(size=2048)
+    post = user.add_post("title", text)
+    (raw,) = shard_for(user.name).execute_sql("SELECT text FROM posts WHERE id = ?", (post.id,)).fetchone()
+    assert raw.startswith(ZSTD_MAGIC) and len(raw) < len(text) / 3, "Text should be compressed"
+    assert zstandard.get_frame_parameters(raw).dict_id == dict_id, "Text should be compressed with dictionary"
+    assert get_user_posts(user.name, limit=1)[0].text == text, "Text should be decompressed transparently"
+    assert get_user_posts(user.name, limit=1, text_length=10)[0].text == text[:10], "Preview should be truncated"
+
+    assert recompress_posts() == 302, "Every post should be rewritten"
+    assert [len(x.text) for x in get_user_posts(user.name)][-1] > 40, "Plain texts should stay readable"
+    reset_dictionaries()
+
+
+def test_backup_restore(sqlite_shards, tmp_path):
+    directory = str(tmp_path / "backups")
+    user = add_user(username="Backup", password="password")
+    user.add_post("title", "text")
+    followee = add_user(username="Followee", password="password")
+    other_host = SocialGraph(str(tmp_path / "graph"))
+    consumer = GraphConsumer(other_host, "graph:other-host")
+    other_host.load()
+    snapshots = backup_all(directory)
+    assert len(snapshots) == 2 and list_backups(directory) == sorted(snapshots), "Every shard should be backed up"
+    assert not backup_due(directory, interval_hours=1), "Next backup shouldn't be due yet"
+
+    user.add_post("title", "text")
+    user.add_subscription(followee.name)
+    trending_consumer.poll()
+    consumer.poll()
+    assert other_host.is_following(user.name, followee.name)
+    snapshot = next(x for x in snapshots if f"shard{shards.index(shard_for(user.name))}-" in x)
+    manifest = restore_database(snapshot)
+    assert manifest["tables"]["posts"] == 1
+    assert user.post_count == 1, "Posts added after backup should be gone"
+    with using_user_shard(user.name):
+        assert Subscription.select().where(Subscription.source == user.name).count() == 0
+    assert graph.followees_count(user.name) == 0 and graph.followers_count(followee.name) == 0, (
+        "Graph index should match restored database"
+    )
+    assert trending_scores(24)[user.name] == 1, "Trending counters should be recounted from restored events"
+    consumer.poll()
+    assert not other_host.is_following(user.name, followee.name), "Other hosts should rebuild their graph index"
+
+    with open(snapshot, "r+b") as f:
+        f.seek(-1, 2)
+        last = f.read(1)[0]
+        f.seek(-1, 2)
+        f.write(bytes([last ^ 0xFF]))
+    with pytest.raises(BackupError):
+        restore_database(snapshot)
+
+
+def test_maintenance_jobs(sqlite_shards):
+    assert jobs["expire_trending"].run() == {"deleted": 0}
+    assert jobs["expire_trending"].run() is None, "Job shouldn't run again before the interval passes"
+    assert MaintenanceJob.get_by_id("expire_trending").runs == 1
+
+    user = add_user(username="Maintained", password="password")
+    add_user(username="Gone", password="password").add_subscription(user.name)
+    with using_user_shard("Gone"):
+        User.delete().where(User.name == "Gone").execute()
+    Subscription.insert(source=user.name, target="Missing").execute()
+    graph.subscribe(user.name, "Missing")
+    assert clean_orphaned_subscriptions() == {"deleted": 2}
+    assert not graph.followers_count(user.name) and not graph.followees_count(user.name)
+
+    graph.subscribe(user.name, "Gone")
+    TrendingCounter.create(username=user.name, bucket=datetime.now(), posts=1)
+    result = audit_counters()
+    assert result["subscriptions_mismatches"] == 1 and result["subscribers_mismatches"] == 1
+    assert result["trending_mismatches"] == 1
+    assert not graph.followees_count(user.name), "Graph index should be rebuilt"
+    with SocialGraph(graph.path).locked():
+        assert audit_counters()["subscriptions_mismatches"] == 0, "Tables should be read without the graph locked"
+
+
+def test_vacuum():
+    user = add_user(username="Vacuumed", password="password")
+    for _ in range(100):
+        user.add_post("title", "x" * 10000)
+    Post.delete().where(Post.author == user.name).execute()
+    assert vacuum_databases()["freed_pages"] > 0, "Free pages should be returned to file system"
+
+
+def test_migrate(sqlite_shards):
+    assert not missing_tables()
+    shards.append(sqlite_shards)
+    try:
+        assert "users" in missing_tables(), "New shard should need migration"
+        assert migrate() == [], "SQLite columns should never be altered"
+        assert not missing_tables()
+    finally:
+        shards.remove(sqlite_shards)
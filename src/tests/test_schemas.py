@@ -1,6 +1,10 @@
+from datetime import datetime
+
 import pytest
+from models.rows import PostRow, ProfileRow
 from pydantic import ValidationError
-from schemas.inbound import NewPostPayload
+from schemas.inbound import FeedFilterPayload, NewPostPayload
+from schemas.outbound import UserProfileWithPosts
 
 
 def test_new_post_payload():
@@ -27,3 +31,20 @@ def test_new_post_payload():
         assert NewPostPayload(
             **payload
         ), "Must raise validation error because of too long text"
+
+
+def test_feed_filter_payload():
+    payload = FeedFilterPayload(usernames="User1, User2,User1")
+    assert payload.usernames == ["User1", "User2"], "Must cast usernames into list of unique names"
+
+    with pytest.raises(ValidationError):
+        assert FeedFilterPayload(
+            usernames=",".join(f"User{x}" for x in range(11))
+        ), "Must raise validation error because of too many usernames"
+
+
+def test_profile_from_rows():
+    post = PostRow(1, "User1", "title", "text", datetime(2022, 9, 6))
+    row = ProfileRow("User1", "Spain", "Madrid", None, ["code"], "", [], 0, 0, 1, [post])
+    profile = UserProfileWithPosts.from_orm(row)
+    assert profile.posts[0].author == "User1", "Must accept read rows directly"
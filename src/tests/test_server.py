@@ -1,5 +1,15 @@
+import asyncio
+import json
+
+import zstandard
 from fastapi.testclient import TestClient
+from benchmarks.replay import load_records, replay
 from server import app
+from server.capture import TrafficCaptureMiddleware
+from server.compression import CompressedBodies, CompressionMiddleware, negotiate_encoding
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
 
 client = TestClient(app)
 
@@ -16,6 +26,41 @@ def test_read_users():
     assert isinstance(response.json(), list)
 
 
+def test_read_trending_users():
+    response = client.get("/users/top", params={"window": "24h"})
+    assert response.status_code == 200
+    assert isinstance(response.json(), list)
+
+    response = client.get("/users/top", params={"window": "1y"})
+    assert response.status_code == 422, "Should accept supported windows only"
+
+
+def test_readiness():
+    assert client.get("/health/ready").status_code == 503, "Worker shouldn't be ready before startup"
+    with TestClient(app) as started:
+        response = started.get("/health/ready")
+    assert response.status_code == 200
+    assert response.json() == {"status": "ok"}
+
+
+def test_read_metrics():
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert "# TYPE maintenance_job_runs_total counter" in response.text
+
+
+def test_search_users():
+    response = client.get("/users/search", params={"interest": "code, sleep", "country": "Spain"})
+    assert response.status_code == 200
+    assert isinstance(response.json(), list)
+
+    response = client.get("/users/search", params={"country": "Spain"})
+    assert response.status_code == 200, "Interests filter should be optional"
+
+    response = client.get("/users/search", params={"interest": "a,b,c,d,e,f"})
+    assert response.status_code == 422, "Should limit count of interests"
+
+
 def test_add_user():
     response = client.post(
         "/signup", json={"username": "TestUser", "password": "testPassword123!@#"}
@@ -58,3 +103,168 @@ def test_random_token():
         },
     )
     assert response.status_code == 401, "Should return 401 Unauthorized"
+
+
+def test_subscriptions_feed_filter():
+    response = client.post(
+        "/token", json={"username": "TestUser", "password": "testPassword123!@#"}
+    )
+    headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+    response = client.get(
+        "/user/me/subscriptions", params={"usernames": "NoSuchUser"}, headers=headers
+    )
+    assert response.status_code == 404, "Should return 404 for non-existent usernames"
+
+    response = client.get("/user/me/subscriptions", headers=headers)
+    assert response.status_code == 200, "Usernames filter should be optional"
+
+    response = client.get(
+        "/user/me/subscriptions",
+        params={"usernames": ",".join(f"User{x}" for x in range(11))},
+        headers=headers,
+    )
+    assert response.status_code == 422, "Should return 422 for too many usernames"
+
+
+def test_read_post_previews():
+    response = client.get("/user/TestUser/posts", params={"text_length": 5})
+    assert response.status_code == 200
+    assert all(len(x["text"]) <= 5 for x in response.json()), "Texts should be cut down"
+
+    response = client.get("/users", params={"text_length": 0})
+    assert response.status_code == 422, "Should validate text length"
+
+
+def test_read_user_by_username():
+    response = client.get("/user/TestUser")
+    assert response.status_code == 200
+    assert response.json()["name"] == "TestUser"
+
+    response = client.get("/user/NoSuchUser")
+    assert response.status_code == 404, "Should return 404 for non-existent user"
+
+
+def test_recommendations():
+    response = client.post(
+        "/token", json={"username": "TestUser", "password": "testPassword123!@#"}
+    )
+    headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+    response = client.get("/user/me/recommendations", headers=headers)
+    assert response.status_code == 200
+    assert isinstance(response.json(), list)
+
+
+def test_read_users_batch():
+    response = client.get("/users/batch", params={"names": "TestUser,NoSuchUser", "posts": True})
+    assert response.status_code == 200
+    assert [x["name"] for x in response.json()] == ["TestUser"], "Unknown users should be skipped"
+    assert response.json()[0]["posts"], "Should contain latest posts"
+    assert set(response.json()[0]["posts"][0]) == {"id", "author", "title", "text", "created"}
+
+    response = client.get("/users/batch", params={"names": ",".join(f"User{x}" for x in range(51))})
+    assert response.status_code == 422, "Should limit count of usernames"
+
+
+def test_complete_username():
+    response = client.get("/users/complete", params={"prefix": "testu"})
+    assert response.status_code == 200
+    assert "TestUser" in response.json()
+
+    response = client.get("/users/complete", params={"prefix": "test", "limit": 100})
+    assert response.status_code == 422, "Should limit count of usernames"
+
+
+def test_update_user_interests():
+    response = client.post(
+        "/token", json={"username": "TestUser", "password": "testPassword123!@#"}
+    )
+    headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+    client.put("/user/me", json={"interests": ["chess"]}, headers=headers)
+    response = client.put("/user/me", json={"city": "Paris"}, headers=headers)
+    assert response.json()["interests"] == ["chess"], "Interests should stay if not provided"
+    response = client.get("/users/search", params={"interest": "Chess", "city": "Paris"})
+    assert [x["name"] for x in response.json()] == ["TestUser"]
+
+
+def test_events():
+    response = client.post(
+        "/token", json={"username": "TestUser", "password": "testPassword123!@#"}
+    )
+    headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+    response = client.get("/events", headers=headers)
+    assert response.status_code == 200
+    events = [json.loads(x) for x in response.text.splitlines()]
+    assert {"user_created", "post_added"} <= {x["kind"] for x in events}
+    ids = [x["id"] for x in events]
+    assert ids == sorted(ids), "Events should be streamed oldest first"
+
+    response = client.get("/events", params={"after": ids[-1]}, headers=headers)
+    assert response.text == "", "Nothing should be streamed after the last event"
+
+    response = client.get("/events", params={"wait": 3600}, headers=headers)
+    assert response.status_code == 422, "Should validate wait time"
+
+
+def test_capture_and_replay(tmp_path):
+    path = str(tmp_path / "traces.jsonl")
+    recording = TestClient(TrafficCaptureMiddleware(app, path))
+    credentials = {"username": "Recorded", "password": "testPassword123!@#"}
+    token = recording.post("/signup", json=credentials).json()["access_token"]
+    recording.get("/user/me", headers={"Authorization": f"Bearer {token}"})
+    recording.get("/user/Recorded", params={"text_length": 10})
+    recording.get("/health/ready")
+
+    records = load_records(path)
+    assert [x["route"] for x in records] == ["/signup", "/user/me", "/user/{username}"]
+    assert records[0]["json"] == {"username": "Recorded"}, "Passwords should be stripped"
+    assert records[1]["subject"] == "Recorded" and records[1]["status"] == 200
+    assert records[2]["query"] == "text_length=10"
+
+    report = asyncio.run(replay(app, records, speed=0))
+    assert report["requests"] == 3
+    assert report["routes"]["POST /signup"]["errors"] == 1, "User should exist already"
+    assert report["routes"]["GET /user/me"]["errors"] == 0, "Requests should be made with fresh tokens"
+    assert report["routes"]["GET /user/{username}"]["count"] == 1
+
+
+def test_compression():
+    assert negotiate_encoding("gzip, deflate") == "gzip"
+    assert negotiate_encoding("gzip;q=0.5, br") == "br"
+    assert negotiate_encoding("gzip, zstd, br") == "zstd", "Should prefer zstd among equal ones"
+    assert negotiate_encoding("*, zstd;q=0") == "br"
+    assert negotiate_encoding("identity") is None
+
+    lines = [f'{{"id": {x}}}\n' for x in range(100)]
+    demo = Starlette(
+        routes=[
+            Route("/big", lambda request: JSONResponse(list(range(1000)))),
+            Route("/small", lambda request: JSONResponse([1])),
+            Route("/stream", lambda request: StreamingResponse(iter(lines), media_type="application/x-ndjson")),
+        ]
+    )
+    cache = CompressedBodies(2**20)
+    compressed = TestClient(CompressionMiddleware(demo, minimum_size=100, cache=cache))
+    headers = {"Accept-Encoding": "zstd"}
+
+    response = compressed.get("/big", headers=headers)
+    assert response.headers["content-encoding"] == "zstd"
+    assert response.headers["vary"] == "Accept-Encoding"
+    assert int(response.headers["content-length"]) == len(response.content) < len(str(list(range(1000)))) / 2
+    assert json.loads(zstandard.ZstdDecompressor().decompress(response.content)) == list(range(1000))
+
+    compressed.get("/big", headers=headers)
+    assert (cache.hits, cache.misses) == (1, 1), "Public responses should be compressed once"
+    compressed.get("/big", headers={**headers, "Authorization": "Bearer any"})
+    assert (cache.hits, cache.misses) == (1, 1), "Responses to authorized requests shouldn't be cached"
+
+    assert compressed.get("/big", headers={"Accept-Encoding": "br"}).json() == list(range(1000))
+    assert "content-encoding" not in compressed.get("/small", headers=headers).headers, "Should skip small bodies"
+    assert "content-encoding" not in compressed.get("/big", headers={"Accept-Encoding": "identity"}).headers
+
+    response = compressed.get("/stream", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip" and "content-length" not in response.headers
+    assert response.text == "".join(lines), "Chunked responses should be compressed on the fly"